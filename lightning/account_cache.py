@@ -0,0 +1,115 @@
+import time
+import typing
+from collections import OrderedDict
+from threading import Lock
+from .config import Config
+from .db import DBAccount
+from .pubsub import Pubsub
+
+class _CachedAccount():
+    def __init__(self, account: DBAccount, loaded_at: float):
+        # Shared by all holders; do not modify.
+        self.account = account
+        self.loaded_at = loaded_at
+        # Set to True when the account is updated, or the entry is evicted.
+        self.invalidated = False
+
+    def is_valid(self, ttl: float) -> bool:
+        return not self.invalidated and time.monotonic() - self.loaded_at < ttl
+
+class AccountCache():
+    '''
+    Process wide cache of DBAccount by account_id, so that requests needing account fields do not read accounts.
+    Holders, e.g. JsonRpcSession, keep the entry returned by get() and check is_valid() before using it. Entries
+    expire after Config.AccountCacheTtl seconds, and are invalidated by "/account/updated" on Pubsub whose payload
+    is the account_id.
+    Readers take generation() before reading the account and pass it to put(), so that an account updated while it
+    was being read is not cached.
+    Thread safe.
+    '''
+    instance = None
+
+    TOPIC_ACCOUNT_UPDATED = "/account/updated"
+
+    def __init__(self, ttl: float = Config.AccountCacheTtl, max_size: int = Config.AccountCacheMaxSize):
+        self.ttl = ttl
+        self._max_size = max_size
+        self._accounts: typing.Dict[int, _CachedAccount] = OrderedDict()
+        self._lock = Lock()
+        # Incremented by each invalidate().
+        self._generation = 0
+        # account_id -> generation of its last invalidate(), the most recent last, at most @max_size.
+        self._invalidations: typing.Dict[int, int] = OrderedDict()
+        # Greatest generation dropped from _invalidations.
+        self._evicted_generation = 0
+        def on_account_updated(topic, account_id):
+            assert topic == AccountCache.TOPIC_ACCOUNT_UPDATED
+            self.invalidate(account_id)
+        self._subscriber_id = Pubsub.instance.subscribe(AccountCache.TOPIC_ACCOUNT_UPDATED, on_account_updated)
+
+    def close(self):
+        Pubsub.instance.unsubscribe(self._subscriber_id)
+
+    def get(self, account_id: int) -> _CachedAccount:
+        '''
+        @return: None if the account is not found.
+        '''
+        self._lock.acquire()
+        try:
+            cached_account = self._accounts.get(account_id, None)
+            if cached_account is not None and cached_account.is_valid(self.ttl):
+                self._accounts.move_to_end(account_id)
+                return cached_account
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        account = DBAccount.get_account_by_id(account_id)
+        return self.put(account, generation) if account else None
+
+    def generation(self) -> int:
+        self._lock.acquire()
+        try:
+            return self._generation
+        finally:
+            self._lock.release()
+
+    def put(self, account: DBAccount, generation: int) -> _CachedAccount:
+        '''
+        @generation: generation() taken before @account was read.
+        @return: the entry of @account. It is not cached, and already invalidated, if the account was invalidated
+            since @generation.
+        '''
+        cached_account = _CachedAccount(account, time.monotonic())
+        self._lock.acquire()
+        try:
+            if self._invalidations.get(account.account_id, 0) > generation or self._evicted_generation > generation:
+                cached_account.invalidated = True
+                return cached_account
+            old_cached_account = self._accounts.get(account.account_id, None)
+            if old_cached_account is not None:
+                old_cached_account.invalidated = True
+            self._accounts[account.account_id] = cached_account
+            self._accounts.move_to_end(account.account_id)
+            while len(self._accounts) > self._max_size:
+                _, evicted = self._accounts.popitem(last=False)
+                evicted.invalidated = True
+        finally:
+            self._lock.release()
+        return cached_account
+
+    def invalidate(self, account_id: int):
+        self._lock.acquire()
+        try:
+            cached_account = self._accounts.pop(account_id, None)
+            if cached_account is not None:
+                cached_account.invalidated = True
+            self._generation += 1
+            self._invalidations[account_id] = self._generation
+            self._invalidations.move_to_end(account_id)
+            while len(self._invalidations) > self._max_size:
+                _, self._evicted_generation = self._invalidations.popitem(last=False)
+        finally:
+            self._lock.release()
+
+AccountCache.instance = AccountCache()
@@ -0,0 +1,68 @@
+import random
+import time
+import unittest
+from .account_cache import AccountCache
+from .db import DBAccount, DBUtils
+from .jsonrpc_handler import JsonRpcSession
+
+class AccountCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = "before@gmail.com"
+        self.account = DBAccount.create_account(account)
+
+    def tearDown(self):
+        DBUtils.delete("accounts", "account_id", self.account.account_id)
+
+    def test_invalidatedByAccountUpdate(self):
+        cache = AccountCache()
+        try:
+            cached_account = cache.get(self.account.account_id)
+            self.assertEqual(cached_account.account.email, "before@gmail.com")
+            self.assertIs(cache.get(self.account.account_id), cached_account)
+
+            DBAccount.update_account(self.account.account_id, {"email": "after@gmail.com"})
+            self.assertFalse(cached_account.is_valid(cache.ttl))
+            self.assertEqual(cache.get(self.account.account_id).account.email, "after@gmail.com")
+            self.assertIsNone(cache.get(-1))
+        finally:
+            cache.close()
+
+    def test_updatedWhileReading(self):
+        cache = AccountCache(max_size=1)
+        try:
+            generation = cache.generation()
+            account = DBAccount.get_account_by_id(self.account.account_id)
+            DBAccount.update_account(self.account.account_id, {"email": "after@gmail.com"})
+            # Read before the update, so not cached.
+            self.assertFalse(cache.put(account, generation).is_valid(cache.ttl))
+            self.assertEqual(cache.get(self.account.account_id).account.email, "after@gmail.com")
+
+            # Also once the invalidation of the account is evicted by another one.
+            generation = cache.generation()
+            cache.invalidate(self.account.account_id)
+            cache.invalidate(-1)
+            self.assertFalse(cache.put(account, generation).is_valid(cache.ttl))
+            self.assertTrue(cache.put(account, cache.generation()).is_valid(cache.ttl))
+        finally:
+            cache.close()
+
+    def test_ttl(self):
+        cache = AccountCache(ttl=0.05)
+        try:
+            cached_account = cache.get(self.account.account_id)
+            time.sleep(0.1)
+            self.assertFalse(cached_account.is_valid(cache.ttl))
+            self.assertIsNot(cache.get(self.account.account_id), cached_account)
+        finally:
+            cache.close()
+
+    def test_session(self):
+        session = JsonRpcSession()
+        session.set_auth(self.account.account_id, int(time.time()) + 60)
+        self.assertEqual(session.get_account().email, "before@gmail.com")
+        DBAccount.update_account(self.account.account_id, {"email": "after@gmail.com"})
+        self.assertEqual(session.get_account().email, "after@gmail.com")
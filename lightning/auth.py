@@ -1,18 +1,20 @@
-
-
-
 import random
+import asyncio
 import json
 import os
 import hmac
 import hashlib
 import base64
 import time
-from .db import DBUtils, DBAccount
-
-# TODO: this way of generating and storing the secret is not scalable. It 
-# will have problems when we scale it into multiple servers.
-_jwt_secret = os.urandom(32)
+import typing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from threading import Lock
+import sys
+from .config import Config
+from .db import DBUtils, DBAccount, DatabaseParams
+from .rate_limit import TokenBucketLimiter
 
 class JwtTokenDecodeError(Exception):
 
@@ -46,18 +48,239 @@ class JwtTokenPayload():
         # It stands for "Expiration Time" in UNIX time in seconds.
         self.exp = 0
 
+class JwtKey():
+    def __init__(self, kid: str, secret: bytes):
+        # "kid" in the JWT header of tokens signed with this key. None for a key without ID, whose tokens have no "kid".
+        self.kid = kid
+        self.secret = secret
+
+def load_jwt_keys_from_file(path: str):
+    '''
+    @path: JSON file {"current_kid": "k2", "keys": [{"kid": "k2", "secret": base64}, {"kid": "k1", "secret": base64}]}
+        shared by the server processes. Keys after the current one are the previous keys, newest first.
+    @return: (List[JwtKey], current kid)
+    '''
+    with open(path, "r") as f:
+        key_ring_json = json.load(f)
+    keys = [JwtKey(key["kid"], base64.b64decode(key["secret"])) for key in key_ring_json["keys"]]
+    return keys, key_ring_json["current_kid"]
+
+def load_jwt_keys_from_db():
+    '''
+    The newest key in jwt_keys is the current one.
+    @return: (List[JwtKey], current kid)
+    '''
+    select_template = "SELECT kid, secret FROM jwt_keys ORDER BY created_at DESC, kid DESC LIMIT ?"
+    rows = DatabaseParams.connection().execute(select_template, (Config.JwtKeyRingPreviousKeys + 1, )).fetchall()
+    if not rows:
+        raise Exception("There is no JWT key in jwt_keys. Run `python -m lightning.auth rotate_jwt_key`.")
+    keys = [JwtKey(kid, base64.b64decode(secret)) for kid, secret in rows]
+    return keys, keys[0].kid
+
+def add_jwt_key_to_db() -> JwtKey:
+    '''
+    Add a random key to jwt_keys which becomes the current key of every server process once they reload it.
+    '''
+    key = JwtKey(base64.urlsafe_b64encode(os.urandom(12)).decode("ascii"), os.urandom(32))
+    with DBUtils.transaction() as conn:
+        conn.execute("INSERT INTO jwt_keys (kid, secret, created_at) VALUES (?, ?, ?)",
+            (key.kid, base64.b64encode(key.secret).decode("ascii"), int(time.time())))
+    return key
+
+# Used when Config.JwtKeyRingSource is "". Tokens are only valid in the process that signed them.
+_process_jwt_key = JwtKey(None, os.urandom(32))
+
+def _load_jwt_keys_from_config():
+    if Config.JwtKeyRingSource == "file":
+        return load_jwt_keys_from_file(Config.JwtKeyRingFile)
+    if Config.JwtKeyRingSource == "db":
+        return load_jwt_keys_from_db()
+    assert not Config.JwtKeyRingSource, "Unknown JwtKeyRingSource {}".format(Config.JwtKeyRingSource)
+    return [_process_jwt_key], _process_jwt_key.kid
+
+class JwtKeyRing():
+    '''
+    Keys used by JwtTokenUtils. Tokens are signed with the current key, and verified with the key named by the
+    "kid" in their header, which may also be one of the Config.JwtKeyRingPreviousKeys previous keys. So tokens
+    signed by any server process before a rotation stay valid after it.
+    With a loader, keys are loaded on first use, reloaded every Config.JwtKeyRingReloadInterval seconds, and
+    when a token names an unknown kid, e.g. a key added by another process.
+    Thread safe.
+    '''
+    instance = None
+
+    def __init__(self, keys=None, current_kid=None, loader=None):
+        '''
+        @keys: List[JwtKey], with @current_kid. Or @loader: func() -> (List[JwtKey], current kid).
+        '''
+        self._keys: typing.Dict[str, JwtKey] = {}
+        self._current_kid = None
+        self._loader = loader
+        self._last_load = 0
+        # Replaced whenever the keys change, e.g. for VerifiedTokenCache to drop what was verified with older keys.
+        self.version = object()
+        self._lock = Lock()
+        if keys is not None:
+            self._set_keys(keys, current_kid)
+
+    @classmethod
+    def from_secret(cls, secret: bytes, kid: str = None):
+        return JwtKeyRing([JwtKey(kid, secret)], kid)
+
+    def _set_keys(self, keys, current_kid):
+        keys_by_kid = {}
+        number_of_previous_keys = 0
+        for key in keys:
+            if key.kid == current_kid:
+                keys_by_kid[key.kid] = key
+            elif key.kid not in keys_by_kid and number_of_previous_keys < Config.JwtKeyRingPreviousKeys:
+                keys_by_kid[key.kid] = key
+                number_of_previous_keys += 1
+        assert current_kid in keys_by_kid, "Current key {} is not found".format(current_kid)
+
+        self._lock.acquire()
+        try:
+            old_keys = {kid: key.secret for kid, key in self._keys.items()}
+            new_keys = {kid: key.secret for kid, key in keys_by_kid.items()}
+            if old_keys != new_keys or self._current_kid != current_kid:
+                self._keys = keys_by_kid
+                self._current_kid = current_kid
+                self.version = object()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        assert self._loader
+        keys, current_kid = self._loader()
+        self._set_keys(keys, current_kid)
+        self._last_load = time.time()
+
+    def _reload_if_older_than(self, seconds):
+        if self._loader and time.time() - self._last_load >= seconds:
+            self.reload()
+
+    def current(self) -> JwtKey:
+        self._reload_if_older_than(Config.JwtKeyRingReloadInterval)
+        self._lock.acquire()
+        try:
+            return self._keys[self._current_kid]
+        finally:
+            self._lock.release()
+
+    def get(self, kid: str) -> JwtKey:
+        '''
+        @return: None if there is no key @kid.
+        '''
+        self._reload_if_older_than(Config.JwtKeyRingReloadInterval)
+        key = self._keys.get(kid, None)
+        if key is None:
+            self._reload_if_older_than(Config.JwtKeyRingMinReloadInterval)
+            key = self._keys.get(kid, None)
+        return key
+
+    def rotate(self, key: JwtKey):
+        '''
+        Make @key the current key of this process. The current key becomes a previous key.
+        '''
+        self._lock.acquire()
+        try:
+            keys = [key] + [self._keys[self._current_kid]] + [k for kid, k in self._keys.items() if kid != self._current_kid]
+        finally:
+            self._lock.release()
+        self._set_keys(keys, key.kid)
+
+JwtKeyRing.instance = JwtKeyRing(loader=_load_jwt_keys_from_config)
+
+class _VerifiedToken():
+    def __init__(self):
+        self.payload: JwtTokenPayload = None
+        # ID of the account of payload.sub once a caller resolved it, otherwise None.
+        self.account_id = None
+
+class VerifiedTokenCache():
+    '''
+    Bounded LRU of tokens that passed the signature check, keyed by the SHA-256 digest of the token. Entries are
+    dropped when their "exp" has passed, and all of them when the keys they were verified with change.
+    Thread safe.
+    '''
+    instance = None
+
+    def __init__(self, max_size=10000):
+        self._max_size = max_size
+        self._tokens: typing.Dict[bytes, _VerifiedToken] = OrderedDict()
+        self._key_ring_version = None
+        self._lock = Lock()
+
+    def _key(self, jwt_token: str) -> bytes:
+        return hashlib.sha256(jwt_token.encode("ascii")).digest()
+
+    def get(self, jwt_token: str, key_ring_version) -> _VerifiedToken:
+        '''
+        @key_ring_version: JwtKeyRing.version of the keys used to verify.
+        @return: None if @jwt_token is not cached for @key_ring_version.
+        '''
+        key = self._key(jwt_token)
+        self._lock.acquire()
+        try:
+            if key_ring_version is not self._key_ring_version:
+                self._tokens.clear()
+                self._key_ring_version = key_ring_version
+                return None
+            verified_token = self._tokens.get(key, None)
+            if verified_token is None:
+                return None
+            if verified_token.payload.exp < int(time.time()):
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+            return verified_token
+        finally:
+            self._lock.release()
+
+    def put(self, jwt_token: str, key_ring_version, payload: JwtTokenPayload):
+        if payload.exp < int(time.time()):
+            return
+        verified_token = _VerifiedToken()
+        verified_token.payload = payload
+        key = self._key(jwt_token)
+        self._lock.acquire()
+        try:
+            if key_ring_version is not self._key_ring_version:
+                self._tokens.clear()
+                self._key_ring_version = key_ring_version
+            self._tokens[key] = verified_token
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self._max_size:
+                self._tokens.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        self._lock.acquire()
+        try:
+            self._tokens.clear()
+        finally:
+            self._lock.release()
+
+VerifiedTokenCache.instance = VerifiedTokenCache()
+
 # Reference for the young: https://jwt.io/#debugger-io. 
 # Reference for human: https://jwt.io/introduction. 
 # Reference for the dead: https://datatracker.ietf.org/doc/html/rfc7519.
 class JwtTokenUtils():
-    def __init__(self):
-        self._jwt_secret = _jwt_secret
+    def __init__(self, key_ring: JwtKeyRing = None, verified_token_cache: VerifiedTokenCache = None):
+        self._key_ring = key_ring if key_ring else JwtKeyRing.instance
+        self._verified_token_cache = verified_token_cache if verified_token_cache else VerifiedTokenCache.instance
     
     def sign_and_build_jwt_token(self, jwt_token_payload: JwtTokenPayload) ->  str:
-        header = json.dumps({
+        key = self._key_ring.current()
+        header = {
             "typ": "JWT",
             "alg": "HS256"
-        })
+        }
+        if key.kid is not None:
+            header["kid"] = key.kid
+        header = json.dumps(header)
 
         payload = json.dumps({
             "sub": jwt_token_payload.sub,
@@ -70,11 +293,34 @@ class JwtTokenUtils():
 
         # Sign it with HMAC-SHA256
         msg = base64url_header + "." + base64url_payload
-        signature = _hmac_hash256(msg.encode("ascii"), self._jwt_secret)
+        signature = _hmac_hash256(msg.encode("ascii"), key.secret)
         base64url_signature = _remove_padding(base64.urlsafe_b64encode(signature).decode("ascii"))
         return base64url_header + "." + base64url_payload + "." + base64url_signature
 
     def verify_and_extract_payload(self, jwt_token: str) -> JwtTokenPayload:
+        '''
+        Tokens verified before are served from the VerifiedTokenCache without decoding and hashing them again.
+        '''
+        verified_token = self._verified_token_cache.get(jwt_token, self._key_ring.version)
+        if verified_token:
+            return copy(verified_token.payload)
+        jwt_token_payload = self._verify_and_extract_payload(jwt_token)
+        self._verified_token_cache.put(jwt_token, self._key_ring.version, copy(jwt_token_payload))
+        return jwt_token_payload
+
+    def get_cached_account_id(self, jwt_token: str):
+        '''
+        @return: account ID set by set_cached_account_id for a verified @jwt_token, otherwise None.
+        '''
+        verified_token = self._verified_token_cache.get(jwt_token, self._key_ring.version)
+        return verified_token.account_id if verified_token else None
+
+    def set_cached_account_id(self, jwt_token: str, account_id: int):
+        verified_token = self._verified_token_cache.get(jwt_token, self._key_ring.version)
+        if verified_token:
+            verified_token.account_id = account_id
+
+    def _verify_and_extract_payload(self, jwt_token: str) -> JwtTokenPayload:
         parts = jwt_token.split(".")
         if len(parts) != 3:
             raise JwtTokenDecodeError("JWT Token must have 3 parts (header, payload, signature)")
@@ -89,12 +335,13 @@ class JwtTokenUtils():
         except Exception as e:
             raise JwtTokenDecodeError("Failed to decode the JWT Token header and payload: {}".format(str(e)))
 
-        # Verify signature
+        # Verify signature with the key that signed the token.
+        key = self._key_ring.get(header.get("kid", None))
+        if key is None:
+            raise JwtTokenDecodeError("JWT Token kid {} is unknown.".format(header.get("kid", None)))
         msg = parts[0] + "." + parts[1]
-        expected_signature = _hmac_hash256(msg.encode("ascii"), self._jwt_secret)
-        if expected_signature != base64.urlsafe_b64decode(_add_mssing_padding(parts[2])):
-            print(expected_signature)
-            print(base64.urlsafe_b64decode(parts[2]))
+        expected_signature = _hmac_hash256(msg.encode("ascii"), key.secret)
+        if not hmac.compare_digest(expected_signature, base64.urlsafe_b64decode(_add_mssing_padding(parts[2]))):
             raise JwtTokenDecodeError("JWT Token signature is not valid.")
 
         # jwt_token is valid. Next, we unpack the content.
@@ -118,20 +365,86 @@ class AuthUserExists(Exception):
         Exception.__init__(self, error_message)
 
 
+def _scrypt_hash(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # Runs in the password hash worker processes.
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256*n*r + 2**20, dklen=32)
+
+_password_hash_executor: ProcessPoolExecutor = None
+
+def _get_password_hash_executor() -> ProcessPoolExecutor:
+    global _password_hash_executor
+    if _password_hash_executor is None:
+        _password_hash_executor = ProcessPoolExecutor(max_workers=Config.PasswordHashWorkers)
+    return _password_hash_executor
+
+def _scrypt_kdf() -> str:
+    '''
+    @return: the password_kdf of accounts hashed with the scrypt cost in Config.
+    '''
+    return "scrypt${}${}${}".format(Config.PasswordHashScryptN, Config.PasswordHashScryptR, Config.PasswordHashScryptP)
+
+class AuthRateLimited(Exception):
+    def __init__(self, error_message):
+        Exception.__init__(self, error_message)
+
 class Auth():
-    # TODO: externalize this so that salt can be keep as a secret. If salt is known, and 
-    # hash(password) in the DB are leaked, password can be figured by hashing all possible passwords.
+    # Login attempts are throttled per username and per remote address before any DB or hashing work, so that
+    # a burst of guesses costs little. Shared by all Auth instances.
+    _username_limiter = TokenBucketLimiter(Config.LoginRatePerUsername, Config.LoginBurstPerUsername, Config.LoginRateLimitMaxKeys)
+    _remote_address_limiter = TokenBucketLimiter(Config.LoginRatePerRemoteAddress, Config.LoginBurstPerRemoteAddress, Config.LoginRateLimitMaxKeys)
+
+    # Only for accounts created before per-account salts, i.e. with an empty password_kdf. They are
+    # rehashed with scrypt on their next login.
     _salt = b"BTC Price: 49,030.60 on Dec 13, 2021 3:40 AM UTC"
 
     def __init__(self):
         pass
 
-    def _password_hash(self, password: str):
+    def _legacy_password_hash(self, password: str) -> bytes:
         password_with_salt = Auth._salt + password.encode("ascii")
         password_hash = hashlib.sha256(password_with_salt).digest()
         return base64.b64encode(password_hash)
 
-    def authenticate(self, username: str, password: str):
+    async def _password_hash(self, password: str, password_salt: str, password_kdf: str) -> str:
+        '''
+        scrypt is memory-hard and takes tens of milliseconds, so it runs in the password hash worker
+        processes instead of blocking the event loop.
+        @password_salt: base64
+        @password_kdf: "scrypt$n$r$p"
+        @return: base64 of the hash
+        '''
+        kdf_name, n, r, p = password_kdf.split("$")
+        assert kdf_name == "scrypt", "Unknown password_kdf {}".format(password_kdf)
+        loop = asyncio.get_running_loop()
+        password_hash = await loop.run_in_executor(_get_password_hash_executor(), _scrypt_hash,
+            password.encode("utf-8"), base64.b64decode(password_salt), int(n), int(r), int(p))
+        return base64.b64encode(password_hash).decode("ascii")
+
+    async def _new_password_hash(self, password: str):
+        '''
+        @return: (password hash, password_salt, password_kdf) for a new random salt and the cost in Config.
+        '''
+        password_salt = base64.b64encode(os.urandom(16)).decode("ascii")
+        password_kdf = _scrypt_kdf()
+        return await self._password_hash(password, password_salt, password_kdf), password_salt, password_kdf
+
+    @classmethod
+    def get_login_rate_limit_counters(cls) -> dict:
+        return {
+            "username": cls._username_limiter.get_counters(),
+            "remote_address": cls._remote_address_limiter.get_counters()
+        }
+
+    async def authenticate(self, username: str, password: str, remote_address: str = None):
+        '''
+        @remote_address: of the client, if known.
+        @raise AuthRateLimited: if there are too many attempts for @username or from @remote_address.
+        '''
+        if remote_address is not None and not self._remote_address_limiter.try_acquire(remote_address):
+            raise AuthRateLimited("Too many login attempts from {}.".format(remote_address))
+        if not self._username_limiter.try_acquire(username):
+            raise AuthRateLimited("Too many login attempts for user {}.".format(username))
+
         query = "SELECT * FROM accounts where username = ?"
         accounts = DBUtils.select(DBAccount(), query, (username,))
         if len(accounts) == 0:
@@ -140,12 +453,27 @@ class Auth():
         assert len(accounts) == 1
         account_found = accounts[0]
 
-        if account_found.password == self._password_hash(password):
-            return True
+        if account_found.password_kdf:
+            password_hash = await self._password_hash(password, account_found.password_salt, account_found.password_kdf)
+            authenticated = hmac.compare_digest(account_found.password.encode("ascii"), password_hash.encode("ascii"))
         else:
-            return False
-
-    def create_account(self, username: str, password: str, email: str):
+            stored_password = account_found.password
+            if type(stored_password) == str:
+                stored_password = stored_password.encode("ascii")
+            authenticated = hmac.compare_digest(stored_password, self._legacy_password_hash(password))
+
+        # Move the account to the current hashing scheme and cost while the password is known.
+        if authenticated and account_found.password_kdf != _scrypt_kdf():
+            password_hash, password_salt, password_kdf = await self._new_password_hash(password)
+            DBAccount.update_account(account_found.account_id, {
+                "password": password_hash,
+                "password_salt": password_salt,
+                "password_kdf": password_kdf
+            })
+
+        return authenticated
+
+    async def create_account(self, username: str, password: str, email: str):
         query = "SELECT * FROM accounts where username = ?"
         accounts = DBUtils.select(DBAccount(), query, (username,))
         if accounts:
@@ -153,8 +481,16 @@ class Auth():
 
         new_account = DBAccount()
         new_account.username = username
-        new_account.password = self._password_hash(password)
+        new_account.password, new_account.password_salt, new_account.password_kdf = await self._new_password_hash(password)
         new_account.email = email
 
         return DBUtils.insert(new_account, "accounts", "account_id")
 
+if __name__ == '__main__':
+    # Add a new current JWT key for Config.JwtKeyRingSource = "db". Tokens signed with the previous
+    # Config.JwtKeyRingPreviousKeys keys stay valid.
+    # python -m lightning.auth rotate_jwt_key
+    if sys.argv[1:] == ["rotate_jwt_key"]:
+        print("Added JWT key {}".format(add_jwt_key_to_db().kid))
+    else:
+        print("Usage: python -m lightning.auth rotate_jwt_key")
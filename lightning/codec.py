@@ -0,0 +1,137 @@
+'''
+Encoding of the JSON messages of the websocket and the Lightning node. Serialization is the largest per
+message CPU cost, so a faster library, orjson or msgspec, is used when installed, with the standard json
+module as the fallback. See codec_benchmark.py for the cost per frame.
+
+Websocket clients may instead negotiate a binary encoding with the Sec-WebSocket-Protocol header, e.g.
+"jsonrpc-msgpack". The JSON-RPC messages are the same, only their encoding differs.
+'''
+import json
+
+class CodecDecodeError(ValueError):
+    def __init__(self, error_message):
+        ValueError.__init__(self, error_message)
+
+class Codec():
+    # Name of the library, for logging and benchmarks.
+    name = ""
+    # If True, dumps returns bytes to be sent as binary frames, otherwise str.
+    binary = False
+
+    def dumps(self, obj):
+        raise NotImplementedError("Must be implemented")
+
+    def loads(self, data):
+        '''
+        @data: str or bytes
+        @raise CodecDecodeError: if @data is malformed.
+        '''
+        raise NotImplementedError("Must be implemented")
+
+class StdlibJsonCodec(Codec):
+    name = "json"
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise CodecDecodeError(str(e))
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        return self._orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, data):
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError as e:
+            raise CodecDecodeError(str(e))
+
+class MsgspecJsonCodec(Codec):
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self._msgspec = msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj) -> str:
+        return self._encoder.encode(obj).decode("utf-8")
+
+    def loads(self, data):
+        try:
+            return self._decoder.decode(data)
+        except self._msgspec.DecodeError as e:
+            raise CodecDecodeError(str(e))
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, obj) -> bytes:
+        return self._msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        if type(data) == str:
+            raise CodecDecodeError("Expected a binary frame")
+        try:
+            return self._msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError, self._msgpack.UnpackException) as e:
+            raise CodecDecodeError(str(e))
+
+def available_json_codecs():
+    '''
+    @return: List[Codec] of the installed libraries, fastest first. StdlibJsonCodec is always the last.
+    '''
+    codecs = []
+    for codec_class in [OrjsonCodec, MsgspecJsonCodec]:
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            pass
+    codecs.append(StdlibJsonCodec())
+    return codecs
+
+json_codec: Codec = available_json_codecs()[0]
+
+SUBPROTOCOL_JSONRPC_MSGPACK = "jsonrpc-msgpack"
+
+def _load_subprotocol_codecs():
+    codecs = {}
+    for subprotocol, codec_class in [(SUBPROTOCOL_JSONRPC_MSGPACK, MsgpackCodec)]:
+        try:
+            codecs[subprotocol] = codec_class()
+        except ImportError:
+            pass
+    return codecs
+
+_subprotocol_codecs = _load_subprotocol_codecs()
+
+def available_subprotocols():
+    '''
+    @return: List[str] of the websocket subprotocols whose library is installed, for websockets.serve.
+    '''
+    return list(_subprotocol_codecs.keys())
+
+def codec_for_subprotocol(subprotocol) -> Codec:
+    '''
+    @subprotocol: the negotiated websocket subprotocol, or None.
+    @return: the Codec of @subprotocol, json_codec if none was negotiated.
+    '''
+    if subprotocol is None:
+        return json_codec
+    return _subprotocol_codecs[subprotocol]
@@ -0,0 +1,28 @@
+import timeit
+from .codec import available_json_codecs, available_subprotocols, codec_for_subprotocol
+
+def _frames():
+    invoice = {
+        "invoice_id": 1234567, "status": "paid", "encoded_invoice": "lnbc" + "x"*300, "account_id": 42,
+        "created_at": 1640000000, "amount_requested": 2500, "exchange_rate": 2000, "expired_at": 1640000600
+    }
+    return {
+        "request": {"jsonrpc": "2.0", "method": "list_invoices", "params": {"limit": 100}, "id": 7},
+        "response": {"jsonrpc": "2.0", "result": {"invoices": [invoice]*100, "next_cursor": "eyJhZnRlciI6IDF9"}, "id": 7},
+        "feed": {"jsonrpc": "2.0", "method": "feed", "params": {"feed_id": 1, "feed": [{"invoice_id": 1234567, "status": "paid"}]}},
+    }
+
+def main(number=2000):
+    print("{:10} {:10} {:>12} {:>12} {:>8}".format("codec", "frame", "encode us", "decode us", "bytes"))
+    codecs = available_json_codecs() + [codec_for_subprotocol(subprotocol) for subprotocol in available_subprotocols()]
+    for codec in codecs:
+        for frame_name, frame in _frames().items():
+            encoded = codec.dumps(frame)
+            encode_seconds = timeit.timeit(lambda: codec.dumps(frame), number=number)
+            decode_seconds = timeit.timeit(lambda: codec.loads(encoded), number=number)
+            print("{:10} {:10} {:12.2f} {:12.2f} {:8}".format(codec.name, frame_name,
+                encode_seconds / number * 1e6, decode_seconds / number * 1e6, len(encoded)))
+
+if __name__ == '__main__':
+    # python -m lightning.codec_benchmark
+    main()
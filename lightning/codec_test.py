@@ -0,0 +1,43 @@
+import unittest
+from .codec import available_json_codecs, json_codec, StdlibJsonCodec, CodecDecodeError
+from .codec import available_subprotocols, codec_for_subprotocol, SUBPROTOCOL_JSONRPC_MSGPACK
+
+class CodecTest(unittest.TestCase):
+    def test_roundTrip(self):
+        message = {"jsonrpc": "2.0", "result": {"invoices": [{"invoice_id": 1, "status": "paid"}], "msg": "café"}, "id": 1}
+        for codec in available_json_codecs():
+            self.assertEqual(message, codec.loads(codec.dumps(message)), codec.name)
+            self.assertEqual(message, codec.loads(codec.dumps(message).encode("utf-8")), codec.name)
+            # Interoperable with the standard json module.
+            self.assertEqual(message, StdlibJsonCodec().loads(codec.dumps(message)), codec.name)
+
+    def test_decodeError(self):
+        for codec in available_json_codecs():
+            with self.assertRaises(CodecDecodeError):
+                codec.loads("{\"jsonrpc\": ")
+
+    def test_fallback(self):
+        codecs = available_json_codecs()
+        self.assertEqual(StdlibJsonCodec.name, codecs[-1].name)
+        self.assertEqual(codecs[0].name, json_codec.name)
+
+    def test_subprotocol(self):
+        self.assertIs(json_codec, codec_for_subprotocol(None))
+        try:
+            import msgpack
+        except ImportError:
+            # Not advertised to clients when the library is missing.
+            self.assertNotIn(SUBPROTOCOL_JSONRPC_MSGPACK, available_subprotocols())
+            return
+        codec = codec_for_subprotocol(SUBPROTOCOL_JSONRPC_MSGPACK)
+        message = {"jsonrpc": "2.0", "method": "feed", "params": {"feed_id": 1, "feed": [{"invoice_id": 1}]}}
+        self.assertTrue(codec.binary)
+        self.assertEqual(message, codec.loads(codec.dumps(message)))
+        with self.assertRaises(CodecDecodeError):
+            codec.loads("{}")
+        # A map keyed by an array, i.e. an unhashable key.
+        with self.assertRaises(CodecDecodeError):
+            codec.loads(b"\x81\x90\x01")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+permessage-deflate of the websockets with a minimum message size for compression and per connection
+byte counters. Small frames, e.g. most feed frames, barely shrink and still cost a compression call.
+'''
+import dataclasses
+import typing
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from .config import Config
+
+class CompressionMetrics():
+    def __init__(self):
+        # Data frames sent, and how many of them were compressed.
+        self.frames = 0
+        self.compressed_frames = 0
+        # Payload bytes of the data frames sent, before and after compression.
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def to_dict(self):
+        return {
+            "frames": self.frames,
+            "compressed_frames": self.compressed_frames,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after
+        }
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    '''
+    PerMessageDeflate that sends messages smaller than @min_size uncompressed, which RFC 7692 allows
+    since rsv1 marks each message as compressed or not.
+    '''
+    def __init__(self, remote_no_context_takeover: bool, local_no_context_takeover: bool, remote_max_window_bits: int,
+            local_max_window_bits: int, compress_settings: dict = None, min_size: int = 0):
+        PerMessageDeflate.__init__(self, remote_no_context_takeover, local_no_context_takeover, remote_max_window_bits,
+            local_max_window_bits, compress_settings)
+        self.min_size = min_size
+        self.metrics = CompressionMetrics()
+        # Whether the message of the following continuation frames is compressed.
+        self._compress_message = True
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+
+        if frame.opcode is not frames.OP_CONT:
+            # Only a message sent in one frame has a known size.
+            self._compress_message = not frame.fin or len(frame.data) >= self.min_size
+
+        if self._compress_message:
+            encoded_frame = PerMessageDeflate.encode(self, frame)
+            self.metrics.compressed_frames += 1
+        else:
+            encoded_frame = frame
+        self.metrics.frames += 1
+        self.metrics.bytes_before += len(frame.data)
+        self.metrics.bytes_after += len(encoded_frame.data)
+        return encoded_frame
+
+class ThresholdServerPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size: int = 0, **kwargs):
+        '''
+        @kwargs: see ServerPerMessageDeflateFactory.
+        '''
+        ServerPerMessageDeflateFactory.__init__(self, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = ServerPerMessageDeflateFactory.process_request_params(self, params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(extension.remote_no_context_takeover, 
+            extension.local_no_context_takeover, extension.remote_max_window_bits, extension.local_max_window_bits,
+            extension.compress_settings, self.min_size)
+
+def server_extensions():
+    '''
+    @return: the extensions argument of websockets.serve according to Config, None if compression is off.
+    '''
+    if not Config.WebSocketCompression:
+        return None
+    return [ThresholdServerPerMessageDeflateFactory(
+        min_size=Config.WebSocketCompressionMinSize,
+        server_max_window_bits=Config.WebSocketCompressionServerMaxWindowBits,
+        client_max_window_bits=Config.WebSocketCompressionClientMaxWindowBits,
+        compress_settings={"memLevel": Config.WebSocketCompressionMemLevel}
+    )]
+
+def compression_metrics(websocket) -> typing.Optional[CompressionMetrics]:
+    '''
+    @websocket: WebSocketServerProtocol
+    @return: CompressionMetrics of @websocket, None if the connection is not compressed.
+    '''
+    for extension in websocket.extensions:
+        if isinstance(extension, ThresholdPerMessageDeflate):
+            return extension.metrics
+    return None
@@ -0,0 +1,44 @@
+import unittest
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from .compression import ThresholdServerPerMessageDeflateFactory, compression_metrics
+
+class CompressionTest(unittest.TestCase):
+
+    def test_minSize(self):
+        factory = ThresholdServerPerMessageDeflateFactory(min_size=100, server_max_window_bits=12, 
+            client_max_window_bits=12, compress_settings={"memLevel": 5})
+        _, server_extension = factory.process_request_params([("client_max_window_bits", None)], [])
+        # The client decodes what the server encodes.
+        client_extension = PerMessageDeflate(False, False, 12, 12)
+
+        small = frames.Frame(frames.OP_TEXT, b'{"jsonrpc": "2.0", "result": "ok", "id": 1}')
+        encoded = server_extension.encode(small)
+        self.assertFalse(encoded.rsv1)
+        self.assertEqual(small.data, encoded.data)
+        self.assertEqual(small.data, client_extension.decode(encoded).data)
+
+        large = frames.Frame(frames.OP_TEXT, b'{"jsonrpc": "2.0", "method": "feed", "params": ' + b'{"status": "paid"}, '*50 + b'}')
+        for _ in range(2):
+            encoded = server_extension.encode(large)
+            self.assertTrue(encoded.rsv1)
+            self.assertLess(len(encoded.data), len(large.data))
+            self.assertEqual(large.data, client_extension.decode(encoded).data)
+
+        # Control frames are not counted.
+        server_extension.encode(frames.Frame(frames.OP_PING, b""))
+
+        metrics = server_extension.metrics
+        self.assertEqual(3, metrics.frames)
+        self.assertEqual(2, metrics.compressed_frames)
+        self.assertEqual(len(small.data) + 2*len(large.data), metrics.bytes_before)
+        self.assertLess(metrics.bytes_after, metrics.bytes_before)
+
+        class MockWebSocket():
+            def __init__(self, extensions):
+                self.extensions = extensions
+        self.assertIs(metrics, compression_metrics(MockWebSocket([server_extension])))
+        self.assertIsNone(compression_metrics(MockWebSocket([])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,3 +5,115 @@ class Config:
     LightningUnixSocket = ""
     
     LoggingLevel = logging.DEBUG
+
+    # Where the JWT signing keys shared by all server processes come from. One of
+    # "": a random key per process, so tokens are only valid in the process that signed them.
+    # "file": JwtKeyRingFile, see auth.load_jwt_keys_from_file.
+    # "db": the jwt_keys table, rotated with `python -m lightning.auth rotate_jwt_key`.
+    JwtKeyRingSource = ""
+    JwtKeyRingFile = ""
+    # Number of keys before the current one that are still accepted.
+    JwtKeyRingPreviousKeys = 1
+    # In seconds. How often keys are reloaded, and at most how often a token with an unknown kid triggers a reload.
+    JwtKeyRingReloadInterval = 60
+    JwtKeyRingMinReloadInterval = 1
+
+    # scrypt cost of password hashes. Accounts hashed with another cost are rehashed on their next login.
+    PasswordHashScryptN = 2**14
+    PasswordHashScryptR = 8
+    PasswordHashScryptP = 1
+    # Number of processes hashing passwords, so that logins neither block the event loop nor each other.
+    PasswordHashWorkers = os.cpu_count()
+
+    # Login attempts allowed per second on average, and at once, for each username and each remote address.
+    LoginRatePerUsername = 5 / 60
+    LoginBurstPerUsername = 5
+    LoginRatePerRemoteAddress = 1
+    LoginBurstPerRemoteAddress = 20
+    # Number of usernames, and of remote addresses, whose attempts are tracked.
+    LoginRateLimitMaxKeys = 100000
+
+    # In seconds. How long AccountCache serves an account without reading it again.
+    AccountCacheTtl = 300
+    AccountCacheMaxSize = 100000
+
+    # Max number of requests of a websocket that are handled concurrently.
+    JsonRpcMaxConcurrentRequests = 10
+    # Max number of requests in a JSON-RPC batch. Larger batches are rejected.
+    JsonRpcMaxBatchSize = 100
+    # In seconds. A request that takes longer is cancelled and gets a timeout error. A request may set its own
+    # timeout with the "_timeout" param, up to the max.
+    JsonRpcRequestTimeoutSeconds = 30
+    JsonRpcMaxRequestTimeoutSeconds = 600
+
+    # Max number of websockets of the process, and of each authenticated account.
+    MaxConnections = 10000
+    MaxConnectionsPerAccount = 20
+    # In seconds. A websocket that has not authenticated in time is closed.
+    AuthenticateTimeoutSeconds = 10
+    # In seconds. websockets pings every interval, and closes the websocket if the pong takes longer than the timeout.
+    WebSocketPingInterval = 20
+    WebSocketPingTimeout = 20
+    # In bytes, max size of a received message, and max number of received messages buffered per websocket.
+    WebSocketMaxMessageSize = 1024 * 1024
+    WebSocketMaxQueue = 16
+    # In seconds. How often the number of connections is logged.
+    ConnectionCountsLogInterval = 60
+
+    # permessage-deflate of websockets. Compression trades server CPU and memory per connection for bandwidth.
+    WebSocketCompression = True
+    # Between 8 and 15. Smaller windows use less memory per connection and compress less.
+    WebSocketCompressionServerMaxWindowBits = 12
+    WebSocketCompressionClientMaxWindowBits = 12
+    # Between 1 and 9, zlib memLevel.
+    WebSocketCompressionMemLevel = 5
+    # In bytes. Messages smaller than this are sent uncompressed.
+    WebSocketCompressionMinSize = 128
+
+    # In bytes. Once this many bytes are queued for a websocket, senders wait until the queue is down to the low watermark.
+    OutboundQueueHighWatermark = 1024 * 1024
+    OutboundQueueLowWatermark = 256 * 1024
+    # In seconds. A websocket whose queue stays over the high watermark for longer is closed.
+    OutboundQueueMaxCongestedSeconds = 30
+    # Number of invoices whose feed items are held while the websocket is congested. Items of further invoices are dropped.
+    FeedMaxPendingItems = 10000
+
+    # Number of recent items of each feed of each account kept in memory for clients resuming a feed with since_seq.
+    FeedReplayRingSize = 256
+    # Number of items written to sqlite at once when a ring is over its size.
+    FeedReplaySpillBatchSize = 64
+    # Number of (account, feed type) rings in memory. The least recently used ring is spilled to sqlite.
+    FeedReplayMaxRings = 10000
+    # In seconds. How long spilled items can be replayed.
+    FeedReplayRetentionSeconds = 24 * 60 * 60
+
+    # Number of invoices a websocket can watch with the invoice_status feed.
+    FeedMaxWatchedInvoices = 1000
+
+    # In seconds. Timeout of the exchange rate requests, see market.exchange_info.
+    MarketRequestTimeoutSeconds = 10
+
+    # Pools of invoices created ahead of time for fixed amounts, see DBInvoicePool. Max number of invoices of a pool,
+    # and of pools of an account.
+    InvoicePoolMaxSize = 20
+    InvoicePoolMaxPoolsPerAccount = 3
+    # Expiry of the pool invoices on the node, see LightningNode.invoice.
+    InvoicePoolInvoiceExpiry = "15m"
+    # In seconds. Pool invoices expiring sooner are dropped instead of handed out, so that the payer has time to pay,
+    # and the exchange rate of a claimed invoice is at most InvoicePoolInvoiceExpiry minus this old.
+    InvoicePoolMinRemainingSeconds = 600
+    # In seconds. How often LightningMonitor drops and replaces the pool invoices that are about to expire, on a thread
+    # of its own so that a slow exchange rate request or node does not hold up the polling of the invoice statuses.
+    InvoicePoolRefillInterval = 5
+    # Max number of pool invoices LightningMonitor creates on the node per refill, across all pools, so that a refill
+    # does not hold the node for long. Pools still short are refilled on the next ones.
+    InvoicePoolMaxInvoicesPerRefill = 10
+
+    # Max number of invoices of a create_invoices request, and of its invoices being created on the node at a time.
+    CreateInvoicesMaxBatchSize = 500
+    CreateInvoicesMaxConcurrentNodeCalls = 16
+
+    # Number of initiated payouts PayoutScheduler picks up and moves through the statuses in one transaction.
+    PayoutBatchSize = 500
+    # In seconds. How often PayoutScheduler looks for initiated payouts.
+    PayoutPollingInterval = 60
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import typing
+from threading import Lock
+from .config import Config
+from .jsonrpc_handler import JsonRpcSession
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+# Try again later. The server is at Config.MaxConnections.
+CLOSE_CODE_TRY_AGAIN_LATER = 1013
+# Policy violation. The remote did not authenticate within Config.AuthenticateTimeoutSeconds.
+CLOSE_CODE_AUTHENTICATE_TIMEOUT = 1008
+
+class ConnectionLimitError(Exception):
+    def __init__(self, error_message):
+        Exception.__init__(self, error_message)
+
+class ConnectionRegistry():
+    '''
+    Live websocket connections, each identified by its JsonRpcSession. Limits the number of connections of the
+    process to @max_connections, and of each account to @max_connections_per_account, so that one client can not
+    use up the file descriptors and memory of the server.
+    Sessions that are not registered, e.g. of tests, are not limited.
+    Thread safe.
+    '''
+    instance = None
+
+    def __init__(self, max_connections: int = Config.MaxConnections,
+            max_connections_per_account: int = Config.MaxConnectionsPerAccount):
+        self._max_connections = max_connections
+        self._max_connections_per_account = max_connections_per_account
+        # session -> account_id, None until authenticated.
+        self._connections: typing.Dict[JsonRpcSession, typing.Optional[int]] = {}
+        # account_id -> number of connections.
+        self._account_connections: typing.Dict[int, int] = {}
+        self._lock = Lock()
+        # Counters for monitoring.
+        self.rejected = 0
+
+    def is_full(self) -> bool:
+        self._lock.acquire()
+        try:
+            return len(self._connections) >= self._max_connections
+        finally:
+            self._lock.release()
+
+    def register(self, session: JsonRpcSession):
+        '''
+        @raise ConnectionLimitError: if there are already max_connections connections.
+        '''
+        self._lock.acquire()
+        try:
+            if len(self._connections) >= self._max_connections:
+                self.rejected += 1
+                raise ConnectionLimitError("Max number of connections {} reached".format(self._max_connections))
+            self._connections[session] = None
+        finally:
+            self._lock.release()
+
+    def set_account(self, session: JsonRpcSession, account_id: int):
+        '''
+        Count the connection of @session for @account_id once it authenticates.
+        @raise ConnectionLimitError: if @account_id already has max_connections_per_account connections.
+        '''
+        self._lock.acquire()
+        try:
+            if session not in self._connections or self._connections[session] == account_id:
+                return
+            if self._account_connections.get(account_id, 0) >= self._max_connections_per_account:
+                self.rejected += 1
+                raise ConnectionLimitError("Max number of connections {} of account {} reached".format(
+                    self._max_connections_per_account, account_id))
+            self._remove_account(session)
+            self._connections[session] = account_id
+            self._account_connections[account_id] = self._account_connections.get(account_id, 0) + 1
+        finally:
+            self._lock.release()
+
+    def unregister(self, session: JsonRpcSession):
+        self._lock.acquire()
+        try:
+            if session in self._connections:
+                self._remove_account(session)
+                del self._connections[session]
+        finally:
+            self._lock.release()
+
+    def _remove_account(self, session: JsonRpcSession):
+        account_id = self._connections[session]
+        if account_id is None:
+            return
+        self._account_connections[account_id] -= 1
+        if self._account_connections[account_id] == 0:
+            del self._account_connections[account_id]
+
+    def get_counts(self) -> dict:
+        self._lock.acquire()
+        try:
+            return {
+                "connections": len(self._connections),
+                "authenticated_connections": sum(self._account_connections.values()),
+                "accounts": len(self._account_connections),
+                "rejected": self.rejected
+            }
+        finally:
+            self._lock.release()
+
+ConnectionRegistry.instance = ConnectionRegistry()
+
+async def close_if_unauthenticated(websocket, session: JsonRpcSession, timeout: float = Config.AuthenticateTimeoutSeconds):
+    '''
+    Close @websocket if @session is not authenticated after @timeout seconds. Cancel the task once the connection ends.
+    @websocket: WebSocketServerProtocol
+    '''
+    await asyncio.sleep(timeout)
+    if session.account_id is None:
+        LOGGER.debug("Closing {}: not authenticated after {} seconds".format(getattr(websocket, "remote_address", None), timeout))
+        await websocket.close(CLOSE_CODE_AUTHENTICATE_TIMEOUT, "Authentication timeout")
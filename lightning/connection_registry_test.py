@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+from .connection_registry import ConnectionLimitError, ConnectionRegistry, close_if_unauthenticated, CLOSE_CODE_AUTHENTICATE_TIMEOUT
+from .jsonrpc_handler import JsonRpcSession
+
+class ConnectionRegistryTest(unittest.TestCase):
+
+    def test_maxConnections(self):
+        registry = ConnectionRegistry(max_connections=2, max_connections_per_account=1)
+        sessions = [JsonRpcSession() for _ in range(3)]
+        registry.register(sessions[0])
+        self.assertFalse(registry.is_full())
+        registry.register(sessions[1])
+        self.assertTrue(registry.is_full())
+        with self.assertRaises(ConnectionLimitError):
+            registry.register(sessions[2])
+
+        registry.unregister(sessions[0])
+        registry.register(sessions[2])
+        self.assertEqual({"connections": 2, "authenticated_connections": 0, "accounts": 0, "rejected": 1}, registry.get_counts())
+
+    def test_maxConnectionsPerAccount(self):
+        registry = ConnectionRegistry(max_connections=10, max_connections_per_account=2)
+        sessions = [JsonRpcSession() for _ in range(4)]
+        for session in sessions:
+            registry.register(session)
+        registry.set_account(sessions[0], 1)
+        registry.set_account(sessions[1], 1)
+        # Authenticating again with the same account does not count twice.
+        registry.set_account(sessions[1], 1)
+        with self.assertRaises(ConnectionLimitError):
+            registry.set_account(sessions[2], 1)
+        registry.set_account(sessions[2], 2)
+        self.assertEqual({"connections": 4, "authenticated_connections": 3, "accounts": 2, "rejected": 1}, registry.get_counts())
+
+        # Re-authenticating with another account, or closing, frees the slot.
+        registry.set_account(sessions[1], 2)
+        registry.unregister(sessions[0])
+        registry.set_account(sessions[3], 1)
+        self.assertEqual({"connections": 3, "authenticated_connections": 3, "accounts": 2, "rejected": 1}, registry.get_counts())
+
+        # Sessions that are not registered are not counted.
+        registry.set_account(JsonRpcSession(), 1)
+        registry.unregister(JsonRpcSession())
+        self.assertEqual(3, registry.get_counts()["authenticated_connections"])
+
+    def test_closeIfUnauthenticated(self):
+        class MockWebSocket():
+            def __init__(self):
+                self.close_code = None
+            async def close(self, code, reason):
+                self.close_code = code
+
+        websocket = MockWebSocket()
+        asyncio.run(close_if_unauthenticated(websocket, JsonRpcSession(), 0))
+        self.assertEqual(CLOSE_CODE_AUTHENTICATE_TIMEOUT, websocket.close_code)
+
+        websocket = MockWebSocket()
+        session = JsonRpcSession()
+        session.set_auth(1, 0)
+        asyncio.run(close_if_unauthenticated(websocket, session, 0))
+        self.assertIsNone(websocket.close_code)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 
 import os
 import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from copy import deepcopy
+from functools import lru_cache
 from .pubsub import Pubsub
 import logging
 
@@ -10,32 +14,111 @@ LOGGER = logging.Logger(__file__)
 class DatabaseParams():
     _DBPath = os.path.dirname(os.path.realpath(__file__)) + "/.database.db"
 
+    # One open connection per thread, so that sqlite's prepared statement cache lives across DBUtils calls.
+    _local = threading.local()
+
     @classmethod
     def set_db_path(cls, path):
         cls._DBPath = path
 
+    @classmethod
+    def get_db_path(cls):
+        return cls._DBPath
+
+    @classmethod
+    def connection(cls) -> sqlite3.Connection:
+        """
+        @return: the connection of the calling thread. Owned by DatabaseParams; do not close it.
+        """
+        local = cls._local
+        if getattr(local, "conn", None) is None or local.db_path != cls._DBPath:
+            if getattr(local, "conn", None) is not None:
+                assert local.transaction_depth == 0, "DB path changed in the middle of a transaction"
+                local.conn.close()
+            local.conn = sqlite3.connect(cls._DBPath)
+            local.db_path = cls._DBPath
+            local.transaction_depth = 0
+        return local.conn
+
+class SqlBuilder():
+    """
+    Builds the statements used by DBUtils. The text is cached per (table, columns), so the same
+    column set always maps to the same string and hits sqlite's prepared statement cache.
+    """
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def insert(table_name, columns: tuple) -> str:
+        n_question_marks = ["?"]*len(columns)
+        insert_statement = "INSERT INTO {0} ({1}) VALUES ({2})".format(table_name, ", ".join(columns), ", ".join(n_question_marks))
+        LOGGER.info("INSERT statement template: " + insert_statement)
+        return insert_statement
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def update(table_name, columns: tuple, id_column) -> str:
+        field_value_strs = ["{} = ?".format(column) for column in columns]
+        update_statement = "UPDATE {} SET {} WHERE {} = ?".format(table_name, ", ".join(field_value_strs), id_column)
+        LOGGER.debug("update_statement: {}".format(update_statement))
+        return update_statement
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def delete(table_name, id_column) -> str:
+        return "DELETE FROM {} WHERE {} = ?".format(table_name, id_column)
+
+def _non_default_columns(obj):
+    # Columns with default values are left out so that the table defaults apply, e.g. an INTEGER PRIMARY KEY of 0.
+    return tuple(column for column, value in obj.__dict__.items() if value)
+
 class DBUtils():
-    def update(table_name, field_values: dict, id_column, id_column_value):
-        with sqlite3.connect(DatabaseParams._DBPath) as conn:
-            cursor = conn.cursor()
-            field_value_strs = []
-            args = []
-            for field in field_values:
-                field_value_strs.append("{} = ?".format(field))
-                args.append(field_values[field])
+    @contextmanager
+    def transaction():
+        """
+        Run DBUtils calls of the calling thread in one transaction, e.g
+            with DBUtils.transaction() as conn:
+                DBUtils.update(...)
+                DBUtils.insert(...)
+        Nested transactions join the outermost one, which commits on exit or rolls back on an exception.
+        """
+        conn = DatabaseParams.connection()
+        local = DatabaseParams._local
+        local.transaction_depth += 1
+        try:
+            yield conn
+        except BaseException:
+            local.transaction_depth -= 1
+            if local.transaction_depth == 0:
+                conn.rollback()
+            raise
+        local.transaction_depth -= 1
+        if local.transaction_depth == 0:
+            conn.commit()
 
+    def update(table_name, field_values: dict, id_column, id_column_value):
+        with DBUtils.transaction() as conn:
+            columns = tuple(field_values.keys())
+            args = [field_values[column] for column in columns]
             args.append(id_column_value)
-            update_statement = "UPDATE {} SET {} WHERE {} = ?".format(table_name, ", ".join(field_value_strs), id_column)
+            conn.execute(SqlBuilder.update(table_name, columns, id_column), tuple(args))
 
-            LOGGER.debug("update_statement: {}".format(update_statement))
+    def update_many(table_name, updates: list, id_column):
+        """
+        Bulk version of update in one transaction.
+        @updates: list of (field_values: dict, id_column_value). Rows updating the same set of fields
+            are sent to sqlite with a single executemany.
+        """
+        updates_by_columns = defaultdict(list)
+        for field_values, id_column_value in updates:
+            columns = tuple(field_values.keys())
+            updates_by_columns[columns].append(tuple(field_values[column] for column in columns) + (id_column_value, ))
 
-            cursor.execute(update_statement, tuple(args))
+        with DBUtils.transaction() as conn:
+            for columns, args_list in updates_by_columns.items():
+                conn.executemany(SqlBuilder.update(table_name, columns, id_column), args_list)
 
     def delete(table_name, id_column, id_column_value):
-        with sqlite3.connect(DatabaseParams._DBPath) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM {} WHERE {} = ?".format(table_name, id_column), (id_column_value, ))
-            cursor.close()
+        with DBUtils.transaction() as conn:
+            conn.execute(SqlBuilder.delete(table_name, id_column), (id_column_value, ))
 
     def select(obj_template, select_template, args):
         """
@@ -44,8 +127,8 @@ class DBUtils():
         @select_template: string
         @args: tuple
         """
-        with sqlite3.connect(DatabaseParams._DBPath) as conn:
-            cursor = conn.cursor()
+        cursor = DatabaseParams.connection().cursor()
+        try:
             cursor.execute(select_template, args)
             field_names = [d[0] for d in cursor.description]
             result = []
@@ -58,6 +141,8 @@ class DBUtils():
                     obj.__dict__[col] = row[i]           
                 result.append(obj)
             return result
+        finally:
+            cursor.close()
 
     def insert(obj, table_name, id_column_name = ""):
         """
@@ -65,34 +150,50 @@ class DBUtils():
         column with the same name in @table_name.
         @id_column_name, if available the ID for the inserted object is populated in @id_column_name field of @obj.
         """
-        with sqlite3.connect(DatabaseParams._DBPath) as conn:
-            # Prepare INSERT statement.
-            columns = list(obj.__dict__.keys())
-            # Kepp columns with non default values
-            columns = list(filter(lambda c: obj.__dict__[c], columns))
-            n_question_marsk = ["?"]*len(columns)
-            create_statement_template = "INSERT INTO {0} ({1}) VALUES ({2})".format(table_name, ", ".join(columns), ", ".join(n_question_marsk))
-            LOGGER.info("INSERT statement template: " + create_statement_template)
-
-            # Prepare column values.
-            values = []
-            for column in columns:
-                values.append(obj.__dict__[column])
-            
-            # Insert into database.
-            cursor = conn.cursor()
-            cursor.execute(create_statement_template, tuple(values))
+        columns = _non_default_columns(obj)
+        values = tuple(obj.__dict__[column] for column in columns)
+        with DBUtils.transaction() as conn:
+            cursor = conn.execute(SqlBuilder.insert(table_name, columns), values)
             if id_column_name:
                 obj.__dict__[id_column_name] = cursor.lastrowid
-            conn.commit()
             return obj
 
+    def insert_many(objs: list, table_name, id_column_name = ""):
+        """
+        Bulk version of insert in one transaction. Objects with the same set of non-default fields share
+        one statement. Without @id_column_name each such group is inserted with a single executemany; with
+        it, rows are inserted one by one since executemany does not report the IDs.
+        @return: @objs
+        """
+        objs_by_columns = defaultdict(list)
+        for obj in objs:
+            objs_by_columns[_non_default_columns(obj)].append(obj)
+
+        with DBUtils.transaction() as conn:
+            for columns, group in objs_by_columns.items():
+                insert_statement = SqlBuilder.insert(table_name, columns)
+                if id_column_name:
+                    cursor = conn.cursor()
+                    for obj in group:
+                        cursor.execute(insert_statement, tuple(obj.__dict__[column] for column in columns))
+                        obj.__dict__[id_column_name] = cursor.lastrowid
+                    cursor.close()
+                else:
+                    conn.executemany(insert_statement, [tuple(obj.__dict__[column] for column in columns) for obj in group])
+        return objs
+
 class DBAccount():
     def __init__(self):
         # Merchant account ID
         self.account_id: int = 0
         self.username: str = ""
+        # base64 of the password hash
         self.password: str = ""
+        # base64 of the salt of the password hash
+        self.password_salt: str = ""
+        # How the password is hashed e.g. "scrypt$16384$8$1" for scrypt with n=16384, r=8 and p=1.
+        # Empty for accounts created before per-account salts. See Auth.
+        self.password_kdf: str = ""
         self.email: str = ""
         self.mailing_address = ""
 
@@ -109,17 +210,37 @@ class DBAccount():
         """
         @return: None on not found.
         """
-        select_template = "SELECT account_id, username, password, email, mailing_address FROM accounts WHERE username = ?"
+        select_template = "SELECT account_id, username, password, password_salt, password_kdf, email, mailing_address FROM accounts WHERE username = ?"
         args = (username, )
         accounts: DBAccount = DBUtils.select(DBAccount(), select_template, args)
         assert len(accounts) <= 1
         return accounts[0] if accounts else None
 
+    @classmethod
+    def get_account_by_id(cls, account_id: int):
+        """
+        @return: None on not found.
+        """
+        select_template = "SELECT account_id, username, password, password_salt, password_kdf, email, mailing_address FROM accounts WHERE account_id = ?"
+        accounts: DBAccount = DBUtils.select(DBAccount(), select_template, (account_id, ))
+        assert len(accounts) <= 1
+        return accounts[0] if accounts else None
+
+    @classmethod
+    def update_account(cls, account_id: int, field_values: dict):
+        """
+        Update the account and publish "/account/updated" with @account_id, e.g. for AccountCache.
+        """
+        DBUtils.update("accounts", field_values, "account_id", account_id)
+        Pubsub.instance.publish("/account/updated", account_id)
+
 class DBPayout():
     def __init__(self):
         '''
         An entry representing merchant want to initiate a receiving a payment on USD.
         '''
+        # Unique ID per payout.
+        self.payoutId: int = 0
         # Merchant account who initiated the payout
         self.account_id: int = 0
         # Status is one of following "initiated", "pending", "sent", "completed", "failed"
@@ -131,7 +252,40 @@ class DBPayout():
         # only support "mail"
         self.method = ""
         # In USD
-        self.amount = 0        
+        self.amount = 0
+
+    @classmethod
+    def create_payout(cls, payout):
+        return DBUtils.insert(payout, "payouts", "payoutId")
+
+    @classmethod
+    def list_payouts_by_status(cls, status: str, after_payout_id: int, limit: int):
+        """
+        @return: List[DBPayout] with @status and payoutId > @after_payout_id, ordered by payoutId.
+        """
+        select_template = '''
+            SELECT payoutId, account_id, status, method, amount FROM payouts
+            WHERE status = ? AND payoutId > ? ORDER BY payoutId LIMIT ?
+        '''
+        return DBUtils.select(DBPayout(), select_template, (status, after_payout_id, limit))
+
+    @classmethod
+    def update_statuses(cls, payout_ids: list, from_status: str, to_status: str) -> list:
+        """
+        Move the payouts of @payout_ids that are still in @from_status to @to_status in one transaction.
+        Payouts moved meanwhile, e.g. by another process, are left as they are.
+        @return: IDs of the payouts moved.
+        """
+        update_statement = "UPDATE payouts SET status = ? WHERE payoutId = ? AND status = ?"
+        updated_ids = []
+        with DBUtils.transaction() as conn:
+            cursor = conn.cursor()
+            for payout_id in payout_ids:
+                cursor.execute(update_statement, (to_status, payout_id, from_status))
+                if cursor.rowcount == 1:
+                    updated_ids.append(payout_id)
+            cursor.close()
+        return updated_ids
 
 class DBInvoice():
     def __init__(self):
@@ -142,6 +296,7 @@ class DBInvoice():
         # "pending" means the invoice has been picked up by Lightning.
         # "expired" means the invoice has expired.
         # "paid" means successful.
+        # "failed" means the invoice could not be created on Lightning.
         self.status = "created"
         # e.g Bolt11
         self.encoded_invoice: str = ""
@@ -159,25 +314,163 @@ class DBInvoice():
     @classmethod
     def get_invoice_by_id(cls, invoice_id: int):        
         select_template = '''
-            SELECT (invoice_id, status, encoded_invoice, account_id, created_at,
-                    amount_requested, exchange_rate, expired_at) 
-            FROM accounts WHERE (invoice_id = ?)
+            SELECT invoice_id, status, encoded_invoice, account_id, created_at,
+                   amount_requested, exchange_rate, expired_at
+            FROM invoices WHERE invoice_id = ?
         '''
         args = (invoice_id ,)
         invoices: DBInvoice = DBUtils.select(DBInvoice(), select_template, args)
-        assert invoices <= 1
+        assert len(invoices) <= 1
         return invoices[0] if invoices else None
     
     @classmethod
-    def create_invoice(cls, invoice):
+    def create_invoice(cls, invoice, idempotency_key: str = None):
         """
         @invoice: DBInvoice
-        @invoice: DBInvoice
+        @idempotency_key: if not None, recorded with the invoice in the same transaction, see get_invoice_by_idempotency_key.
+        @raise sqlite3.IntegrityError: if the account already used @idempotency_key.
         """
-        created_invoice = DBUtils.insert(invoice, "invoices", id_column_name="invoice_id")
+        created_invoice = cls._insert_invoice(invoice, idempotency_key)
         Pubsub.instance.publish("/invoice/created", created_invoice)
         return created_invoice
 
+    @classmethod
+    def _insert_invoice(cls, invoice, idempotency_key: str = None):
+        try:
+            with DBUtils.transaction():
+                created_invoice = DBUtils.insert(invoice, "invoices", id_column_name="invoice_id")
+                if idempotency_key is not None:
+                    invoice_request = DBInvoiceRequest()
+                    invoice_request.account_id = created_invoice.account_id
+                    invoice_request.idempotency_key = idempotency_key
+                    invoice_request.invoice_id = created_invoice.invoice_id
+                    invoice_request.created_at = created_invoice.created_at
+                    DBUtils.insert(invoice_request, "invoice_requests")
+                return created_invoice
+        except BaseException:
+            # Rolled back. The ID may be given to another invoice.
+            invoice.invoice_id = 0
+            raise
+
+    @classmethod
+    def fail_invoices(cls, invoice_ids: list):
+        """
+        Mark the invoices of @invoice_ids that are still "created" as "failed", and release their idempotency keys,
+        in one transaction. The rows are kept, so that their invoice_id, which is part of their label on the node,
+        is not reused.
+        """
+        with DBUtils.transaction() as conn:
+            cursor = conn.cursor()
+            for invoice_id in invoice_ids:
+                cursor.execute("UPDATE invoices SET status = 'failed' WHERE invoice_id = ? AND status = 'created'", (invoice_id, ))
+                if cursor.rowcount == 1:
+                    cursor.execute("DELETE FROM invoice_requests WHERE invoice_id = ?", (invoice_id, ))
+            cursor.close()
+
+    @classmethod
+    def insert_invoices(cls, invoices: list, idempotency_keys: list):
+        """
+        Insert @invoices in one transaction, each with the @idempotency_keys at the same index if not None. Unlike
+        create_invoice, "/invoice/created" is not published, i.e. the caller creates the invoices on the node.
+        @raise sqlite3.IntegrityError: if the account already used one of @idempotency_keys.
+        @return: @invoices with their invoice_id.
+        """
+        with DBUtils.transaction():
+            DBUtils.insert_many(invoices, "invoices", id_column_name="invoice_id")
+            invoice_requests = []
+            for invoice, idempotency_key in zip(invoices, idempotency_keys):
+                if idempotency_key is not None:
+                    invoice_request = DBInvoiceRequest()
+                    invoice_request.account_id = invoice.account_id
+                    invoice_request.idempotency_key = idempotency_key
+                    invoice_request.invoice_id = invoice.invoice_id
+                    invoice_request.created_at = invoice.created_at
+                    invoice_requests.append(invoice_request)
+            DBUtils.insert_many(invoice_requests, "invoice_requests")
+        return invoices
+
+    @classmethod
+    def get_invoices_by_idempotency_keys(cls, account_id: int, idempotency_keys: list) -> dict:
+        """
+        @return: idempotency key -> DBInvoice, for the keys of @idempotency_keys that the account used.
+        """
+        if not idempotency_keys:
+            return {}
+        select_template = '''
+            SELECT idempotency_key, invoices.invoice_id, status, encoded_invoice, invoices.account_id, invoices.created_at,
+                   amount_requested, exchange_rate, expired_at
+            FROM invoice_requests JOIN invoices ON invoices.invoice_id = invoice_requests.invoice_id
+            WHERE invoice_requests.account_id = ? AND idempotency_key IN ({})
+        '''.format(", ".join(["?"] * len(idempotency_keys)))
+        cursor = DatabaseParams.connection().execute(select_template, (account_id, ) + tuple(idempotency_keys))
+        try:
+            invoices = {}
+            for row in cursor:
+                invoice = DBInvoice()
+                (idempotency_key, invoice.invoice_id, invoice.status, invoice.encoded_invoice, invoice.account_id, invoice.created_at,
+                    invoice.amount_requested, invoice.exchange_rate, invoice.expired_at) = row
+                invoices[idempotency_key] = invoice
+            return invoices
+        finally:
+            cursor.close()
+
+    @classmethod
+    def get_invoice_by_idempotency_key(cls, account_id: int, idempotency_key: str):
+        """
+        @return: DBInvoice created by DBInvoice.create_invoice with @idempotency_key, or None.
+        """
+        select_template = '''
+            SELECT invoices.invoice_id, status, encoded_invoice, invoices.account_id, invoices.created_at,
+                   amount_requested, exchange_rate, expired_at
+            FROM invoice_requests JOIN invoices ON invoices.invoice_id = invoice_requests.invoice_id
+            WHERE invoice_requests.account_id = ? AND idempotency_key = ?
+        '''
+        invoices = DBUtils.select(DBInvoice(), select_template, (account_id, idempotency_key))
+        return invoices[0] if invoices else None
+
+    @classmethod
+    def list_invoices(cls, account_id: int, after_invoice_id: int, limit: int, statuses = None, created_from = None, created_to = None):
+        """
+        A page of invoices of @account_id ordered by invoice_id, starting after @after_invoice_id. The cost of a
+        page does not depend on how many pages come before it.
+        @statuses: if not empty, only invoices with one of the statuses.
+        @created_from, @created_to: if not None, only invoices with created_from <= created_at < created_to.
+        @return: List[DBInvoice]
+        """
+        conditions = ["account_id = ?", "invoice_id > ?"]
+        args = [account_id, after_invoice_id]
+        if statuses:
+            conditions.append("status IN ({})".format(", ".join(["?"]*len(statuses))))
+            args.extend(statuses)
+        if created_from is not None:
+            conditions.append("created_at >= ?")
+            args.append(created_from)
+        if created_to is not None:
+            conditions.append("created_at < ?")
+            args.append(created_to)
+        args.append(limit)
+
+        select_template = '''
+            SELECT invoice_id, status, encoded_invoice, account_id, created_at,
+                   amount_requested, exchange_rate, expired_at
+            FROM invoices WHERE {} ORDER BY invoice_id LIMIT ?
+        '''.format(" AND ".join(conditions))
+        return DBUtils.select(DBInvoice(), select_template, tuple(args))
+
+    @classmethod
+    def get_invoices_by_ids(cls, account_id: int, invoice_ids: list):
+        """
+        @return: List[DBInvoice] of the invoices of @account_id among @invoice_ids, ordered by invoice_id.
+        """
+        if not invoice_ids:
+            return []
+        select_template = '''
+            SELECT invoice_id, status, encoded_invoice, account_id, created_at,
+                   amount_requested, exchange_rate, expired_at
+            FROM invoices WHERE account_id = ? AND invoice_id IN ({}) ORDER BY invoice_id
+        '''.format(", ".join(["?"]*len(invoice_ids)))
+        return DBUtils.select(DBInvoice(), select_template, (account_id, ) + tuple(invoice_ids))
+
     @classmethod
     def from_row(cls, row):
         invoice = DBInvoice()
@@ -190,3 +483,222 @@ class DBInvoice():
         invoice.exchange_rate = row.exchange_rate
         invoice.expired_at = row.expired_at
         return invoice
+
+# Contribution of finalized invoices to account_daily_stats. Shared by the incremental update and the backfill.
+_ACCOUNT_DAILY_STATS_DAY = "created_at - created_at % 86400"
+_ACCOUNT_DAILY_STATS_COLUMNS = '''
+    CASE WHEN status = 'paid' THEN 1 ELSE 0 END AS paid_count,
+    CASE WHEN status = 'paid' THEN CAST(ROUND(amount_requested * exchange_rate) AS INTEGER) ELSE 0 END AS paid_sats,
+    CASE WHEN status = 'paid' THEN amount_requested ELSE 0 END AS paid_amount_requested,
+    CASE WHEN status = 'expired' THEN 1 ELSE 0 END AS expired_count
+'''
+
+class DBInvoiceRequest():
+    def __init__(self):
+        '''
+        Idempotency key of a create_invoice request, see DBInvoice.create_invoice.
+        '''
+        self.account_id: int = 0
+        self.idempotency_key: str = ""
+        self.invoice_id: int = 0
+        # Unix time in seconds.
+        self.created_at: int = 0
+
+class DBInvoicePool():
+    def __init__(self):
+        '''
+        @size invoices of @amount_requested kept ready for @account_id, see DBInvoicePoolItem.
+        '''
+        self.account_id: int = 0
+        # In USD in cents
+        self.amount_requested: int = 0
+        self.size: int = 0
+
+    @classmethod
+    def set_pool(cls, account_id: int, amount_requested: int, size: int):
+        '''
+        A @size of 0 removes the pool. Its items are left to expire.
+        '''
+        with DBUtils.transaction() as conn:
+            if size > 0:
+                conn.execute("INSERT OR REPLACE INTO invoice_pools (account_id, amount_requested, size) VALUES (?, ?, ?)", 
+                    (account_id, amount_requested, size))
+            else:
+                conn.execute("DELETE FROM invoice_pools WHERE account_id = ? AND amount_requested = ?", (account_id, amount_requested))
+
+    @classmethod
+    def list_pools(cls, account_id: int = None):
+        '''
+        @return: List[DBInvoicePool] of @account_id, or of all accounts if None.
+        '''
+        if account_id is None:
+            return DBUtils.select(DBInvoicePool(), "SELECT account_id, amount_requested, size FROM invoice_pools", ())
+        return DBUtils.select(DBInvoicePool(), "SELECT account_id, amount_requested, size FROM invoice_pools WHERE account_id = ?", 
+            (account_id, ))
+
+class DBInvoicePoolItem():
+    def __init__(self):
+        '''
+        Invoice created on the node ahead of time for a DBInvoicePool.
+        '''
+        self.pool_item_id: int = 0
+        self.account_id: int = 0
+        # In USD in cents
+        self.amount_requested: int = 0
+        # The echange rate SAT/USD when the invoice was created.
+        self.exchange_rate = 0
+        self.encoded_invoice: str = ""
+        # Label of the invoice on the node.
+        self.label: str = ""
+        # Unix time in seconds.
+        self.expired_at: int = 0
+
+    @classmethod
+    def insert_items(cls, items: list):
+        DBUtils.insert_many(items, "invoice_pool_items")
+
+    @classmethod
+    def count_items(cls, account_id: int, amount_requested: int, min_expired_at: int) -> int:
+        cursor = DatabaseParams.connection().execute(
+            "SELECT COUNT(*) FROM invoice_pool_items WHERE account_id = ? AND amount_requested = ? AND expired_at >= ?",
+            (account_id, amount_requested, min_expired_at))
+        try:
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    @classmethod
+    def delete_items_expiring_before(cls, expired_at: int) -> int:
+        '''
+        @return: number of items deleted.
+        '''
+        with DBUtils.transaction() as conn:
+            return conn.execute("DELETE FROM invoice_pool_items WHERE expired_at < ?", (expired_at, )).rowcount
+
+    @classmethod
+    def claim(cls, account_id: int, amount_requested: int, min_expired_at: int, created_at: int, idempotency_key: str = None):
+        '''
+        Move the item of the pool of (@account_id, @amount_requested) that expires first, but not before @min_expired_at,
+        to the invoices as a pending invoice. Each item is claimed at most once, also across processes.
+        @idempotency_key: see DBInvoice.create_invoice.
+        @return: (DBInvoice, label of the invoice on the node), or None if the pool has no such item.
+        '''
+        select_template = '''
+            SELECT pool_item_id, account_id, amount_requested, exchange_rate, encoded_invoice, label, expired_at
+            FROM invoice_pool_items WHERE account_id = ? AND amount_requested = ? AND expired_at >= ? ORDER BY expired_at LIMIT 1
+        '''
+        while True:
+            with DBUtils.transaction() as conn:
+                items = DBUtils.select(DBInvoicePoolItem(), select_template, (account_id, amount_requested, min_expired_at))
+                if not items:
+                    return None
+                item = items[0]
+                if conn.execute("DELETE FROM invoice_pool_items WHERE pool_item_id = ?", (item.pool_item_id, )).rowcount == 0:
+                    # Claimed by another process meanwhile.
+                    continue
+                invoice = DBInvoice()
+                invoice.status = "pending"
+                invoice.encoded_invoice = item.encoded_invoice
+                invoice.account_id = account_id
+                invoice.created_at = created_at
+                invoice.amount_requested = amount_requested
+                invoice.exchange_rate = item.exchange_rate
+                invoice.expired_at = item.expired_at
+                return DBInvoice._insert_invoice(invoice, idempotency_key), item.label
+
+class DBAccountDailyStats():
+    def __init__(self):
+        '''
+        Totals of the finalized invoices of an account created on a day.
+        '''
+        self.account_id: int = 0
+        # Unix time in seconds of 00:00 UTC of the day.
+        self.day: int = 0
+        self.paid_count = 0
+        # Same conversion as the msatoshi requested from Lightning by LightningMonitor, in SAT.
+        self.paid_sats = 0
+        # In USD in cents
+        self.paid_amount_requested = 0
+        self.expired_count = 0
+
+    @classmethod
+    def add_finalized_invoice(cls, invoice_id: int):
+        """
+        Add the invoice, which must have been updated to "paid" or "expired", to the stats of its account and day.
+        Call it in the DBUtils.transaction that finalizes the invoice, so that the stats count each invoice once.
+        """
+        upsert_statement = '''
+            INSERT INTO account_daily_stats (account_id, day, paid_count, paid_sats, paid_amount_requested, expired_count)
+            SELECT account_id, {0}, {1} FROM invoices WHERE invoice_id = ? AND status IN ('paid', 'expired')
+            ON CONFLICT (account_id, day) DO UPDATE SET
+                paid_count = paid_count + excluded.paid_count,
+                paid_sats = paid_sats + excluded.paid_sats,
+                paid_amount_requested = paid_amount_requested + excluded.paid_amount_requested,
+                expired_count = expired_count + excluded.expired_count
+        '''.format(_ACCOUNT_DAILY_STATS_DAY, _ACCOUNT_DAILY_STATS_COLUMNS)
+        with DBUtils.transaction() as conn:
+            conn.execute(upsert_statement, (invoice_id, ))
+
+    @classmethod
+    def get_account_stats(cls, account_id: int, from_day: int, to_day: int):
+        """
+        @return: List[DBAccountDailyStats] of days from_day <= day < to_day, ordered by day.
+        """
+        select_template = '''
+            SELECT account_id, day, paid_count, paid_sats, paid_amount_requested, expired_count
+            FROM account_daily_stats WHERE account_id = ? AND day >= ? AND day < ? ORDER BY day
+        '''
+        return DBUtils.select(DBAccountDailyStats(), select_template, (account_id, from_day, to_day))
+
+    @classmethod
+    def backfill(cls):
+        """
+        Rebuild account_daily_stats from all finalized invoices in one transaction.
+        @return: number of rows in account_daily_stats.
+        """
+        insert_statement = '''
+            INSERT INTO account_daily_stats (account_id, day, paid_count, paid_sats, paid_amount_requested, expired_count)
+            SELECT account_id, day, SUM(paid_count), SUM(paid_sats), SUM(paid_amount_requested), SUM(expired_count)
+            FROM (
+                SELECT account_id, {0} AS day, {1}
+                FROM invoices WHERE status IN ('paid', 'expired')
+            )
+            GROUP BY account_id, day
+        '''.format(_ACCOUNT_DAILY_STATS_DAY, _ACCOUNT_DAILY_STATS_COLUMNS)
+        with DBUtils.transaction() as conn:
+            conn.execute("DELETE FROM account_daily_stats")
+            cursor = conn.execute(insert_statement)
+            return cursor.rowcount
+
+class DBFeedEvent():
+    def __init__(self):
+        '''
+        Feed item spilled from the in memory replay buffer of FeedReplay.
+        '''
+        self.seq: int = 0
+        self.account_id: int = 0
+        self.feed_type: str = ""
+        # JSON of the feed item.
+        self.item: str = ""
+        # Unix time in seconds.
+        self.created_at: int = 0
+
+    @classmethod
+    def insert_events(cls, events: list):
+        DBUtils.insert_many(events, "feed_events")
+
+    @classmethod
+    def list_events(cls, account_id: int, feed_type: str, after_seq: int, before_seq: int, limit: int):
+        """
+        @return: List[DBFeedEvent] with after_seq < seq < before_seq, ordered by seq.
+        """
+        select_template = '''
+            SELECT seq, account_id, feed_type, item, created_at FROM feed_events
+            WHERE account_id = ? AND feed_type = ? AND seq > ? AND seq < ? ORDER BY seq LIMIT ?
+        '''
+        return DBUtils.select(DBFeedEvent(), select_template, (account_id, feed_type, after_seq, before_seq, limit))
+
+    @classmethod
+    def delete_events_before(cls, created_at: int):
+        with DBUtils.transaction() as conn:
+            conn.execute("DELETE FROM feed_events WHERE created_at < ?", (created_at, ))
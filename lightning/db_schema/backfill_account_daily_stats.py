@@ -0,0 +1,8 @@
+import logging
+from ..db import DBAccountDailyStats
+
+if __name__ == '__main__':
+    # Rebuild account_daily_stats from invoices, e.g. for invoices finalized before update_3.
+    # python -m lightning.db_schema.backfill_account_daily_stats
+    logging.basicConfig(format='%(filename)s:%(funcName)s:%(levelname)s:%(message)s')
+    print("Backfilled {} rows of account_daily_stats".format(DBAccountDailyStats.backfill()))
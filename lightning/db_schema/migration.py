@@ -0,0 +1,97 @@
+import importlib
+import logging
+import os
+import pkgutil
+import re
+import sqlite3
+import time
+from ..config import Config
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+DB_PATH = os.path.dirname(os.path.realpath(__file__)) + "/../.database.db"
+
+# Each schema update is a module named "update_{version}" in this package that
+# exposes upgrade(conn). Versions are applied in increasing order exactly once.
+_UPDATE_MODULE_PATTERN = r"^update_([\d]+)$"
+
+def create_index_sql(index_spec):
+    '''
+    @index_spec: (index name, table name, [column, ...])
+    '''
+    index_name, table_name, columns = index_spec
+    return "CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(index_name, table_name, ", ".join(columns))
+
+def list_updates():
+    '''
+    @return: list of (version, module) sorted by version.
+    '''
+    package_dir = os.path.dirname(os.path.realpath(__file__))
+    updates = []
+    for module_info in pkgutil.iter_modules([package_dir]):
+        match = re.fullmatch(_UPDATE_MODULE_PATTERN, module_info.name)
+        if match:
+            module = importlib.import_module("." + module_info.name, __package__)
+            updates.append((int(match.groups()[0]), module))
+    updates.sort(key=lambda update: update[0])
+    return updates
+
+def _table_exists(conn, table_name):
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name, ))
+    return cursor.fetchone() is not None
+
+def current_version(conn):
+    '''
+    @return: the latest applied version, or -1 if nothing has been applied.
+    '''
+    if not _table_exists(conn, "schema_version"):
+        return -1
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] if row[0] is not None else -1
+
+def _ensure_schema_version_table(conn):
+    if _table_exists(conn, "schema_version"):
+        return
+    conn.execute("CREATE TABLE schema_version ( version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL )")
+    # Databases created by running update_0 directly predate the schema_version table.
+    if _table_exists(conn, "accounts"):
+        LOGGER.info("Found tables without schema_version. Marking version 0 as applied.")
+        conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (0, int(time.time())))
+    conn.commit()
+
+def apply_updates(db_path):
+    '''
+    Bring the database at @db_path up to the latest schema version. Each update and its schema_version
+    row are committed in a single transaction, so a failed update leaves the database at the previous version.
+    @return: the schema version after applying the updates.
+    '''
+    conn = sqlite3.connect(db_path)
+    try:
+        _ensure_schema_version_table(conn)
+        version = current_version(conn)
+        for update_version, update_module in list_updates():
+            if update_version <= version:
+                continue
+            LOGGER.info("Applying schema update {}".format(update_version))
+            conn.execute("BEGIN")
+            try:
+                update_module.upgrade(conn)
+                conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (update_version, int(time.time())))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            version = update_version
+
+        # Long running readers, e.g. the invoice export, would otherwise block writers until they finish.
+        # journal_mode is persistent and cannot be changed inside a transaction, hence here.
+        conn.execute("PRAGMA journal_mode=WAL")
+        return version
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    # python -m lightning.db_schema.migration
+    logging.basicConfig(format='%(filename)s:%(funcName)s:%(levelname)s:%(message)s')
+    print("Schema version: {}".format(apply_updates(DB_PATH)))
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from . import update_0
+from .migration import apply_updates, current_version, list_updates
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "test.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _index_names(self, table_name):
+        with sqlite3.connect(self.db_path) as conn:
+            return [row[1] for row in conn.execute("PRAGMA index_list({})".format(table_name))]
+
+    def test_applyUpdates(self):
+        latest_version = list_updates()[-1][0]
+        self.assertEqual(apply_updates(self.db_path), latest_version)
+        self.assertIn("invoices_account_id_created_at", self._index_names("invoices"))
+        self.assertIn("invoices_status_expired_at", self._index_names("invoices"))
+
+        # Applying again is a no-op.
+        self.assertEqual(apply_updates(self.db_path), latest_version)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(current_version(conn), latest_version)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0], len(list_updates()))
+
+    def test_applyUpdatesOnLegacyDatabase(self):
+        # A database created by update_0 before schema_version existed.
+        update_0.main(self.db_path)
+        self.assertEqual(apply_updates(self.db_path), list_updates()[-1][0])
+        self.assertIn("invoices_status_expired_at", self._index_names("invoices"))
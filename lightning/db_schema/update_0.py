@@ -8,8 +8,7 @@ def create_table_sql(table_spec):
     sql = "CREATE TABLE {0} ( {1} )".format(table_spec[0], ", ".join(table_spec[1:]))
     return sql
 
-def main(db_path):
-    assert not os.path.exists(db_path)
+def upgrade(conn):
     account_table_spec = [
         "accounts",
         "account_id INTEGER PRIMARY KEY",
@@ -49,12 +48,20 @@ def main(db_path):
     create_statements.append(create_table_sql(payout_table_spec))
     create_statements.append(create_table_sql(invoice_table_spec))
 
-    with sqlite3.connect(DB_PATH) as conn:
-        for create_statement in create_statements:
-            print("Executing Create statement: " + create_statement)
-            cursor = conn.cursor()
-            cursor.execute(create_statement)
-            conn.commit()
+    for create_statement in create_statements:
+        print("Executing Create statement: " + create_statement)
+        cursor = conn.cursor()
+        cursor.execute(create_statement)
+
+def main(db_path):
+    """
+    Create the initial tables in a new database. Prefer `python -m lightning.db_schema.migration`,
+    which also applies the later updates.
+    """
+    assert not os.path.exists(db_path)
+    with sqlite3.connect(db_path) as conn:
+        upgrade(conn)
+        conn.commit()
 
 
 
@@ -0,0 +1,14 @@
+from .migration import create_index_sql
+
+def upgrade(conn):
+    index_specs = [
+        # Listing an account's invoices in creation order.
+        ("invoices_account_id_created_at", "invoices", ["account_id", "created_at"]),
+        # LightningMonitor looking up invoices by status, e.g. pending invoices that are about to expire.
+        ("invoices_status_expired_at", "invoices", ["status", "expired_at"]),
+    ]
+
+    for index_spec in index_specs:
+        create_statement = create_index_sql(index_spec)
+        print("Executing Create statement: " + create_statement)
+        conn.execute(create_statement)
@@ -0,0 +1,8 @@
+from .migration import create_index_sql
+
+def upgrade(conn):
+    # Keyset pagination of an account's invoices i.e. WHERE account_id = ? AND invoice_id > ? ORDER BY invoice_id.
+    index_spec = ("invoices_account_id_invoice_id", "invoices", ["account_id", "invoice_id"])
+    create_statement = create_index_sql(index_spec)
+    print("Executing Create statement: " + create_statement)
+    conn.execute(create_statement)
@@ -0,0 +1,23 @@
+from .update_0 import create_table_sql
+
+def upgrade(conn):
+    # Totals of finalized invoices per account per UTC day. Maintained by LightningMonitor when it finalizes
+    # an invoice, and rebuilt from invoices by backfill_account_daily_stats.
+    account_daily_stats_table_spec = [
+        "account_daily_stats",
+        "account_id INTEGER NOT NULL",
+        # Unix time in seconds of 00:00 UTC of the day the invoice was created.
+        "day INTEGER NOT NULL",
+        "paid_count INTEGER NOT NULL DEFAULT 0",
+        "paid_sats INTEGER NOT NULL DEFAULT 0",
+        # In USD in cents
+        "paid_amount_requested INTEGER NOT NULL DEFAULT 0",
+        "expired_count INTEGER NOT NULL DEFAULT 0",
+
+        "PRIMARY KEY (account_id, day)",
+        "FOREIGN KEY(account_id) REFERENCES accounts(account_id)"
+    ]
+
+    create_statement = create_table_sql(account_daily_stats_table_spec)
+    print("Executing Create statement: " + create_statement)
+    conn.execute(create_statement)
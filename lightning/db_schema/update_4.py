@@ -0,0 +1,16 @@
+from .update_0 import create_table_sql
+
+def upgrade(conn):
+    # JWT signing keys shared by the server processes when Config.JwtKeyRingSource is "db".
+    jwt_key_table_spec = [
+        "jwt_keys",
+        "kid TEXT PRIMARY KEY",
+        # base64
+        "secret TEXT NOT NULL",
+        # Unix time in seconds. The newest key is the current one.
+        "created_at INTEGER NOT NULL",
+    ]
+
+    create_statement = create_table_sql(jwt_key_table_spec)
+    print("Executing Create statement: " + create_statement)
+    conn.execute(create_statement)
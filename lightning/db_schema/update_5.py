@@ -0,0 +1,10 @@
+def upgrade(conn):
+    # Per-account salt and hashing scheme of accounts.password. See Auth.
+    alter_statements = [
+        "ALTER TABLE accounts ADD COLUMN password_salt TEXT NULL",
+        "ALTER TABLE accounts ADD COLUMN password_kdf TEXT NULL",
+    ]
+
+    for alter_statement in alter_statements:
+        print("Executing Alter statement: " + alter_statement)
+        conn.execute(alter_statement)
@@ -0,0 +1,32 @@
+from .update_0 import create_table_sql
+from .migration import create_index_sql
+
+def upgrade(conn):
+    # Feed items spilled from the in memory replay buffers of FeedReplay, kept for Config.FeedReplayRetentionSeconds.
+    feed_event_table_spec = [
+        "feed_events",
+        # FeedReplay seq, increasing across accounts and feed types.
+        "seq INTEGER PRIMARY KEY",
+        "account_id INTEGER NOT NULL",
+        "feed_type TEXT NOT NULL",
+        # JSON of the feed item.
+        "item TEXT NOT NULL",
+        # Unix time in seconds.
+        "created_at INTEGER NOT NULL",
+    ]
+
+    create_statement = create_table_sql(feed_event_table_spec)
+    print("Executing Create statement: " + create_statement)
+    conn.execute(create_statement)
+
+    index_specs = [
+        # Replay of a feed after a seq.
+        ("feed_events_account_id_feed_type_seq", "feed_events", ["account_id", "feed_type", "seq"]),
+        # Deletion of expired items.
+        ("feed_events_created_at", "feed_events", ["created_at"]),
+    ]
+
+    for index_spec in index_specs:
+        create_statement = create_index_sql(index_spec)
+        print("Executing Create statement: " + create_statement)
+        conn.execute(create_statement)
@@ -0,0 +1,21 @@
+from .update_0 import create_table_sql
+
+def upgrade(conn):
+    # Idempotency keys of create_invoice, so that a retried request returns the invoice of the first one.
+    invoice_request_table_spec = [
+        "invoice_requests",
+        "account_id INTEGER NOT NULL",
+        # Chosen by the client, unique per account.
+        "idempotency_key TEXT NOT NULL",
+        "invoice_id INTEGER NOT NULL",
+        # Unix time in seconds.
+        "created_at INTEGER NOT NULL",
+
+        "PRIMARY KEY (account_id, idempotency_key)",
+        "FOREIGN KEY(account_id) REFERENCES accounts(account_id)",
+        "FOREIGN KEY(invoice_id) REFERENCES invoices(invoice_id)"
+    ]
+
+    create_statement = create_table_sql(invoice_request_table_spec)
+    print("Executing Create statement: " + create_statement)
+    conn.execute(create_statement)
@@ -0,0 +1,49 @@
+from .update_0 import create_table_sql
+from .migration import create_index_sql
+
+def upgrade(conn):
+    # Accounts that keep pre-created invoices of a fixed amount, see LightningMonitor._refill_invoice_pools.
+    invoice_pool_table_spec = [
+        "invoice_pools",
+        "account_id INTEGER NOT NULL",
+        # In USD in cents
+        "amount_requested INTEGER NOT NULL",
+        # Number of invoices kept ready.
+        "size INTEGER NOT NULL",
+
+        "PRIMARY KEY (account_id, amount_requested)",
+        "FOREIGN KEY(account_id) REFERENCES accounts(account_id)"
+    ]
+
+    # Invoices created on the node ahead of time. One becomes a row of invoices when InvoiceGenerator claims it.
+    invoice_pool_item_table_spec = [
+        "invoice_pool_items",
+        "pool_item_id INTEGER PRIMARY KEY",
+        "account_id INTEGER NOT NULL",
+        "amount_requested INTEGER NOT NULL",
+        "exchange_rate INTEGER NOT NULL",
+        "encoded_invoice TEXT NOT NULL",
+        # Label of the invoice on the node.
+        "label TEXT NOT NULL",
+        # Unix time in seconds.
+        "expired_at INTEGER NOT NULL",
+
+        "FOREIGN KEY(account_id) REFERENCES accounts(account_id)"
+    ]
+
+    for table_spec in [invoice_pool_table_spec, invoice_pool_item_table_spec]:
+        create_statement = create_table_sql(table_spec)
+        print("Executing Create statement: " + create_statement)
+        conn.execute(create_statement)
+
+    index_specs = [
+        # Claiming and counting the items of a pool that are not about to expire.
+        ("invoice_pool_items_account_id_amount_requested_expired_at", "invoice_pool_items", ["account_id", "amount_requested", "expired_at"]),
+        # Dropping the items that are about to expire.
+        ("invoice_pool_items_expired_at", "invoice_pool_items", ["expired_at"]),
+    ]
+
+    for index_spec in index_specs:
+        create_statement = create_index_sql(index_spec)
+        print("Executing Create statement: " + create_statement)
+        conn.execute(create_statement)
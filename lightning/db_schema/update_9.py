@@ -0,0 +1,12 @@
+from .migration import create_index_sql
+
+def upgrade(conn):
+    index_specs = [
+        # PayoutScheduler picking up the payouts of a status in batches, ordered by payoutId.
+        ("payouts_status_payoutId", "payouts", ["status", "payoutId"]),
+    ]
+
+    for index_spec in index_specs:
+        create_statement = create_index_sql(index_spec)
+        print("Executing Create statement: " + create_statement)
+        conn.execute(create_statement)
@@ -1,5 +1,6 @@
-from .db import DBInvoice, DBAccount, DBUtils
+from .db import DBInvoice, DBAccount, DBUtils, SqlBuilder, DBAccountDailyStats
 from pprint import pprint
+import random
 import unittest
 
 class TestDB(unittest.TestCase):
@@ -26,6 +27,90 @@ class TestDB(unittest.TestCase):
         deleted_account = DBAccount.get_account_by_username(account.username)
         self.assertIsNone(deleted_account)
 
+    def test_sqlBuilderCache(self):
+        statement = SqlBuilder.insert("accounts", ("username", "password"))
+        self.assertEqual(statement, "INSERT INTO accounts (username, password) VALUES (?, ?)")
+        self.assertIs(statement, SqlBuilder.insert("accounts", ("username", "password")))
+        self.assertEqual(SqlBuilder.update("invoices", ("status", ), "invoice_id"), "UPDATE invoices SET status = ? WHERE invoice_id = ?")
+
+    def test_insertManyAndUpdateMany(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = "dsafdsaf"
+        created_account = DBAccount.create_account(account)
+
+        invoices = []
+        for i in range(3):
+            invoice = DBInvoice()
+            invoice.account_id = created_account.account_id
+            invoice.created_at = 1000 + i
+            invoice.amount_requested = 100 + i
+            invoice.exchange_rate = 2000
+            invoices.append(invoice)
+        DBUtils.insert_many(invoices, "invoices", id_column_name="invoice_id")
+        invoice_ids = [invoice.invoice_id for invoice in invoices]
+        self.assertEqual(len(set(invoice_ids)), 3)
+        self.assertTrue(all(invoice_ids))
+
+        DBUtils.update_many("invoices", [({"status": "pending"}, invoice_id) for invoice_id in invoice_ids[:2]], "invoice_id")
+        select_template = "SELECT invoice_id, status FROM invoices WHERE account_id = ? ORDER BY invoice_id"
+        selected = DBUtils.select(DBInvoice(), select_template, (created_account.account_id, ))
+        self.assertEqual([invoice.status for invoice in selected], ["pending", "pending", "created"])
+
+        for invoice_id in invoice_ids:
+            DBUtils.delete("invoices", "invoice_id", invoice_id)
+        DBUtils.delete("accounts", "account_id", created_account.account_id)
+
+    def test_transactionRollback(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = "dsafdsaf"
+        with self.assertRaises(RuntimeError):
+            with DBUtils.transaction():
+                DBAccount.create_account(account)
+                raise RuntimeError("abort")
+        self.assertIsNone(DBAccount.get_account_by_username(account.username))
+
+    def test_accountDailyStats(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = "dsafdsaf"
+        created_account = DBAccount.create_account(account)
+
+        day = 86400 * 100
+        invoices = []
+        for created_at, amount_requested in [(day + 10, 100), (day + 20, 200), (day + 86400, 300)]:
+            invoice = DBInvoice()
+            invoice.account_id = created_account.account_id
+            invoice.created_at = created_at
+            invoice.amount_requested = amount_requested
+            invoice.exchange_rate = 2
+            invoices.append(invoice)
+        DBUtils.insert_many(invoices, "invoices", id_column_name="invoice_id")
+
+        for invoice, status in zip(invoices, ["paid", "expired", "paid"]):
+            with DBUtils.transaction():
+                DBUtils.update("invoices", {"status": status}, "invoice_id", invoice.invoice_id)
+                DBAccountDailyStats.add_finalized_invoice(invoice.invoice_id)
+
+        def stats_as_tuples():
+            stats = DBAccountDailyStats.get_account_stats(created_account.account_id, day, day + 2*86400)
+            return [(s.day, s.paid_count, s.paid_sats, s.paid_amount_requested, s.expired_count) for s in stats]
+
+        expected = [(day, 1, 200, 100, 1), (day + 86400, 1, 600, 300, 0)]
+        self.assertEqual(stats_as_tuples(), expected)
+        # Backfill rebuilds the same stats from invoices.
+        DBAccountDailyStats.backfill()
+        self.assertEqual(stats_as_tuples(), expected)
+
+        for invoice in invoices:
+            DBUtils.delete("invoices", "invoice_id", invoice.invoice_id)
+        DBUtils.delete("account_daily_stats", "account_id", created_account.account_id)
+        DBUtils.delete("accounts", "account_id", created_account.account_id)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,66 @@
+'''
+Server side filter and projection of feed items, compiled once per feed from the params of select_feed, so that
+items the client does not want are neither queued, encoded nor sent.
+'''
+import typing
+
+# Fields of the invoice feed items, see feed_replay.invoice_feed_item.
+FEED_ITEM_FIELDS = ["seq", "invoice_id", "status", "amount_requested", "encoded_invoice", "expired_at"]
+INVOICE_STATUSES = ["created", "pending", "paid", "expired", "failed"]
+
+def _check_number(name, value):
+    if type(value) not in [int, float]:
+        raise ValueError("{} must be a number".format(name))
+
+def _check_list_of(name, values, allowed):
+    if type(values) != list or any(type(value) != str or value not in allowed for value in values):
+        raise ValueError("{} must be a list of {}".format(name, ", ".join(allowed)))
+
+def compile_feed_filter(filter_spec: dict) -> typing.Optional[typing.Callable[[dict], bool]]:
+    '''
+    @filter_spec: e.g. {"status": ["paid"], "min_amount": 1000, "max_amount": 5000}. Each key is optional.
+        "status": the item status is one of them.
+        "min_amount", "max_amount": min_amount <= amount_requested < max_amount, in USD in cents.
+    @return: predicate of the items to send, or None if every item is sent.
+    @raise ValueError: if @filter_spec is invalid.
+    '''
+    if not filter_spec:
+        return None
+    if type(filter_spec) != dict:
+        raise ValueError("filter must be an object")
+    unknown_keys = set(filter_spec.keys()) - {"status", "min_amount", "max_amount"}
+    if unknown_keys:
+        raise ValueError("Unknown filter: {}".format(", ".join(sorted(unknown_keys))))
+
+    checks = []
+    if "status" in filter_spec:
+        statuses = filter_spec["status"]
+        _check_list_of("status", statuses, INVOICE_STATUSES)
+        statuses = frozenset(statuses)
+        checks.append(lambda item: item["status"] in statuses)
+    if "min_amount" in filter_spec:
+        min_amount = filter_spec["min_amount"]
+        _check_number("min_amount", min_amount)
+        checks.append(lambda item: item["amount_requested"] >= min_amount)
+    if "max_amount" in filter_spec:
+        max_amount = filter_spec["max_amount"]
+        _check_number("max_amount", max_amount)
+        checks.append(lambda item: item["amount_requested"] < max_amount)
+
+    if len(checks) == 1:
+        return checks[0]
+    return lambda item: all(check(item) for check in checks)
+
+def compile_feed_projection(fields: list, required_fields: list) -> typing.Optional[typing.Callable[[dict], dict]]:
+    '''
+    @fields: the fields of the items to send, e.g. ["invoice_id", "status"]. Fields that an item does not have,
+        e.g. encoded_invoice of a paid invoice, are left out.
+    @required_fields: sent even if not in @fields, e.g. "seq" for resuming the feed.
+    @return: function from an item to the item to send, or None if items are sent whole.
+    @raise ValueError: if @fields is invalid.
+    '''
+    if not fields:
+        return None
+    _check_list_of("fields", fields, FEED_ITEM_FIELDS)
+    fields = tuple(dict.fromkeys(required_fields + fields))
+    return lambda item: {field: item[field] for field in fields if field in item}
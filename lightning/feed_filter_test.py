@@ -0,0 +1,37 @@
+import unittest
+from .feed_filter import compile_feed_filter, compile_feed_projection
+
+class FeedFilterTest(unittest.TestCase):
+
+    def test_compileFeedFilter(self):
+        self.assertIsNone(compile_feed_filter(None))
+        self.assertIsNone(compile_feed_filter({}))
+
+        predicate = compile_feed_filter({"status": ["paid"]})
+        self.assertTrue(predicate({"status": "paid", "amount_requested": 1}))
+        self.assertFalse(predicate({"status": "expired", "amount_requested": 1}))
+
+        predicate = compile_feed_filter({"status": ["paid", "pending"], "min_amount": 100, "max_amount": 200})
+        self.assertTrue(predicate({"status": "pending", "amount_requested": 100}))
+        self.assertFalse(predicate({"status": "pending", "amount_requested": 99}))
+        self.assertFalse(predicate({"status": "pending", "amount_requested": 200}))
+        self.assertFalse(predicate({"status": "expired", "amount_requested": 150}))
+
+    def test_compileFeedFilterInvalid(self):
+        for filter_spec in ["paid", {"account_id": 1}, {"status": "paid"}, {"status": ["unknown"]}, {"min_amount": "1"},
+                {"status": [["paid"]]}, {"status": [{"paid": 1}]}]:
+            with self.assertRaises(ValueError):
+                compile_feed_filter(filter_spec)
+
+    def test_compileFeedProjection(self):
+        self.assertIsNone(compile_feed_projection(None, ["seq"]))
+        projection = compile_feed_projection(["status", "encoded_invoice"], ["seq", "invoice_id"])
+        item = {"seq": 1, "invoice_id": 2, "status": "paid", "amount_requested": 3}
+        self.assertEqual({"seq": 1, "invoice_id": 2, "status": "paid"}, projection(item))
+
+        for fields in ["status", ["account_id"], [["status"]], [{"status": 1}], {"status": 1}]:
+            with self.assertRaises(ValueError):
+                compile_feed_projection(fields, ["seq"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,5 @@
 import asyncio
 import websockets
-import json
 from websockets.server import WebSocketServerProtocol
 import logging
 from .config import Config
@@ -8,12 +7,15 @@ from .db import DBAccount, DBInvoice
 import os
 import lightning.market
 from .pubsub import Pubsub
+from .feed_replay import FEED_FINALIZED_INVOICES, FEED_PENDING_INVOICES, FEED_INVOICE_STATUS, FeedEvent, FeedReplay, invoice_feed_item
+from .feed_router import FeedRouter
+from .feed_filter import compile_feed_filter, compile_feed_projection
 import time
 from .auth import Auth, JwtTokenDecodeError, JwtTokenUtils
 from threading import Lock
 from asyncio import Task
 import typing
-from queue import SimpleQueue, Empty
+import itertools
 from collections import defaultdict
 from .jsonrpc_handler import JsonRpcException, WebSocketSend, JsonRpcRequest, JsonRpcHandler, JsonRpcSession
 from .jsonrpc_handler import JSONRPC_ERROR_CODE_PARSE_ERROR, JSONRPC_ERROR_CODE_INVALID_REQUEST, JSONRPC_ERROR_CODE_METHOD_NOT_FOUND, JSONRPC_ERROR_CODE_INVALID_PARAMS, JSONRPC_ERROR_CODE_INTERNAL_ERROR
@@ -28,15 +30,129 @@ class _FeedMetadata():
     def __init__(self):
         self.feed_id = 0
         self.feed_type = None
+        # If not None, items with a greater seq are replayed before the live items.
+        self.since_seq = None
         # True when the remote signals "cancel" is closed and the feed is terminated.
         self.cancelled = False
+        # Items to send.
+        self.buffer = _FeedBuffer(Config.FeedMaxPendingItems)
+        # For FEED_INVOICE_STATUS, invoice_id -> FeedRouter subscriber id of each watched invoice.
+        self.watched_invoices: typing.Dict[int, int] = {}
+        # Compiled from the "filter" and "fields" params, see feed_filter.py. None sends all items, whole.
+        self.predicate = None
+        self.projection = None
+        # Task sending the feed, see FeedHandler._run_feed.
+        self.task: asyncio.Task = None
+
+    def accept(self, item: dict) -> typing.Optional[dict]:
+        '''
+        @return: @item as sent to the remote, or None if it is filtered out.
+        '''
+        if self.predicate is not None and not self.predicate(item):
+            return None
+        return self.projection(item) if self.projection is not None else item
+
+class _FeedBuffer():
+    '''
+    Feed items not sent yet, filled by FeedRouter callbacks on other threads. Items are keyed e.g. by invoice_id, so that
+    while the websocket is congested a newer item replaces the pending one of the same key. At most @max_items keys
+    are held; items of further keys are dropped and overflowed is set.
+    The feed task waits for items with wait_ready(), which put wakes up from any thread.
+    '''
+    def __init__(self, max_items: int):
+        self._max_items = max_items
+        self._items = {}
+        self._lock = Lock()
+        self.overflowed = False
+        # Event loop of the task in wait_ready(), and the event it waits on.
+        self._loop: asyncio.AbstractEventLoop = None
+        self._ready: asyncio.Event = None
+
+    def _notify(self):
+        # Called with the lock held.
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                # The loop is closed, no task waits anymore.
+                pass
+
+    def wake(self):
+        '''
+        Wake up the task in wait_ready() even without items, e.g. when the feed is cancelled.
+        '''
+        self._lock.acquire()
+        try:
+            self._notify()
+        finally:
+            self._lock.release()
+
+    async def wait_ready(self, timeout: float):
+        '''
+        Wait until there are items, wake() is called, or @timeout seconds passed.
+        '''
+        self._lock.acquire()
+        try:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+                self._ready = asyncio.Event()
+            if self._items:
+                return
+            self._ready.clear()
+        finally:
+            self._lock.release()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def put_if_absent(self, key, item):
+        self._lock.acquire()
+        try:
+            if key not in self._items:
+                if not self._items:
+                    self._notify()
+                if len(self._items) < self._max_items:
+                    self._items[key] = item
+                else:
+                    self.overflowed = True
+        finally:
+            self._lock.release()
+
+    def put(self, key, item):
+        self._lock.acquire()
+        try:
+            if not self._items:
+                self._notify()
+            if key in self._items or len(self._items) < self._max_items:
+                # Moved to the end, so that items are taken in seq order.
+                self._items.pop(key, None)
+                self._items[key] = item
+            else:
+                self.overflowed = True
+        finally:
+            self._lock.release()
+
+    def take(self, max_number_of_items: int) -> list:
+        '''
+        @return: at most @max_number_of_items items, oldest key first.
+        '''
+        self._lock.acquire()
+        try:
+            keys = list(itertools.islice(self._items, max_number_of_items))
+            return [self._items.pop(key) for key in keys]
+        finally:
+            self._lock.release()
 
 class FeedHandler(JsonRpcHandler):
-    FEED_FINALIZED_INVOICES = "finalized_invoices"
+    FEED_FINALIZED_INVOICES = FEED_FINALIZED_INVOICES
+    FEED_PENDING_INVOICES = FEED_PENDING_INVOICES
+    FEED_INVOICE_STATUS = FEED_INVOICE_STATUS
+    FEED_TYPES = [FEED_FINALIZED_INVOICES, FEED_PENDING_INVOICES, FEED_INVOICE_STATUS]
 
     FEED_MAX_NUMBER_OF_ITEMS = 100
 
-    def __init__(self, websocket_send: WebSocketSend, jsonrpc_session: JsonRpcSession, max_feeds_allowed=1):
+    def __init__(self, websocket_send: WebSocketSend, jsonrpc_session: JsonRpcSession, max_feeds_allowed=3):
         self._websocket_send = websocket_send
         self._jsonrpc_session = jsonrpc_session
         self._max_feeds_allowed = max_feeds_allowed
@@ -50,56 +166,167 @@ class FeedHandler(JsonRpcHandler):
         return False
     
     def can_handle(self, request: JsonRpcRequest):
-        return request.method in ["select_feed", "cancel_feed"]
+        return request.method in ["select_feed", "cancel_feed", "watch_invoices", "unwatch_invoices"]
+
+    async def _send_feed_items(self, feed: _FeedMetadata, items: list):
+        await self._websocket_send.send_message({
+            "jsonrpc": "2.0", 
+            "method": "feed", 
+            "params": {
+                "feed_id": feed.feed_id,
+                "feed": items
+            }
+        })
+
+    def _check_invoice_ids(self, invoice_ids):
+        if type(invoice_ids) != list or any(type(invoice_id) != int for invoice_id in invoice_ids):
+            msg = "invoice_ids must be a list of integers"
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+
+    def _watch_invoices(self, feed: _FeedMetadata, invoice_ids: list):
+        '''
+        Send the current status of each of @invoice_ids, then its updates until it is paid or expired.
+        '''
+        self._check_invoice_ids(invoice_ids)
+        new_invoice_ids = [invoice_id for invoice_id in dict.fromkeys(invoice_ids) if invoice_id not in feed.watched_invoices]
+        if len(feed.watched_invoices) + len(new_invoice_ids) > Config.FeedMaxWatchedInvoices:
+            msg = "At most {} invoices can be watched".format(Config.FeedMaxWatchedInvoices)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        account_id = self._jsonrpc_session.account_id
+        # Only invoices of the account are subscribed to.
+        if len(DBInvoice.get_invoices_by_ids(account_id, new_invoice_ids)) != len(new_invoice_ids):
+            msg = "Invoices are not found"
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        buffer = feed.buffer
+        def on_feed_event(event: FeedEvent):
+            if event.account_id == account_id:
+                buffer.put(event.item["invoice_id"], feed.accept(event.item))
+        # Subscribed before reading the current status again, so that no update is missed. An update received
+        # meanwhile is newer than the current status read, which is then not sent.
+        for invoice_id in new_invoice_ids:
+            feed.watched_invoices[invoice_id] = FeedRouter.instance.subscribe_invoice(invoice_id, on_feed_event)
+        seq = FeedReplay.instance.last_seq()
+        for invoice in DBInvoice.get_invoices_by_ids(account_id, new_invoice_ids):
+            item = invoice_feed_item(invoice)
+            item["seq"] = seq
+            buffer.put_if_absent(invoice.invoice_id, feed.accept(item))
+
+    def _unwatch_invoice(self, feed: _FeedMetadata, invoice_id: int):
+        subscriber_id = feed.watched_invoices.pop(invoice_id, None)
+        if subscriber_id is not None:
+            FeedRouter.instance.unsubscribe(subscriber_id)
 
     async def _start_feed(self, feed: _FeedMetadata):
-        queue = SimpleQueue()
+        buffer = feed.buffer
         subscriber_id = 0
         try:
-            if feed.feed_type == FeedHandler.FEED_FINALIZED_INVOICES:
-                def on_finalized_invoice(topic, invoice):
-                    assert topic == "/invoice/finalized"
-                    if invoice.account_id == self._jsonrpc_session.account_id:
-                        queue.put({
-                            "invoice_id": invoice.invoice_id,
-                            "status": invoice.status
-                        })
-                subscriber_id = Pubsub.instance.subscribe("/invoice/finalized", on_finalized_invoice)
-            else:
-                raise JsonRpcException("Unknown feed_type: {}".format(feed.feed_type))
+            account_id = self._jsonrpc_session.account_id
+            if feed.feed_type in [FeedHandler.FEED_FINALIZED_INVOICES, FeedHandler.FEED_PENDING_INVOICES]:
+                def on_feed_event(event: FeedEvent):
+                    item = feed.accept(event.item)
+                    if item is not None:
+                        buffer.put(item["invoice_id"], item)
+                subscriber_id = FeedRouter.instance.subscribe_feed(account_id, feed.feed_type, on_feed_event)
+            elif feed.feed_type != FeedHandler.FEED_INVOICE_STATUS:
+                raise JsonRpcException("Unknown feed_type: {}".format(feed.feed_type), JSONRPC_ERROR_CODE_INVALID_PARAMS)
 
-            # Given queue where we feed items will be put into, send them to the remote.
+            # Items recorded before the subscription are replayed, the later ones are in the buffer.
+            last_replayed_seq = 0
+            if feed.since_seq is not None and feed.feed_type != FeedHandler.FEED_INVOICE_STATUS:
+                for items in FeedReplay.instance.iter_since(account_id, feed.feed_type, feed.since_seq, 
+                        FeedHandler.FEED_MAX_NUMBER_OF_ITEMS):
+                    last_replayed_seq = items[-1]["seq"]
+                    items = [item for item in map(feed.accept, items) if item is not None]
+                    if items:
+                        await self._send_feed_items(feed, items)
+
+            # Given buffer where feed items will be put into, send them to the remote.
             while not feed.cancelled:
                 self._jsonrpc_session.check_auth()
-                items = []
-                for _ in range(FeedHandler.FEED_MAX_NUMBER_OF_ITEMS):
-                    try:
-                        item = queue.get_nowait()
-                    except Empty:
-                        break
-                    items.append(item)
+                if self._websocket_send.is_congested() and not buffer.overflowed:
+                    # Coalesce in the buffer until the remote catches up. Once the buffer overflows, send anyway so
+                    # that the websocket is closed if it stays congested.
+                    await self._websocket_send.wait_uncongested()
+                    continue
+                taken = buffer.take(FeedHandler.FEED_MAX_NUMBER_OF_ITEMS)
+                items = [item for item in taken if item["seq"] > last_replayed_seq]
                 if items:
-                    await self._websocket_send.send(json.dumps({
-                        "jsonrpc": "2.0", 
-                        "method": "feed", 
-                        "params": {
-                            "feed_id": feed.feed_id,
-                            "feed": items
-                        }
-                    }))
-                await asyncio.sleep(0)
+                    await self._send_feed_items(feed, items)
+                    if feed.feed_type == FeedHandler.FEED_INVOICE_STATUS:
+                        for item in items:
+                            if item["status"] in ["paid", "expired"]:
+                                self._unwatch_invoice(feed, item["invoice_id"])
+                if not taken:
+                    # Until the next item, or until the token expires so that the feed is closed.
+                    await buffer.wait_ready(min(max(self._jsonrpc_session.exp - time.time(), 0) + 1, 60))
+                else:
+                    await asyncio.sleep(0)
             
         finally:
             if subscriber_id:
-                Pubsub.instance.unsubscribe(subscriber_id)
-            del self._feeds[feed.feed_id]
+                FeedRouter.instance.unsubscribe(subscriber_id)
+            self._release_feed(feed)
+
+    def _release_feed(self, feed: _FeedMetadata):
+        for invoice_id in list(feed.watched_invoices.keys()):
+            self._unwatch_invoice(feed, invoice_id)
+        self._feeds.pop(feed.feed_id, None)
+
+    async def _run_feed(self, feed: _FeedMetadata):
+        '''
+        Send @feed until it is cancelled or fails. A feed that fails e.g. because the token expired is closed with
+        {"jsonrpc": "2.0", "method": "feed_closed", "params": {"feed_id": 1, "reason": "Token has expired"}}.
+        '''
+        try:
+            await self._start_feed(feed)
+            return
+        except JsonRpcException as e:
+            LOGGER.debug("Feed {} closed: {}".format(feed.feed_id, str(e)))
+            reason = e.message_to_client
+        except websockets.exceptions.ConnectionClosed:
+            return
+        except Exception as e:
+            LOGGER.error("Feed {} failed: {}".format(feed.feed_id, str(e)))
+            reason = "Internal error"
+        try:
+            await self._websocket_send.send_message({
+                "jsonrpc": "2.0",
+                "method": "feed_closed",
+                "params": {
+                    "feed_id": feed.feed_id,
+                    "reason": reason
+                }
+            })
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def close(self):
+        '''
+        Cancel all feeds, e.g. when the websocket is closed.
+        '''
+        tasks = [feed.task for feed in self._feeds.values() if feed.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Feeds without a task, e.g. whose select_feed response was being sent.
+        for feed in list(self._feeds.values()):
+            self._release_feed(feed)
+
+    def _get_feed(self, feed_id, feed_type: str = None) -> _FeedMetadata:
+        if feed_id not in self._feeds or (feed_type and self._feeds[feed_id].feed_type != feed_type):
+            msg = "Feed ID {} is not found".format(feed_id)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_REQUEST, msg)
+        return self._feeds[feed_id]
+
+    def _response_send(self, request: JsonRpcRequest) -> WebSocketSend:
+        return request.websocket_send if request.websocket_send else self._websocket_send
 
-    async def _send_ok(self, request_id):
-        await self._websocket_send.send(json.dumps({
+    async def _send_ok(self, request: JsonRpcRequest):
+        await self._response_send(request).send_message({
             "jsonrpc": "2.0",
             "result": "ok",
-            "id": request_id
-        }))
+            "id": request.id
+        })
 
     async def handle(self, request: JsonRpcRequest):
         '''
@@ -107,49 +334,96 @@ class FeedHandler(JsonRpcHandler):
         Pre-condition: The websocket has been authenticated indicated by self.jsonrpc_session
         Case: Start receiving a feed
             1) The remote sends a requets indicating the type of Feed that it want to receive, {"method": "select_feed", "params": {"feed_type": "finalized_invoices"}}
+                feed_type is one of FeedHandler.FEED_TYPES:
+                    "finalized_invoices": invoices of the account that are paid or expired.
+                    "pending_invoices": invoices of the account that Lightning has picked up, with their encoded_invoice.
+                    "invoice_status": the current status and the updates of the invoices of "invoice_ids", e.g. {"feed_type": "invoice_status", "invoice_ids": [1, 2]},
+                        until they are paid or expired. At most Config.FeedMaxWatchedInvoices invoices.
+                Optionally with "since_seq": the "seq" of the last item it received, to first receive the items it missed e.g. while reconnecting.
+                    Not needed for "invoice_status", which starts with the current status.
+                Optionally with "filter" e.g. {"status": ["paid"], "min_amount": 1000}, and "fields" e.g. ["invoice_id", "status"], to only
+                    receive the items and fields it needs. See feed_filter.py. "filter" is not supported by "invoice_status".
                 2a) Handler responds with error {"error": "error message"}, possible errors: 1) not authenicated, 2) self.max_feeds_allowed is reached.
                 2b) Handler responds with {"result": 1} where 1 is the feed ID
             2) Handler starts to send the feed indefinitely until the remote closes the socket, token expired, the local encounter an error, or the remote cancels it.
-                The format of the feed is {"jsonrpc": "2.0", "method": "feed", "params": {"feed_id": 1,"feed": []}}
+                A feed that ends on an error, e.g. the token expired, is followed by a "feed_closed" notification, see _run_feed.
+                The format of the feed is {"jsonrpc": "2.0", "method": "feed", "params": {"feed_id": 1,"feed": []}}. Each item has an increasing "seq".
         Case: Cancel a feed
             1) The remote sends a requets indicating the type of Feed that it want to cancel, {"method": "cancel_feed", "params": {"feed_id": 1}}
                 1) The remote respond {"result": "ok"}
+        Case: Watch more invoices, or stop watching some, with an "invoice_status" feed
+            1) {"method": "watch_invoices", "params": {"feed_id": 1, "invoice_ids": [3]}}, or "unwatch_invoices"
+                1) The remote respond {"result": "ok"}
 
-        Note: the websocket handler must have more than self.max_feeds_allowed, otherwise when the self.max_feeds_allowed number
-            of feeds are reach or before, socket hangs and no more requests can be processed. Maybe a FIXME?
+        Each feed is sent by its own task, see _run_feed, so open feeds do not hold up the handling of other requests.
         '''
         assert self.can_handle(request)
         self._jsonrpc_session.check_auth()
-        
-        if len(self._feeds) > self._max_feeds_allowed:
-            raise JsonRpcException("Max number of feeds reached", JSONRPC_ERROR_CODE_INVALID_REQUEST, "You have reached the max number of feeds")
 
         if request.method == "select_feed":
+            if len(self._feeds) >= self._max_feeds_allowed:
+                raise JsonRpcException("Max number of feeds reached", JSONRPC_ERROR_CODE_INVALID_REQUEST, "You have reached the max number of feeds")
             feed_type = request.params.get("feed_type", None)
+            if feed_type not in FeedHandler.FEED_TYPES:
+                msg = "Unknown feed_type: {}".format(feed_type)
+                raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
             if self._feed_type_exists(feed_type):
                 msg = "Feed type {} already exists".format(feed_type)
                 raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_REQUEST, msg)
 
+            feed_metadata = _FeedMetadata()
+            feed_metadata.feed_type = feed_type
+            feed_metadata.since_seq = request.params.get("since_seq", None)
+            if feed_metadata.since_seq is not None and (type(feed_metadata.since_seq) != int or feed_metadata.since_seq < 0):
+                msg = "since_seq must be a non-negative integer"
+                raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+            try:
+                if feed_type != FeedHandler.FEED_INVOICE_STATUS:
+                    feed_metadata.predicate = compile_feed_filter(request.params.get("filter", None))
+                elif request.params.get("filter", None):
+                    raise ValueError("filter is not supported by {}".format(feed_type))
+                # seq is needed to resume the feed, and status to stop watching invoices that are paid or expired.
+                required_fields = ["seq", "invoice_id", "status"] if feed_type == FeedHandler.FEED_INVOICE_STATUS else ["seq", "invoice_id"]
+                feed_metadata.projection = compile_feed_projection(request.params.get("fields", None), required_fields)
+            except ValueError as e:
+                raise JsonRpcException(str(e), JSONRPC_ERROR_CODE_INVALID_PARAMS, str(e))
+            if feed_type == FeedHandler.FEED_INVOICE_STATUS:
+                self._watch_invoices(feed_metadata, request.params.get("invoice_ids", []))
+
             self._last_feed_id += 1
             feed_id = self._last_feed_id
-            feed_metadata = _FeedMetadata()
             feed_metadata.feed_id = feed_id
-            feed_metadata.feed_type = feed_type
             self._feeds[feed_id] = feed_metadata 
-            await self._websocket_send.send(json.dumps({
-                "jsonrpc": "2.0",
-                "result": feed_id,
-                "id": request.id
-            }))
-            await self._start_feed(feed_metadata)
+            try:
+                await self._response_send(request).send_message({
+                    "jsonrpc": "2.0",
+                    "result": feed_id,
+                    "id": request.id
+                })
+            except BaseException:
+                # e.g. the remote is gone. The feed never starts, release its subscriptions.
+                self._release_feed(feed_metadata)
+                raise
+            feed_metadata.task = asyncio.create_task(self._run_feed(feed_metadata))
         elif request.method == "cancel_feed":
             feed_id = request.params.get("feed_id", 0)
             if feed_id in self._feeds:
                 self._feeds[feed_id].cancelled = True
-                await self._send_ok(request.id)
+                self._feeds[feed_id].buffer.wake()
+                await self._send_ok(request)
             else:
                 msg = "Feed ID {} is not found".format(feed_id)
                 raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_REQUEST, msg)
+        elif request.method == "watch_invoices":
+            feed = self._get_feed(request.params.get("feed_id", 0), FeedHandler.FEED_INVOICE_STATUS)
+            self._watch_invoices(feed, request.params.get("invoice_ids", []))
+            await self._send_ok(request)
+        elif request.method == "unwatch_invoices":
+            feed = self._get_feed(request.params.get("feed_id", 0), FeedHandler.FEED_INVOICE_STATUS)
+            self._check_invoice_ids(request.params.get("invoice_ids", []))
+            for invoice_id in request.params.get("invoice_ids", []):
+                self._unwatch_invoice(feed, invoice_id)
+            await self._send_ok(request)
         else:
             msg = "JSONRPC method {} is unknown".format(request.method)
             raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_REQUEST, msg)
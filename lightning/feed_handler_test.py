@@ -4,11 +4,17 @@ from .pubsub import Pubsub
 import random
 import unittest
 from .db import DBInvoice, DBAccount, DBUtils
+import threading
 import time
 from .auth import JwtTokenUtils, JwtTokenPayload
-from .feed_handler import FeedHandler, _FeedMetadata
+from .feed_handler import FeedHandler, _FeedMetadata, _FeedBuffer
+from .feed_replay import FeedEvent, FeedReplay
+from .feed_router import FeedRouter
+from .feed_filter import compile_feed_filter, compile_feed_projection
+from .jsonrpc_handler import JsonRpcException, JSONRPC_ERROR_CODE_INVALID_PARAMS
 from .jsonrpc_handler import JsonRpcRequest, WebSocketSend, JsonRpcSession
 import json
+import websockets
 
 class FeedTest(unittest.TestCase):
 
@@ -34,6 +40,49 @@ class FeedTest(unittest.TestCase):
         request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_FINALIZED_INVOICES}, 2)
         _ = asyncio.run(feed_handler.handle(request))
 
+    def test_selectFeedTask(self):
+        Pubsub.instance = Pubsub()
+        FeedRouter.instance = FeedRouter()
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.messages = []
+            async def send_message(self, message):
+                self.messages.append(message)
+
+        session = JsonRpcSession()
+        session.account_id = 1
+        session.exp = int(time.time()) + 60*60*24
+
+        websocket_send = MockWebSocketSend()
+        feed_handler = FeedHandler(websocket_send, session)
+        async def run():
+            # Returns once the feed is started, which keeps running in its own task.
+            await feed_handler.handle(JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_FINALIZED_INVOICES}, 2))
+            await asyncio.sleep(0.01)
+            feed = feed_handler._feeds[1]
+            self.assertFalse(feed.task.done())
+            self.assertEqual(1, len(FeedRouter.instance._by_feed))
+
+            # The token expires, which closes the feed. An idle feed checks it at the time of exp, which the test
+            # moves back, so the feed is woken up.
+            session.exp = int(time.time()) - 1
+            feed.buffer.wake()
+            await asyncio.sleep(0.01)
+            self.assertTrue(feed.task.done())
+
+            session.exp = int(time.time()) + 60*60*24
+            await feed_handler.handle(JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_FINALIZED_INVOICES}, 3))
+            await asyncio.sleep(0.01)
+            await feed_handler.close()
+        asyncio.run(run())
+
+        self.assertEqual(0, len(feed_handler._feeds))
+        self.assertEqual(0, len(FeedRouter.instance._by_feed))
+        self.assertEqual({"jsonrpc": "2.0", "result": 1, "id": 2}, websocket_send.messages[0])
+        self.assertEqual({"jsonrpc": "2.0", "method": "feed_closed", "params": {"feed_id": 1, "reason": "Please authenticate"}}, 
+            websocket_send.messages[1])
+        self.assertEqual({"jsonrpc": "2.0", "result": 2, "id": 3}, websocket_send.messages[2])
+
     def test_cancel(self):
         this = self
         class MockWebSocketSend(WebSocketSend):
@@ -54,20 +103,17 @@ class FeedTest(unittest.TestCase):
 
     def test_startFeed(self):
         this = self
-        class MockPubsub(Pubsub):
-            def subscribe(self, topic: str, callback):
-                this.assertEqual(topic, "/invoice/finalized")
-                finalized_invoice = DBInvoice()
-                finalized_invoice.account_id = 5
-                finalized_invoice.invoice_id = 7
-                finalized_invoice.status = "paid"
-                callback(topic, finalized_invoice)
-                return 19
-
-            def unsubscribe(self, callback_id):
-                this.assertEqual(callback_id, 19)
+        Pubsub.instance = Pubsub()
+        class MockFeedRouter(FeedRouter):
+            def subscribe_feed(self, account_id: int, feed_type: str, callback):
+                subscriber_id = FeedRouter.subscribe_feed(self, account_id, feed_type, callback)
+                self._route(FeedEvent(5, FeedHandler.FEED_FINALIZED_INVOICES, {"invoice_id": 7, "status": "paid", "seq": 1}))
+                # Other accounts and feeds are not sent.
+                self._route(FeedEvent(6, FeedHandler.FEED_FINALIZED_INVOICES, {"invoice_id": 8, "status": "paid", "seq": 2}))
+                self._route(FeedEvent(5, FeedHandler.FEED_PENDING_INVOICES, {"invoice_id": 9, "status": "pending", "seq": 3}))
+                return subscriber_id
 
-        Pubsub.instance = MockPubsub()
+        FeedRouter.instance = MockFeedRouter()
 
         feed_metadata = _FeedMetadata()
         feed_metadata.feed_id = 23
@@ -81,6 +127,7 @@ class FeedTest(unittest.TestCase):
                 this.assertEqual(len(resp["params"]["feed"]), 1)
                 this.assertEqual(resp["params"]["feed"][0]["status"], "paid")
                 this.assertEqual(resp["params"]["feed"][0]["invoice_id"], 7)
+                this.assertEqual(resp["params"]["feed"][0]["seq"], 1)
 
                 feed_metadata.cancelled = True
 
@@ -92,3 +139,290 @@ class FeedTest(unittest.TestCase):
         feed_handler._feeds[feed_metadata.feed_id] = feed_metadata
 
         _ = asyncio.run(feed_handler._start_feed(feed_metadata))
+
+    def test_feedBuffer(self):
+        buffer = _FeedBuffer(max_items=2)
+        buffer.put(1, {"invoice_id": 1, "status": "pending", "seq": 1})
+        buffer.put(2, {"invoice_id": 2, "status": "paid", "seq": 2})
+        # Coalesced with the pending item of the same invoice, and taken after the older items.
+        buffer.put(1, {"invoice_id": 1, "status": "paid", "seq": 3})
+        self.assertFalse(buffer.overflowed)
+        buffer.put(3, {"invoice_id": 3, "status": "paid", "seq": 4})
+        self.assertTrue(buffer.overflowed)
+
+        self.assertEqual([{"invoice_id": 2, "status": "paid", "seq": 2}], buffer.take(1))
+        self.assertEqual([{"invoice_id": 1, "status": "paid", "seq": 3}], buffer.take(100))
+        self.assertEqual([], buffer.take(100))
+
+    def test_startFeedCongested(self):
+        this = self
+        Pubsub.instance = Pubsub()
+        class MockFeedRouter(FeedRouter):
+            def subscribe_feed(self, account_id: int, feed_type: str, callback):
+                for seq, status in enumerate(["pending", "paid"]):
+                    callback(FeedEvent(5, FeedHandler.FEED_FINALIZED_INVOICES, {"invoice_id": 7, "status": status, "seq": seq}))
+                return FeedRouter.subscribe_feed(self, account_id, feed_type, callback)
+
+        FeedRouter.instance = MockFeedRouter()
+
+        feed_metadata = _FeedMetadata()
+        feed_metadata.feed_id = 23
+        feed_metadata.feed_type = FeedHandler.FEED_FINALIZED_INVOICES
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.congested_checks = 0
+            def is_congested(self):
+                self.congested_checks += 1
+                return self.congested_checks < 3
+            async def send(self, data: str):
+                # Only the latest item of the invoice is sent once the websocket is no longer congested.
+                resp = json.loads(data)
+                this.assertEqual(resp["params"]["feed"], [{"invoice_id": 7, "status": "paid", "seq": 1}])
+                feed_metadata.cancelled = True
+
+        session = JsonRpcSession()
+        session.account_id = 5
+        session.exp = int(time.time()) + 60*60*24
+
+        websocket_send = MockWebSocketSend()
+        feed_handler = FeedHandler(websocket_send, session)
+        feed_handler._feeds[feed_metadata.feed_id] = feed_metadata
+        _ = asyncio.run(feed_handler._start_feed(feed_metadata))
+        self.assertEqual(websocket_send.congested_checks, 3)
+
+    def test_startFeedSinceSeq(self):
+        this = self
+        Pubsub.instance = Pubsub()
+        FeedReplay.instance = FeedReplay(ring_size=2, spill_batch_size=1)
+        FeedRouter.instance = FeedRouter()
+        account_id = random.randint(1, 10e12)
+        seqs = [FeedReplay.instance.record(account_id, FeedHandler.FEED_FINALIZED_INVOICES, {"invoice_id": i, "status": "paid"}) 
+            for i in range(5)]
+
+        feed_metadata = _FeedMetadata()
+        feed_metadata.feed_id = 23
+        feed_metadata.feed_type = FeedHandler.FEED_FINALIZED_INVOICES
+        feed_metadata.since_seq = seqs[0]
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.items = []
+            async def send(self, data: str):
+                self.items.extend(json.loads(data)["params"]["feed"])
+                if len(self.items) == 4:
+                    # A live item, after the replayed ones.
+                    FeedReplay.instance.record(account_id, FeedHandler.FEED_FINALIZED_INVOICES, {"invoice_id": 5, "status": "paid"})
+                if len(self.items) == 5:
+                    feed_metadata.cancelled = True
+
+        session = JsonRpcSession()
+        session.account_id = account_id
+        session.exp = int(time.time()) + 60*60*24
+
+        websocket_send = MockWebSocketSend()
+        feed_handler = FeedHandler(websocket_send, session)
+        feed_handler._feeds[feed_metadata.feed_id] = feed_metadata
+        _ = asyncio.run(feed_handler._start_feed(feed_metadata))
+        self.assertEqual([1, 2, 3, 4, 5], [item["invoice_id"] for item in websocket_send.items])
+        self.assertEqual(seqs[1:], [item["seq"] for item in websocket_send.items][:4])
+        FeedReplay.instance.close()
+
+    def test_startFeedFilter(self):
+        this = self
+        Pubsub.instance = Pubsub()
+        FeedReplay.instance = FeedReplay(ring_size=2, spill_batch_size=1)
+        FeedRouter.instance = FeedRouter()
+        account_id = random.randint(1, 10e12)
+        seqs = [FeedReplay.instance.record(account_id, FeedHandler.FEED_FINALIZED_INVOICES, 
+            {"invoice_id": i, "status": "paid" if i % 2 else "expired", "amount_requested": 100 * i}) for i in range(5)]
+
+        feed_metadata = _FeedMetadata()
+        feed_metadata.feed_id = 23
+        feed_metadata.feed_type = FeedHandler.FEED_FINALIZED_INVOICES
+        feed_metadata.since_seq = seqs[0] - 1
+        feed_metadata.predicate = compile_feed_filter({"status": ["paid"], "min_amount": 200})
+        feed_metadata.projection = compile_feed_projection(["status"], ["seq", "invoice_id"])
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.items = []
+            async def send(self, data: str):
+                self.items.extend(json.loads(data)["params"]["feed"])
+                if len(self.items) == 1:
+                    FeedReplay.instance.record(account_id, FeedHandler.FEED_FINALIZED_INVOICES, 
+                        {"invoice_id": 5, "status": "paid", "amount_requested": 100})
+                    FeedReplay.instance.record(account_id, FeedHandler.FEED_FINALIZED_INVOICES, 
+                        {"invoice_id": 6, "status": "paid", "amount_requested": 600})
+                if len(self.items) == 2:
+                    feed_metadata.cancelled = True
+
+        session = JsonRpcSession()
+        session.account_id = account_id
+        session.exp = int(time.time()) + 60*60*24
+
+        websocket_send = MockWebSocketSend()
+        feed_handler = FeedHandler(websocket_send, session)
+        feed_handler._feeds[feed_metadata.feed_id] = feed_metadata
+        _ = asyncio.run(feed_handler._start_feed(feed_metadata))
+        self.assertEqual([{"seq": seqs[3], "invoice_id": 3, "status": "paid"}], websocket_send.items[:1])
+        self.assertEqual([3, 6], [item["invoice_id"] for item in websocket_send.items])
+        FeedReplay.instance.close()
+
+    def test_selectFeedInvalidFilter(self):
+        session = JsonRpcSession()
+        session.account_id = 1
+        session.exp = int(time.time()) + 60*60*24
+
+        feed_handler = FeedHandler(WebSocketSend(), session)
+        for params in [{"filter": {"status": ["unknown"]}}, {"fields": ["account_id"]}, 
+                {"feed_type": FeedHandler.FEED_INVOICE_STATUS, "invoice_ids": [1], "filter": {"status": ["paid"]}},
+                {"since_seq": "10"}, {"since_seq": -1}, {"since_seq": 1.5}]:
+            request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_FINALIZED_INVOICES, **params}, 2)
+            with self.assertRaises(JsonRpcException):
+                asyncio.run(feed_handler.handle(request))
+        self.assertEqual(0, len(feed_handler._feeds))
+
+    def test_invoiceStatus(self):
+        this = self
+        Pubsub.instance = Pubsub()
+        FeedReplay.instance = FeedReplay()
+        FeedRouter.instance = FeedRouter()
+
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = account.username + "@gmail.com"
+        account = DBAccount.create_account(account)
+        other_account = copy(account)
+        other_account.account_id = 0
+        other_account.username = "Jack" + str(random.randint(0, 10e12))
+        other_account = DBAccount.create_account(other_account)
+        invoices = []
+        for _ in range(3):
+            invoice = DBInvoice()
+            invoice.account_id = account.account_id
+            invoice.status = "created"
+            invoice.created_at = int(time.time())
+            invoice.amount_requested = 100
+            invoice.exchange_rate = 2
+            invoice.expired_at = invoice.created_at + 600
+            invoices.append(DBUtils.insert(invoice, "invoices", id_column_name="invoice_id"))
+        other_account_invoice = copy(invoices[0])
+        other_account_invoice.invoice_id = 0
+        other_account_invoice.account_id = other_account.account_id
+        other_account_invoice = DBUtils.insert(other_account_invoice, "invoices", id_column_name="invoice_id")
+
+        session = JsonRpcSession()
+        session.account_id = account.account_id
+        session.exp = int(time.time()) + 60*60*24
+
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.messages = []
+            async def send(self, data: str):
+                message = json.loads(data)
+                self.messages.append(message)
+                if message.get("method", "") != "feed":
+                    return
+                statuses = [(item["invoice_id"], item["status"]) for item in message["params"]["feed"]]
+                if statuses == [(invoices[0].invoice_id, "created"), (invoices[1].invoice_id, "created")]:
+                    # Only watched invoices of the account, e.g. not invoices[2].
+                    for invoice in invoices:
+                        invoice.status = "pending"
+                        Pubsub.instance.publish("/invoice/pending", invoice)
+                elif statuses == [(invoices[0].invoice_id, "pending"), (invoices[1].invoice_id, "pending")]:
+                    invoices[0].status = "paid"
+                    Pubsub.instance.publish("/invoice/finalized", invoices[0])
+                else:
+                    this.assertEqual(statuses, [(invoices[0].invoice_id, "paid")])
+                    def check_and_cancel():
+                        watched_after_paid.extend(feed_handler._feeds[1].watched_invoices.keys())
+                        feed_handler._feeds[1].cancelled = True
+                    asyncio.get_running_loop().call_soon(check_and_cancel)
+
+        watched_after_paid = []
+        websocket_send = MockWebSocketSend()
+        feed_handler = FeedHandler(websocket_send, session)
+        request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_INVOICE_STATUS, 
+            "invoice_ids": [invoices[0].invoice_id, invoices[1].invoice_id]}, 2)
+        async def run_feed():
+            await feed_handler.handle(request)
+            await feed_handler._feeds[1].task
+        asyncio.run(run_feed())
+        self.assertEqual(websocket_send.messages[0]["result"], 1)
+        self.assertEqual(len(websocket_send.messages), 4)
+        # No longer watched once paid.
+        self.assertEqual(watched_after_paid, [invoices[1].invoice_id])
+        self.assertEqual(feed_handler._feeds, {})
+
+        # Invoices of other accounts can not be watched.
+        request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_INVOICE_STATUS, 
+            "invoice_ids": [invoices[2].invoice_id, other_account_invoice.invoice_id]}, 3)
+        with self.assertRaises(JsonRpcException):
+            asyncio.run(feed_handler.handle(request))
+        self.assertEqual(FeedRouter.instance._by_invoice, {})
+        for invoice_ids in [str(invoices[2].invoice_id), [str(invoices[2].invoice_id)], [[invoices[2].invoice_id]], [True]]:
+            request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_INVOICE_STATUS, 
+                "invoice_ids": invoice_ids}, 3)
+            with self.assertRaises(JsonRpcException) as context:
+                asyncio.run(feed_handler.handle(request))
+            self.assertEqual(context.exception.code, JSONRPC_ERROR_CODE_INVALID_PARAMS)
+
+        # Events of other accounts about a watched invoice id are not sent.
+        feed = _FeedMetadata()
+        feed_handler._watch_invoices(feed, [invoices[2].invoice_id])
+        self.assertEqual([(invoices[2].invoice_id, "created")], [(item["invoice_id"], item["status"]) for item in feed.buffer.take(10)])
+        item = {"invoice_id": invoices[2].invoice_id, "status": "paid", "amount_requested": 100}
+        FeedReplay.instance.record(other_account.account_id, FeedHandler.FEED_FINALIZED_INVOICES, dict(item))
+        self.assertEqual([], feed.buffer.take(10))
+        FeedReplay.instance.record(account.account_id, FeedHandler.FEED_FINALIZED_INVOICES, dict(item))
+        self.assertEqual(["paid"], [item["status"] for item in feed.buffer.take(10)])
+        feed_handler._release_feed(feed)
+        self.assertEqual(FeedRouter.instance._by_invoice, {})
+
+        # A feed whose select_feed response can not be sent, e.g. the remote is gone, releases its invoices.
+        class ClosedWebSocketSend(WebSocketSend):
+            async def send(self, data: str):
+                raise websockets.exceptions.ConnectionClosedError(None, None)
+        feed_handler = FeedHandler(ClosedWebSocketSend(), session)
+        request = JsonRpcRequest("2.0", "select_feed", {"feed_type": FeedHandler.FEED_INVOICE_STATUS, 
+            "invoice_ids": [invoices[2].invoice_id]}, 4)
+        with self.assertRaises(websockets.exceptions.ConnectionClosed):
+            asyncio.run(feed_handler.handle(request))
+        self.assertEqual(FeedRouter.instance._by_invoice, {})
+        self.assertEqual(feed_handler._feeds, {})
+
+    def test_runFeedFailure(self):
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.messages = []
+            async def send_message(self, message):
+                self.messages.append(message)
+        class FailingFeedHandler(FeedHandler):
+            async def _start_feed(self, feed):
+                raise ValueError("bug")
+
+        websocket_send = MockWebSocketSend()
+        feed = _FeedMetadata()
+        feed.feed_id = 3
+        asyncio.run(FailingFeedHandler(websocket_send, JsonRpcSession())._run_feed(feed))
+        # The remote is told, rather than left waiting for items.
+        self.assertEqual([{"jsonrpc": "2.0", "method": "feed_closed", "params": {"feed_id": 3, "reason": "Internal error"}}], 
+            websocket_send.messages)
+
+class FeedBufferTest(unittest.TestCase):
+
+    def test_waitReady(self):
+        buffer = _FeedBuffer(10)
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            # Put from another thread, like the FeedRouter callbacks.
+            threading.Timer(0.05, lambda: buffer.put(1, {"invoice_id": 1})).start()
+            await buffer.wait_ready(5)
+            self.assertLess(loop.time() - start, 1)
+            self.assertEqual([{"invoice_id": 1}], buffer.take(10))
+
+            # Times out without items.
+            start = loop.time()
+            await buffer.wait_ready(0.05)
+            self.assertGreaterEqual(loop.time() - start, 0.04)
+        asyncio.run(run())
@@ -0,0 +1,175 @@
+import logging
+import time
+import typing
+from collections import OrderedDict, deque
+from threading import Lock
+from .codec import json_codec
+from .config import Config
+from .db import DBFeedEvent, DBInvoice
+from .pubsub import Pubsub
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+FEED_FINALIZED_INVOICES = "finalized_invoices"
+FEED_PENDING_INVOICES = "pending_invoices"
+# Not recorded. Made of the items of the feeds above, selected by invoice_id, see FeedRouter.
+FEED_INVOICE_STATUS = "invoice_status"
+
+def invoice_feed_item(invoice: DBInvoice) -> dict:
+    '''
+    @return: the feed item of the current status of @invoice, without "seq".
+    '''
+    item = {
+        "invoice_id": invoice.invoice_id,
+        "status": invoice.status,
+        "amount_requested": invoice.amount_requested
+    }
+    if invoice.status == "pending":
+        item["encoded_invoice"] = invoice.encoded_invoice
+        item["expired_at"] = invoice.expired_at
+    return item
+
+class FeedEvent():
+    def __init__(self, account_id: int, feed_type: str, item: dict):
+        '''
+        Payload of FeedReplay.TOPIC_FEED_EVENT.
+        @item: the feed item sent to the client, with its "seq".
+        '''
+        self.account_id = account_id
+        self.feed_type = feed_type
+        self.item = item
+
+class FeedReplay():
+    '''
+    Numbers the feed items of invoice events with an increasing "seq" and keeps them, so that a client resuming a
+    feed with the seq of the last item it received gets the items it missed, see FeedHandler select_feed since_seq.
+
+    The latest Config.FeedReplayRingSize items of each (account, feed type) are in memory. Older items, and the items
+    of the least recently used rings beyond Config.FeedReplayMaxRings, are spilled in batches to the feed_events
+    table, which keeps them for Config.FeedReplayRetentionSeconds.
+
+    seq increases across accounts and feed types. It starts from the current time in microseconds, so that it keeps
+    increasing across restarts. Items still in memory when the process exits are lost.
+    Thread safe.
+    '''
+    instance = None
+
+    # Published after an item is numbered and recorded.
+    TOPIC_FEED_EVENT = "/feed/event"
+
+    def __init__(self, ring_size: int = Config.FeedReplayRingSize, spill_batch_size: int = Config.FeedReplaySpillBatchSize,
+            max_rings: int = Config.FeedReplayMaxRings, retention_seconds: int = Config.FeedReplayRetentionSeconds):
+        self._ring_size = ring_size
+        self._spill_batch_size = spill_batch_size
+        self._max_rings = max_rings
+        self._retention_seconds = retention_seconds
+        self._last_seq = int(time.time() * 1000000)
+        self._rings: typing.Dict[tuple, deque] = OrderedDict()
+        self._last_purge = 0
+        self._lock = Lock()
+
+        def on_pending_invoice(topic, invoice: DBInvoice):
+            self.record(invoice.account_id, FEED_PENDING_INVOICES, invoice_feed_item(invoice))
+        def on_finalized_invoice(topic, invoice: DBInvoice):
+            self.record(invoice.account_id, FEED_FINALIZED_INVOICES, invoice_feed_item(invoice))
+        self._subscriber_ids = [
+            Pubsub.instance.subscribe("/invoice/pending", on_pending_invoice),
+            Pubsub.instance.subscribe("/invoice/finalized", on_finalized_invoice)
+        ]
+
+    def close(self):
+        for subscriber_id in self._subscriber_ids:
+            Pubsub.instance.unsubscribe(subscriber_id)
+
+    def last_seq(self) -> int:
+        '''
+        @return: seq of the latest recorded item.
+        '''
+        self._lock.acquire()
+        try:
+            return self._last_seq
+        finally:
+            self._lock.release()
+
+    def record(self, account_id: int, feed_type: str, item: dict) -> int:
+        '''
+        Number @item, keep it for replay and publish it on TOPIC_FEED_EVENT.
+        @return: seq of @item.
+        '''
+        key = (account_id, feed_type)
+        self._lock.acquire()
+        try:
+            self._last_seq += 1
+            item["seq"] = self._last_seq
+            ring = self._rings.get(key, None)
+            if ring is None:
+                ring = deque()
+                self._rings[key] = ring
+            self._rings.move_to_end(key)
+            ring.append(item)
+
+            spilled = []
+            if len(ring) >= self._ring_size + self._spill_batch_size:
+                for _ in range(self._spill_batch_size):
+                    spilled.append((key, ring.popleft()))
+            while len(self._rings) > self._max_rings:
+                evicted_key, evicted_ring = self._rings.popitem(last=False)
+                spilled.extend((evicted_key, evicted_item) for evicted_item in evicted_ring)
+            if spilled:
+                # Under the lock, so that an item is always either in a ring or in the table for readers.
+                try:
+                    self._spill(spilled)
+                except Exception as e:
+                    # Replay of these items is lost, but the event is still delivered to live feeds.
+                    LOGGER.error("Failed to spill {} feed items: {}".format(len(spilled), str(e)))
+        finally:
+            self._lock.release()
+
+        Pubsub.instance.publish(FeedReplay.TOPIC_FEED_EVENT, FeedEvent(account_id, feed_type, item))
+        return item["seq"]
+
+    def _spill(self, spilled):
+        now = int(time.time())
+        events = []
+        for (account_id, feed_type), item in spilled:
+            event = DBFeedEvent()
+            event.seq = item["seq"]
+            event.account_id = account_id
+            event.feed_type = feed_type
+            event.item = json_codec.dumps(item)
+            event.created_at = now
+            events.append(event)
+        DBFeedEvent.insert_events(events)
+
+        if now - self._last_purge >= 60:
+            self._last_purge = now
+            DBFeedEvent.delete_events_before(now - self._retention_seconds)
+
+    def iter_since(self, account_id: int, feed_type: str, since_seq: int, chunk_size: int):
+        '''
+        Yield lists of at most @chunk_size items of the feed with seq > @since_seq, ordered by seq. Items recorded
+        after the call are not included.
+        '''
+        key = (account_id, feed_type)
+        self._lock.acquire()
+        try:
+            ring = self._rings.get(key, None)
+            in_memory = [item for item in ring if item["seq"] > since_seq] if ring else []
+            # Items before the ring, or all items up to now if there is no ring, are in the table.
+            before_seq = ring[0]["seq"] if ring else self._last_seq + 1
+        finally:
+            self._lock.release()
+
+        after_seq = since_seq
+        while True:
+            events = DBFeedEvent.list_events(account_id, feed_type, after_seq, before_seq, chunk_size)
+            if not events:
+                break
+            yield [json_codec.loads(event.item) for event in events]
+            after_seq = events[-1].seq
+
+        for i in range(0, len(in_memory), chunk_size):
+            yield in_memory[i:i + chunk_size]
+
+FeedReplay.instance = FeedReplay()
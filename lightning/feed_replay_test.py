@@ -0,0 +1,58 @@
+import random
+import unittest
+from .feed_replay import FeedReplay, FeedEvent, FEED_FINALIZED_INVOICES
+from .pubsub import Pubsub
+from .db import DBInvoice
+
+class FeedReplayTest(unittest.TestCase):
+
+    def test_iterSince(self):
+        Pubsub.instance = Pubsub()
+        feed_replay = FeedReplay(ring_size=3, spill_batch_size=2)
+        account_id = random.randint(1, 10e12)
+        seqs = [feed_replay.record(account_id, FEED_FINALIZED_INVOICES, {"invoice_id": i, "status": "paid"}) for i in range(10)]
+        self.assertEqual(seqs, sorted(seqs))
+        feed_replay.record(account_id + 1, FEED_FINALIZED_INVOICES, {"invoice_id": 10, "status": "paid"})
+
+        # Older items are read from feed_events, the latest ones from memory.
+        chunks = list(feed_replay.iter_since(account_id, FEED_FINALIZED_INVOICES, seqs[2], 4))
+        self.assertEqual([3, 4, 5, 6, 7, 8, 9], [item["invoice_id"] for chunk in chunks for item in chunk])
+        self.assertEqual(seqs[3:], [item["seq"] for chunk in chunks for item in chunk])
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 4)
+
+        self.assertEqual([], list(feed_replay.iter_since(account_id, FEED_FINALIZED_INVOICES, seqs[-1], 4)))
+        self.assertEqual([], list(feed_replay.iter_since(account_id, "other_feed", 0, 4)))
+        feed_replay.close()
+
+    def test_maxRings(self):
+        Pubsub.instance = Pubsub()
+        feed_replay = FeedReplay(ring_size=10, spill_batch_size=1, max_rings=1)
+        account_id = random.randint(1, 10e12)
+        seq = feed_replay.record(account_id, FEED_FINALIZED_INVOICES, {"invoice_id": 1, "status": "paid"})
+        # Spills the ring of account_id.
+        feed_replay.record(account_id + 1, FEED_FINALIZED_INVOICES, {"invoice_id": 2, "status": "paid"})
+        chunks = list(feed_replay.iter_since(account_id, FEED_FINALIZED_INVOICES, seq - 1, 10))
+        self.assertEqual([[{"invoice_id": 1, "status": "paid", "seq": seq}]], chunks)
+        feed_replay.close()
+
+    def test_finalizedInvoice(self):
+        Pubsub.instance = Pubsub()
+        feed_replay = FeedReplay()
+        events = []
+        Pubsub.instance.subscribe(FeedReplay.TOPIC_FEED_EVENT, lambda topic, event: events.append(event))
+        invoice = DBInvoice()
+        invoice.invoice_id = 7
+        invoice.account_id = 5
+        invoice.status = "expired"
+        Pubsub.instance.publish("/invoice/finalized", invoice)
+
+        self.assertEqual(1, len(events))
+        self.assertEqual(5, events[0].account_id)
+        self.assertEqual(FEED_FINALIZED_INVOICES, events[0].feed_type)
+        self.assertEqual(7, events[0].item["invoice_id"])
+        self.assertEqual("expired", events[0].item["status"])
+        feed_replay.close()
+
+if __name__ == '__main__':
+    unittest.main()
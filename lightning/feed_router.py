@@ -0,0 +1,78 @@
+import typing
+from threading import Lock
+from .feed_replay import FeedEvent, FeedReplay
+from .pubsub import Pubsub
+
+class FeedRouter():
+    '''
+    Delivers each FeedEvent only to the feeds that want it, found with a dict lookup by (account_id, feed_type)
+    or by invoice_id, so the cost of an event does not depend on the number of open feeds. Feeds subscribe here
+    instead of each subscribing to Pubsub and checking every event.
+    Callbacks are called on the thread publishing the event, e.g. LightningMonitor.
+    Thread safe.
+    '''
+    instance = None
+
+    def __init__(self):
+        self._last_subscriber_id = 0
+        # Key of the index -> {subscriber_id: callback}
+        self._by_feed: typing.Dict[tuple, dict] = {}
+        self._by_invoice: typing.Dict[int, dict] = {}
+        # subscriber_id -> (index, key)
+        self._subscriptions = {}
+        self._lock = Lock()
+        def on_feed_event(topic, event: FeedEvent):
+            assert topic == FeedReplay.TOPIC_FEED_EVENT
+            self._route(event)
+        self._subscriber_id = Pubsub.instance.subscribe(FeedReplay.TOPIC_FEED_EVENT, on_feed_event)
+
+    def close(self):
+        Pubsub.instance.unsubscribe(self._subscriber_id)
+
+    def _subscribe(self, index: dict, key, callback) -> int:
+        self._lock.acquire()
+        try:
+            self._last_subscriber_id += 1
+            index.setdefault(key, {})[self._last_subscriber_id] = callback
+            self._subscriptions[self._last_subscriber_id] = (index, key)
+            return self._last_subscriber_id
+        finally:
+            self._lock.release()
+
+    def subscribe_feed(self, account_id: int, feed_type: str, callback) -> int:
+        '''
+        @callback: func(event: FeedEvent) -> None, for the events of @feed_type of @account_id.
+        @return: id for unsubscribe
+        '''
+        return self._subscribe(self._by_feed, (account_id, feed_type), callback)
+
+    def subscribe_invoice(self, invoice_id: int, callback) -> int:
+        '''
+        @callback: func(event: FeedEvent) -> None, for the events of any feed type about @invoice_id.
+        @return: id for unsubscribe
+        '''
+        return self._subscribe(self._by_invoice, invoice_id, callback)
+
+    def unsubscribe(self, subscriber_id: int):
+        self._lock.acquire()
+        try:
+            index, key = self._subscriptions.pop(subscriber_id)
+            callbacks = index[key]
+            del callbacks[subscriber_id]
+            if not callbacks:
+                del index[key]
+        finally:
+            self._lock.release()
+
+    def _route(self, event: FeedEvent):
+        self._lock.acquire()
+        try:
+            callbacks = list(self._by_feed.get((event.account_id, event.feed_type), {}).values())
+            callbacks.extend(self._by_invoice.get(event.item.get("invoice_id", None), {}).values())
+        finally:
+            self._lock.release()
+
+        for callback in callbacks:
+            callback(event)
+
+FeedRouter.instance = FeedRouter()
@@ -0,0 +1,36 @@
+import unittest
+from .feed_replay import FeedEvent, FeedReplay, FEED_FINALIZED_INVOICES, FEED_PENDING_INVOICES
+from .feed_router import FeedRouter
+from .pubsub import Pubsub
+
+class FeedRouterTest(unittest.TestCase):
+
+    def test_route(self):
+        Pubsub.instance = Pubsub()
+        router = FeedRouter()
+        by_feed = []
+        by_invoice = []
+        feed_subscriber_id = router.subscribe_feed(5, FEED_FINALIZED_INVOICES, by_feed.append)
+        invoice_subscriber_id = router.subscribe_invoice(7, by_invoice.append)
+
+        events = [
+            FeedEvent(5, FEED_PENDING_INVOICES, {"invoice_id": 7, "status": "pending", "seq": 1}),
+            FeedEvent(5, FEED_FINALIZED_INVOICES, {"invoice_id": 7, "status": "paid", "seq": 2}),
+            FeedEvent(5, FEED_FINALIZED_INVOICES, {"invoice_id": 8, "status": "paid", "seq": 3}),
+            FeedEvent(6, FEED_FINALIZED_INVOICES, {"invoice_id": 9, "status": "paid", "seq": 4}),
+        ]
+        for event in events:
+            Pubsub.instance.publish(FeedReplay.TOPIC_FEED_EVENT, event)
+        self.assertEqual([events[1], events[2]], by_feed)
+        self.assertEqual([events[0], events[1]], by_invoice)
+
+        router.unsubscribe(feed_subscriber_id)
+        router.unsubscribe(invoice_subscriber_id)
+        self.assertEqual({}, router._by_feed)
+        self.assertEqual({}, router._by_invoice)
+        Pubsub.instance.publish(FeedReplay.TOPIC_FEED_EVENT, events[1])
+        self.assertEqual(2, len(by_feed))
+        router.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import argparse
+import csv
+import io
+from .codec import json_codec
+import sqlite3
+import sys
+from contextlib import closing
+from .db import DatabaseParams
+
+EXPORT_FORMAT_NDJSON = "ndjson"
+EXPORT_FORMAT_CSV = "csv"
+EXPORT_FORMATS = [EXPORT_FORMAT_NDJSON, EXPORT_FORMAT_CSV]
+
+EXPORT_COLUMNS = ["invoice_id", "status", "encoded_invoice", "created_at", "amount_requested", "exchange_rate", "expired_at"]
+
+# Number of rows fetched from sqlite and encoded into one chunk.
+EXPORT_ROWS_PER_CHUNK = 500
+
+def iter_invoice_rows(account_id: int, rows_per_fetch: int = EXPORT_ROWS_PER_CHUNK):
+    '''
+    Yield lists of at most @rows_per_fetch rows (tuples of EXPORT_COLUMNS) of @account_id ordered by invoice_id.
+    Rows are stepped from a cursor on a dedicated connection, so only one list is in memory at a time.
+    '''
+    select_template = "SELECT {} FROM invoices WHERE account_id = ? ORDER BY invoice_id".format(", ".join(EXPORT_COLUMNS))
+    with closing(sqlite3.connect(DatabaseParams.get_db_path())) as conn:
+        cursor = conn.execute(select_template, (account_id, ))
+        try:
+            while True:
+                rows = cursor.fetchmany(rows_per_fetch)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+def _encode_ndjson(rows) -> str:
+    return "".join(json_codec.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+
+def _encode_csv(rows, with_header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if with_header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def iter_export_chunks(account_id: int, export_format: str, rows_per_chunk: int = EXPORT_ROWS_PER_CHUNK):
+    '''
+    Yield (text, number of rows in text) for the invoices of @account_id encoded in @export_format.
+    The CSV header is part of the first chunk.
+    '''
+    assert export_format in EXPORT_FORMATS, "Unknown export format {}".format(export_format)
+    rows_iter = iter_invoice_rows(account_id, rows_per_chunk)
+    try:
+        first = True
+        for rows in rows_iter:
+            if export_format == EXPORT_FORMAT_NDJSON:
+                yield _encode_ndjson(rows), len(rows)
+            else:
+                yield _encode_csv(rows, first), len(rows)
+            first = False
+        if first and export_format == EXPORT_FORMAT_CSV:
+            yield _encode_csv([], True), 0
+    finally:
+        rows_iter.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Export invoices of an account to stdout.")
+    parser.add_argument("--account-id", type=int, required=True)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default=EXPORT_FORMAT_NDJSON)
+    parser.add_argument("--db-path", default=DatabaseParams.get_db_path())
+    args = parser.parse_args(argv)
+
+    DatabaseParams.set_db_path(args.db_path)
+    for text, _ in iter_export_chunks(args.account_id, args.format):
+        sys.stdout.write(text)
+
+if __name__ == '__main__':
+    # python -m lightning.invoice_export --account-id 1 --format csv > invoices.csv
+    main(sys.argv[1:])
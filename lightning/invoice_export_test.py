@@ -0,0 +1,49 @@
+import csv
+import io
+import json
+import random
+import unittest
+from .db import DBAccount, DBInvoice, DBUtils
+from .invoice_export import iter_export_chunks, EXPORT_COLUMNS, EXPORT_FORMAT_CSV, EXPORT_FORMAT_NDJSON
+
+class InvoiceExportTest(unittest.TestCase):
+
+    def setUp(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = account.username + "@gmail.com"
+        self.account = DBAccount.create_account(account)
+        self.invoices = []
+        for i in range(5):
+            invoice = DBInvoice()
+            invoice.account_id = self.account.account_id
+            invoice.created_at = 1000 + i
+            invoice.amount_requested = 100 + i
+            invoice.exchange_rate = 2000
+            self.invoices.append(invoice)
+        DBUtils.insert_many(self.invoices, "invoices", id_column_name="invoice_id")
+
+    def tearDown(self):
+        for invoice in self.invoices:
+            DBUtils.delete("invoices", "invoice_id", invoice.invoice_id)
+        DBUtils.delete("accounts", "account_id", self.account.account_id)
+
+    def test_ndjson(self):
+        chunks = list(iter_export_chunks(self.account.account_id, EXPORT_FORMAT_NDJSON, rows_per_chunk=2))
+        self.assertEqual([number_of_rows for _, number_of_rows in chunks], [2, 2, 1])
+        rows = [json.loads(line) for text, _ in chunks for line in text.splitlines()]
+        self.assertEqual([row["invoice_id"] for row in rows], [invoice.invoice_id for invoice in self.invoices])
+        self.assertEqual(rows[1]["amount_requested"], 101)
+
+    def test_csv(self):
+        chunks = list(iter_export_chunks(self.account.account_id, EXPORT_FORMAT_CSV, rows_per_chunk=3))
+        rows = list(csv.reader(io.StringIO("".join(text for text, _ in chunks))))
+        self.assertEqual(rows[0], EXPORT_COLUMNS)
+        self.assertEqual([int(row[0]) for row in rows[1:]], [invoice.invoice_id for invoice in self.invoices])
+
+    def test_csvWithoutInvoices(self):
+        chunks = list(iter_export_chunks(0, EXPORT_FORMAT_CSV))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0][1], 0)
+        self.assertEqual(list(csv.reader(io.StringIO(chunks[0][0]))), [EXPORT_COLUMNS])
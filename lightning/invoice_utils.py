@@ -1,8 +1,12 @@
 
 from werkzeug.exceptions import BadRequest, InternalServerError
-from .db import DBInvoice
-import lightning.market
+from .db import DBInvoice, DBInvoicePoolItem, DBUtils
+from .lightning import AsyncLightningNode, LightningMonitor, invoice_label, invoice_msatoshi
+from . import market
+import asyncio
+import sqlite3
 import time
+import typing
 import logging
 from .pubsub import Pubsub
 from .config import Config
@@ -17,27 +21,55 @@ class InvoiceGenerator():
     def __init__(self):
         self.pending_invoice = None
         self.created_invoice = None
+        # See generate.
+        self.idempotency_key = None
 
     def _exchange_info(self):
         return market.exchange_info()
 
     def _db_create_invoice(self, new_invoice: DBInvoice):
         try:
-            return DBInvoice.create_invoice(new_invoice)
+            return DBInvoice.create_invoice(new_invoice, self.idempotency_key)
+        except sqlite3.IntegrityError:
+            if self.idempotency_key is not None:
+                raise
+            LOGGER.debug("Failed to create invoice: integrity error")
         except Exception as e:
             LOGGER.debug("Failed to create invoice: " + str(e))
 
-    def _add_pending_invoice_to_state_callback(self):
+    def _add_pending_invoice_to_state_callback(self, new_invoice: DBInvoice):
+        # Matched on @new_invoice, whose invoice_id is set once inserted, since LightningMonitor may publish
+        # "/invoice/pending" from within DBInvoice.create_invoice, before self.created_invoice is set.
         def on_topic(topic, pending_invoice):
             assert topic == "/invoice/pending"
-            if self.created_invoice.invoice_id == pending_invoice.invoice_id:
+            if new_invoice.invoice_id and new_invoice.invoice_id == pending_invoice.invoice_id:
                 self.pending_invoice = pending_invoice
         return on_topic
 
-    def generate(self, account_id: int, amount_requested: int):
+    def _claim_pooled_invoice(self, account_id: int, amount_requested: int, idempotency_key: str):
+        """
+        @return: the invoice claimed from the pool of @amount_requested of @account_id, see DBInvoicePool, or None.
+        """
+        now = int(time.time())
+        claimed = DBInvoicePoolItem.claim(account_id, amount_requested, now + Config.InvoicePoolMinRemainingSeconds, now, idempotency_key)
+        if claimed is None:
+            return None
+        # LightningMonitor watches it and publishes "/invoice/pending".
+        Pubsub.instance.publish("/invoice/claimed", claimed)
+        return claimed[0]
+
+    def generate(self, account_id: int, amount_requested: int, idempotency_key: str = None):
         """
         Call once per instance.
+        An invoice ready in the pool of @amount_requested of @account_id is returned right away, otherwise one is
+        created on the node.
+        @idempotency_key: see DBInvoice.create_invoice.
+        @raise sqlite3.IntegrityError: if the account already used @idempotency_key.
         """
+        pooled_invoice = self._claim_pooled_invoice(account_id, amount_requested, idempotency_key)
+        if pooled_invoice is not None:
+            return invoice_result(pooled_invoice)
+
         # Build the invoice
         new_invoice = DBInvoice()
         new_invoice.amount_requested = amount_requested
@@ -50,9 +82,10 @@ class InvoiceGenerator():
         new_invoice.exchange_rate = exchange_info["sat_per_usd"]
         new_invoice.created_at = int(time.time())
         new_invoice.account_id = account_id
+        self.idempotency_key = idempotency_key
         
         # Subcribe to pending invoice topic which would add the pending invoice to our state.
-        subscriber_id = Pubsub.instance.subscribe("/invoice/pending", self._add_pending_invoice_to_state_callback())
+        subscriber_id = Pubsub.instance.subscribe("/invoice/pending", self._add_pending_invoice_to_state_callback(new_invoice))
         try:
             # Insert the invoice into DB.
             self.created_invoice = self._db_create_invoice(new_invoice)
@@ -68,12 +101,206 @@ class InvoiceGenerator():
                 time.sleep(0.1)
         
             # Ready
-            return {
-                "invoice_id": self.pending_invoice.invoice_id,
-                "encoded_invoice": self.pending_invoice.encoded_invoice,
-                "amount_requested": self.pending_invoice.amount_requested,
-                "exchange_rate": self.pending_invoice.exchange_rate,
-                "expired_at": self.pending_invoice.expired_at
-            }
+            return invoice_result(self.pending_invoice)
+        except Exception:
+            if new_invoice.invoice_id and self.pending_invoice is None:
+                # Inserted but never made pending, e.g. the node call failed. Released, so that a retry with
+                # @idempotency_key creates another invoice instead of getting this one.
+                DBInvoice.fail_invoices([new_invoice.invoice_id])
+            raise
         finally:
             Pubsub.instance.unsubscribe(subscriber_id)
+
+def invoice_result(invoice: DBInvoice) -> dict:
+    return {
+        "invoice_id": invoice.invoice_id,
+        "status": invoice.status,
+        "encoded_invoice": invoice.encoded_invoice,
+        "amount_requested": invoice.amount_requested,
+        "exchange_rate": invoice.exchange_rate,
+        "expired_at": invoice.expired_at
+    }
+
+class IdempotencyKeyConflict(Exception):
+    def __init__(self, error_message):
+        Exception.__init__(self, error_message)
+
+class IdempotentInvoiceCreator():
+    '''
+    Creates invoices once per (account, idempotency key), so that a client retrying create_invoice e.g. after a
+    timeout gets the invoice of its first request instead of another one.
+    Requests with a key that is being created share its creation, and the later ones read the invoice recorded with
+    the key in invoice_requests, whose primary key also settles races between processes.
+    Used from the event loop. InvoiceGenerator.generate, which blocks, runs in the default executor.
+    '''
+    instance = None
+
+    def __init__(self, generator_factory = InvoiceGenerator):
+        self._generator_factory = generator_factory
+        self._in_flight: typing.Dict[tuple, asyncio.Future] = {}
+
+    async def create(self, account_id: int, amount_requested: int, idempotency_key: str) -> dict:
+        '''
+        @return: see invoice_result.
+        @raise IdempotencyKeyConflict: if @idempotency_key was used for an invoice of another amount.
+        '''
+        key = (account_id, idempotency_key)
+        future = self._in_flight.get(key, None)
+        if future is None:
+            future = asyncio.ensure_future(self._create(account_id, amount_requested, idempotency_key))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shielded, so that a caller cancelled e.g. at its deadline does not cancel the creation shared with the others.
+        invoice = await asyncio.shield(future)
+        if invoice["amount_requested"] != amount_requested:
+            raise IdempotencyKeyConflict("idempotency_key {} was used for an invoice of {}".format(idempotency_key, invoice["amount_requested"]))
+        return invoice
+
+    async def _create(self, account_id: int, amount_requested: int, idempotency_key: str) -> dict:
+        invoice = DBInvoice.get_invoice_by_idempotency_key(account_id, idempotency_key)
+        if invoice is not None:
+            return invoice_result(invoice)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, 
+                self._generator_factory().generate, account_id, amount_requested, idempotency_key)
+        except sqlite3.IntegrityError:
+            # Created by another process meanwhile.
+            invoice = DBInvoice.get_invoice_by_idempotency_key(account_id, idempotency_key)
+            if invoice is None:
+                raise
+            return invoice_result(invoice)
+
+IdempotentInvoiceCreator.instance = IdempotentInvoiceCreator()
+
+
+class BulkInvoiceCreator():
+    '''
+    Creates many invoices of an account at once. The rows are inserted in one transaction, the node invoices are
+    created concurrently, at most @max_concurrent_node_calls at a time across all requests, and the rows are then
+    made pending in one transaction. Invoices whose node call failed are marked "failed" and their idempotency keys
+    released, so that retrying with the keys creates them, see DBInvoice.fail_invoices.
+    Used from the event loop.
+    '''
+    instance = None
+
+    def __init__(self, lightning_node: AsyncLightningNode = None, exchange_info = market.exchange_info, 
+            max_concurrent_node_calls: int = Config.CreateInvoicesMaxConcurrentNodeCalls):
+        self._lightning_node = lightning_node if lightning_node is not None else AsyncLightningNode()
+        self._exchange_info = exchange_info
+        self._max_concurrent_node_calls = max_concurrent_node_calls
+        self._node_calls_semaphore = None
+        self._node_calls_loop = None
+
+    async def create(self, account_id: int, items: list) -> list:
+        '''
+        @items: [(amount_requested, idempotency_key or None)]
+        @return: for each of @items, in order, either an invoice_result or an exception. Items with the key of an
+            earlier item of @items, or of an invoice created before, get that invoice.
+        '''
+        return await self._create(account_id, items, True)
+
+    async def _create(self, account_id: int, items: list, retry_on_conflict: bool) -> list:
+        results = [None] * len(items)
+        new_indexes = self._use_existing_invoices(account_id, items, results)
+        if not new_indexes:
+            return results
+
+        exchange_info = await asyncio.get_running_loop().run_in_executor(None, self._exchange_info)
+        if not exchange_info["sat_per_usd"]:
+            raise InternalServerError("Failed to get exchange info")
+        now = int(time.time())
+        invoices = []
+        for index in new_indexes:
+            invoice = DBInvoice()
+            invoice.amount_requested = items[index][0]
+            invoice.exchange_rate = exchange_info["sat_per_usd"]
+            invoice.created_at = now
+            invoice.account_id = account_id
+            invoices.append(invoice)
+        try:
+            DBInvoice.insert_invoices(invoices, [items[index][1] for index in new_indexes])
+        except sqlite3.IntegrityError:
+            if not retry_on_conflict:
+                raise
+            # A key was used by another request meanwhile. Its invoice is used instead.
+            return await self._create(account_id, items, False)
+
+        semaphore = self._node_calls_semaphore_of_loop()
+        async def create_node_invoice(invoice: DBInvoice):
+            async with semaphore:
+                return await self._lightning_node.invoice(invoice_label(invoice), invoice_msatoshi(invoice), "", 
+                    LightningMonitor.INVOICE_EXPIRY)
+        try:
+            node_invoices = await asyncio.gather(*[create_node_invoice(invoice) for invoice in invoices], return_exceptions=True)
+        except BaseException:
+            # Cancelled e.g. at the deadline of the request.
+            DBInvoice.fail_invoices([invoice.invoice_id for invoice in invoices])
+            raise
+
+        updates = []
+        failed_invoice_ids = []
+        with DBUtils.transaction():
+            for invoice, node_invoice in zip(invoices, node_invoices):
+                if isinstance(node_invoice, Exception):
+                    LOGGER.debug("Failed to create invoice {} on the node: {}".format(invoice.invoice_id, str(node_invoice)))
+                    failed_invoice_ids.append(invoice.invoice_id)
+                    continue
+                invoice.status = "pending"
+                invoice.encoded_invoice, invoice.expired_at = node_invoice
+                updates.append(({"status": invoice.status, "encoded_invoice": invoice.encoded_invoice, "expired_at": invoice.expired_at}, 
+                    invoice.invoice_id))
+            DBUtils.update_many("invoices", updates, "invoice_id")
+            DBInvoice.fail_invoices(failed_invoice_ids)
+
+        for index, invoice, node_invoice in zip(new_indexes, invoices, node_invoices):
+            if isinstance(node_invoice, Exception):
+                results[index] = node_invoice
+            else:
+                # LightningMonitor watches it and publishes "/invoice/pending".
+                Pubsub.instance.publish("/invoice/claimed", (invoice, invoice_label(invoice)))
+                results[index] = invoice_result(invoice)
+        for index, (_, idempotency_key) in enumerate(items):
+            if results[index] is None:
+                results[index] = self._result_of_key(results, items, idempotency_key, items[index][0])
+        return results
+
+    def _node_calls_semaphore_of_loop(self) -> asyncio.Semaphore:
+        # Shared by all the requests. Made once per event loop, since a semaphore can only be used from one.
+        loop = asyncio.get_running_loop()
+        if self._node_calls_loop is not loop:
+            self._node_calls_semaphore = asyncio.Semaphore(self._max_concurrent_node_calls)
+            self._node_calls_loop = loop
+        return self._node_calls_semaphore
+
+    def _use_existing_invoices(self, account_id: int, items: list, results: list) -> list:
+        '''
+        Set @results of the items whose key was used before.
+        @return: indexes of the items to create i.e. without a key used before, or with the first use of a key in @items.
+        '''
+        keys = list(dict.fromkeys(idempotency_key for _, idempotency_key in items if idempotency_key is not None))
+        existing_invoices = DBInvoice.get_invoices_by_idempotency_keys(account_id, keys)
+        new_indexes = []
+        new_keys = set()
+        for index, (amount_requested, idempotency_key) in enumerate(items):
+            if idempotency_key in existing_invoices:
+                invoice = existing_invoices[idempotency_key]
+                if invoice.amount_requested != amount_requested:
+                    results[index] = IdempotencyKeyConflict("idempotency_key {} was used for an invoice of {}".format(
+                        idempotency_key, invoice.amount_requested))
+                else:
+                    results[index] = invoice_result(invoice)
+            elif idempotency_key is None or idempotency_key not in new_keys:
+                new_keys.add(idempotency_key)
+                new_indexes.append(index)
+        return new_indexes
+
+    def _result_of_key(self, results: list, items: list, idempotency_key: str, amount_requested: int):
+        for index, (_, key) in enumerate(items):
+            if key == idempotency_key and results[index] is not None:
+                first = results[index]
+                if not isinstance(first, Exception) and first["amount_requested"] != amount_requested:
+                    return IdempotencyKeyConflict("idempotency_key {} was used for an invoice of {}".format(
+                        idempotency_key, first["amount_requested"]))
+                return first
+
+BulkInvoiceCreator.instance = BulkInvoiceCreator()
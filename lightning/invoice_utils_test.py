@@ -1,8 +1,13 @@
-from .invoice_utils import InvoiceGenerator
+from .invoice_utils import BulkInvoiceCreator, IdempotencyKeyConflict, IdempotentInvoiceCreator, InvoiceGenerator, invoice_result
+import asyncio
+import random
+import sqlite3
+import time
 from .pubsub import Pubsub
 from copy import copy
 import unittest
 from .db import DBInvoice
+from .lightning import LightningMonitor, LightningNode
 from threading import Timer
 from .auth import JwtTokenUtils, JwtTokenPayload
 
@@ -36,3 +41,174 @@ class InvoiceGeneratorTest(unittest.TestCase):
         self.assertEqual(invoice["expired_at"], 1023508393)
         self.assertEqual(invoice["amount_requested"], 1000)
         self.assertEqual(invoice["exchange_rate"], 2000)
+
+    def test_generateWithMonitor(self):
+        class DummyLightningNode(LightningNode):
+            def invoice(self, invoice_label, msatoshi, description, expiry):
+                return "encoded-" + invoice_label, 1023508393
+            def invoice_status(self, invoice_label):
+                return "unpaid"
+
+        class InvoiceGeneratorUnderTest(InvoiceGenerator):
+            def _exchange_info(self):
+                return {"sat_per_usd": 2000}
+
+        # The monitor creates the node invoice and publishes "/invoice/pending" within DBInvoice.create_invoice.
+        Pubsub.instance = Pubsub()
+        LightningMonitor(lightning_node=DummyLightningNode())
+        account_id = random.randint(1, 10e12)
+        invoice = InvoiceGeneratorUnderTest().generate(account_id, 1000, "a")
+        self.assertEqual(invoice["status"], "pending")
+        self.assertEqual(invoice["encoded_invoice"], DBInvoice.get_invoice_by_id(invoice["invoice_id"]).encoded_invoice)
+        self.assertEqual(invoice["invoice_id"], DBInvoice.get_invoice_by_idempotency_key(account_id, "a").invoice_id)
+
+class IdempotentInvoiceCreatorTest(unittest.TestCase):
+    def test_create(self):
+        generated = []
+        class MockInvoiceGenerator():
+            def generate(self, account_id, amount_requested, idempotency_key):
+                generated.append(idempotency_key)
+                time.sleep(0.1)
+                invoice = DBInvoice()
+                invoice.account_id = account_id
+                invoice.status = "pending"
+                invoice.encoded_invoice = "encoded-" + idempotency_key
+                invoice.created_at = int(time.time())
+                invoice.amount_requested = amount_requested
+                invoice.exchange_rate = 2000
+                invoice.expired_at = invoice.created_at + 600
+                return invoice_result(DBInvoice.create_invoice(invoice, idempotency_key))
+
+        Pubsub.instance = Pubsub()
+        creator = IdempotentInvoiceCreator(MockInvoiceGenerator)
+        account_id = random.randint(1, 10e12)
+        async def run():
+            # Concurrent duplicates share one creation.
+            invoices = await asyncio.gather(creator.create(account_id, 1000, "a"), creator.create(account_id, 1000, "a"), 
+                creator.create(account_id, 1000, "b"))
+            self.assertEqual(invoices[0], invoices[1])
+            self.assertNotEqual(invoices[0]["invoice_id"], invoices[2]["invoice_id"])
+            self.assertEqual(sorted(generated), ["a", "b"])
+
+            # Retries return the invoice of the first request, from the DB.
+            self.assertEqual(invoices[0], await creator.create(account_id, 1000, "a"))
+            self.assertEqual(len(generated), 2)
+            with self.assertRaises(IdempotencyKeyConflict):
+                await creator.create(account_id, 2000, "a")
+
+            # A caller cancelled at its deadline does not cancel the creation.
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(creator.create(account_id, 1000, "c"), 0.01)
+            invoice = await creator.create(account_id, 1000, "c")
+            self.assertEqual(invoice["encoded_invoice"], "encoded-c")
+            self.assertEqual(len(generated), 3)
+        asyncio.run(run())
+
+        # Keys are per account.
+        self.assertIsNone(DBInvoice.get_invoice_by_idempotency_key(account_id + 1, "a"))
+        with self.assertRaises(sqlite3.IntegrityError):
+            MockInvoiceGenerator().generate(account_id, 1000, "a")
+
+    def test_retryAfterFailure(self):
+        class FailingOnceLightningNode(LightningNode):
+            def __init__(self):
+                self.calls = 0
+            def invoice(self, invoice_label, msatoshi, description, expiry):
+                self.calls += 1
+                if self.calls == 1:
+                    raise Exception("node failure")
+                return "encoded-" + invoice_label, 1023508393
+            def invoice_status(self, invoice_label):
+                return "unpaid"
+
+        class InvoiceGeneratorUnderTest(InvoiceGenerator):
+            def _exchange_info(self):
+                return {"sat_per_usd": 2000}
+
+        Pubsub.instance = Pubsub()
+        LightningMonitor(lightning_node=FailingOnceLightningNode())
+        creator = IdempotentInvoiceCreator(InvoiceGeneratorUnderTest)
+        account_id = random.randint(1, 10e12)
+        async def run():
+            with self.assertRaises(Exception):
+                await creator.create(account_id, 1000, "a")
+            self.assertIsNone(DBInvoice.get_invoice_by_idempotency_key(account_id, "a"))
+            return await creator.create(account_id, 1000, "a")
+        invoice = asyncio.run(run())
+        self.assertEqual(invoice["status"], "pending")
+        # The failed invoice is kept, so that its invoice_id is not reused.
+        self.assertEqual(len(DBInvoice.list_invoices(account_id, 0, 10, statuses=["failed"])), 1)
+
+class BulkInvoiceCreatorTest(unittest.TestCase):
+    def test_create(self):
+        class MockAsyncLightningNode():
+            def __init__(self):
+                self.concurrent_calls = 0
+                self.max_concurrent_calls = 0
+                self.labels = []
+            async def invoice(self, invoice_label, msatoshi, description, expiry):
+                self.concurrent_calls += 1
+                self.max_concurrent_calls = max(self.max_concurrent_calls, self.concurrent_calls)
+                try:
+                    await asyncio.sleep(0.01)
+                    self.labels.append(invoice_label)
+                    if msatoshi == 3 * 2000 * 1000:
+                        raise Exception("node failure")
+                    return "encoded-" + invoice_label, 1023508393
+                finally:
+                    self.concurrent_calls -= 1
+
+        Pubsub.instance = Pubsub()
+        claimed = []
+        Pubsub.instance.subscribe("/invoice/claimed", lambda topic, payload: claimed.append(payload))
+        node = MockAsyncLightningNode()
+        creator = BulkInvoiceCreator(node, lambda: {"sat_per_usd": 2000}, max_concurrent_node_calls=2)
+        account_id = random.randint(1, 10e12)
+        items = [(1, "a"), (2, None), (3, "c"), (1, "a"), (4, "a"), (5, None)]
+        results = asyncio.run(creator.create(account_id, items))
+
+        self.assertEqual(node.max_concurrent_calls, 2)
+        self.assertEqual(len(node.labels), 4)
+        self.assertEqual([result["amount_requested"] for result in [results[0], results[1], results[5]]], [1, 2, 5])
+        for result in [results[0], results[1], results[5]]:
+            self.assertEqual(result["status"], "pending")
+            self.assertEqual(result["expired_at"], 1023508393)
+            self.assertEqual(DBInvoice.get_invoice_by_id(result["invoice_id"]).encoded_invoice, result["encoded_invoice"])
+        self.assertEqual(sorted(invoice.invoice_id for invoice, _ in claimed), 
+            sorted(result["invoice_id"] for result in [results[0], results[1], results[5]]))
+        # The failed invoice is kept and its key released, so that it is created again on retry.
+        self.assertIsInstance(results[2], Exception)
+        self.assertIsNone(DBInvoice.get_invoice_by_idempotency_key(account_id, "c"))
+        self.assertEqual([invoice.amount_requested for invoice in DBInvoice.list_invoices(account_id, 0, 10, statuses=["failed"])], [3])
+        # Duplicate keys share the invoice.
+        self.assertEqual(results[3], results[0])
+        self.assertIsInstance(results[4], IdempotencyKeyConflict)
+
+        # Retries return the invoices created before.
+        results = asyncio.run(creator.create(account_id, [(1, "a"), (4, "d")]))
+        self.assertEqual(results[0]["invoice_id"], DBInvoice.get_invoice_by_idempotency_key(account_id, "a").invoice_id)
+        self.assertEqual(results[1]["amount_requested"], 4)
+        self.assertEqual(len(node.labels), 5)
+
+    def test_maxConcurrentNodeCallsAcrossRequests(self):
+        class MockAsyncLightningNode():
+            def __init__(self):
+                self.concurrent_calls = 0
+                self.max_concurrent_calls = 0
+            async def invoice(self, invoice_label, msatoshi, description, expiry):
+                self.concurrent_calls += 1
+                self.max_concurrent_calls = max(self.max_concurrent_calls, self.concurrent_calls)
+                try:
+                    await asyncio.sleep(0.01)
+                    return "encoded-" + invoice_label, 1023508393
+                finally:
+                    self.concurrent_calls -= 1
+
+        Pubsub.instance = Pubsub()
+        node = MockAsyncLightningNode()
+        creator = BulkInvoiceCreator(node, lambda: {"sat_per_usd": 2000}, max_concurrent_node_calls=2)
+        account_id = random.randint(1, 10e12)
+        async def run():
+            return await asyncio.gather(*[creator.create(account_id, [(1, None), (2, None)]) for _ in range(3)])
+        asyncio.run(run())
+        self.assertEqual(node.max_concurrent_calls, 2)
@@ -1,10 +1,15 @@
+import asyncio
 import time
+from .account_cache import AccountCache
+from .codec import Codec, json_codec
 
 JSONRPC_ERROR_CODE_PARSE_ERROR = -32700
 JSONRPC_ERROR_CODE_INVALID_REQUEST = -32600
 JSONRPC_ERROR_CODE_METHOD_NOT_FOUND = -32601
 JSONRPC_ERROR_CODE_INVALID_PARAMS = -32602
 JSONRPC_ERROR_CODE_INTERNAL_ERROR = -32603
+# Server error, the request did not complete before its deadline.
+JSONRPC_ERROR_CODE_TIMEOUT = -32001
 
 class JsonRpcException(Exception):
     def __init__(self, error_message, code, message_to_client: str = ""):
@@ -14,15 +19,50 @@ class JsonRpcException(Exception):
         self.message_to_client = message_to_client
 
 class WebSocketSend():
-    async def send(self, data:str):
+    # Encoding of the messages of the websocket, see codec.py.
+    codec: Codec = json_codec
+
+    async def send(self, data):
         raise NotImplementedError("Must be implemented")
 
+    async def send_message(self, message):
+        '''
+        @message: JSON-RPC object to encode with self.codec and send.
+        '''
+        await self.send(self.codec.dumps(message))
+
+    def is_congested(self) -> bool:
+        '''
+        @return: True if messages are sent faster than the remote reads them. Feeds then hold back and coalesce their items.
+        '''
+        return False
+
+    async def wait_uncongested(self):
+        '''
+        Wait until is_congested() may have changed.
+        '''
+        await asyncio.sleep(0)
+
 class JsonRpcRequest():
-    def __init__(self, jsonrpc, method, params, id):
+    def __init__(self, jsonrpc, method, params, id, websocket_send: WebSocketSend = None):
         self.jsonrpc = jsonrpc
         self.method = method
         self.params = params
         self.id = id
+        # Where the response to this request goes, e.g. to be collected with the other responses of a batch.
+        # If None, the handler's websocket. Notifications that are not responses, e.g. feeds, always go to the websocket.
+        self.websocket_send = websocket_send
+        # In seconds, and event loop time. Set by JsonRpc, which cancels the request at the deadline.
+        self.timeout = None
+        self.deadline = None
+
+    def keep_alive(self):
+        '''
+        Move the deadline of the request, if any, to timeout seconds from now. Called by streams on each chunk, so that
+        a stream times out when it stalls rather than when it is long.
+        '''
+        if self.deadline is not None:
+            self.deadline = asyncio.get_running_loop().time() + self.timeout
 
 class JsonRpcHandler():
     def can_handle(request: JsonRpcRequest) -> bool: 
@@ -39,6 +79,25 @@ class JsonRpcSession():
         # Auth related. If not None, then account_id is the login user for the websocket.
         self.account_id = None
         self.exp = 0
+        # Entry of AccountCache for account_id.
+        self._cached_account = None
+
+    def set_auth(self, account_id, exp):
+        self.account_id = account_id
+        self.exp = exp
+        self._cached_account = None
+
+    def get_account(self):
+        '''
+        @return: DBAccount of the authenticated account. Shared with other sessions; do not modify.
+        '''
+        self.check_auth()
+        cache = AccountCache.instance
+        if self._cached_account is None or not self._cached_account.is_valid(cache.ttl):
+            self._cached_account = cache.get(self.account_id)
+            if self._cached_account is None:
+                raise JsonRpcException("Account {} is not found".format(self.account_id), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Please authenticate")
+        return self._cached_account.account
     
     def check_auth(self):
         if not self.account_id or self.exp < int(time.time()):
@@ -1,16 +1,27 @@
 import asyncio
+from .codec import CodecDecodeError, codec_for_subprotocol
 from .config import Config
+from .outbound_queue import OutboundQueue
 import websockets
 import json
+import base64
+import inspect
 from websockets.server import WebSocketServerProtocol
 import logging
 import os
 import typing
 from .auth import JwtTokenDecodeError, JwtTokenUtils, JwtTokenPayload
 import time
-from .db import DBAccount
+from .db import DBAccount, DBInvoice, DBInvoicePool, DBAccountDailyStats
+from .account_cache import AccountCache
+from .connection_registry import ConnectionLimitError, ConnectionRegistry
+from .invoice_export import EXPORT_FORMAT_NDJSON, EXPORT_FORMATS, iter_export_chunks
+from .invoice_utils import BulkInvoiceCreator, IdempotencyKeyConflict, IdempotentInvoiceCreator
+from .feed_handler import FeedHandler
+from .feed_filter import INVOICE_STATUSES
 from .jsonrpc_handler import JsonRpcException, WebSocketSend, JsonRpcRequest, JsonRpcHandler, JsonRpcSession
 from .jsonrpc_handler import JSONRPC_ERROR_CODE_PARSE_ERROR, JSONRPC_ERROR_CODE_INVALID_REQUEST, JSONRPC_ERROR_CODE_METHOD_NOT_FOUND, JSONRPC_ERROR_CODE_INVALID_PARAMS, JSONRPC_ERROR_CODE_INTERNAL_ERROR
+from .jsonrpc_handler import JSONRPC_ERROR_CODE_TIMEOUT
 
 # TODO: Move this to a top level code.
 logging.basicConfig(format='%(filename)s:%(funcName)s:%(levelname)s:%(message)s')
@@ -21,22 +32,61 @@ LOGGER.setLevel(Config.LoggingLevel)
 class WebSocketServerProtocolWrapper(WebSocketSend):
     def __init__(self, websocket: WebSocketServerProtocol):
         self.websocket = websocket
-        self.messages = websocket.messages
+        self.codec = codec_for_subprotocol(getattr(websocket, "subprotocol", None))
+        self.outbound_queue = OutboundQueue(websocket)
 
-    async def send(self, data:str):
-        return await self.websocket.send(data)
+    async def send(self, data):
+        await self.outbound_queue.send(data)
+
+    def is_congested(self) -> bool:
+        return self.outbound_queue.is_congested()
+
+    async def wait_uncongested(self):
+        await self.outbound_queue.wait_uncongested()
+
+    def close(self):
+        self.outbound_queue.close()
     
     async def recv(self):
         return await self.websocket.recv()
-    
-    async def close():
-        return await self.websocket.close()
+
+def _encode_list_invoices_cursor(after_invoice_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": after_invoice_id}).encode("ascii")).decode("ascii")
+
+def _decode_list_invoices_cursor(cursor: str) -> int:
+    try:
+        after_invoice_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["after"]
+    except Exception as e:
+        raise JsonRpcException("Invalid cursor {}: {}".format(cursor, str(e)), JSONRPC_ERROR_CODE_INVALID_PARAMS, "Invalid cursor")
+    if type(after_invoice_id) != int:
+        raise JsonRpcException("Invalid cursor {}".format(cursor), JSONRPC_ERROR_CODE_INVALID_PARAMS, "Invalid cursor")
+    return after_invoice_id
+
+def _check_create_invoice_params(amount_requested, idempotency_key, idempotency_key_optional: bool = False):
+    if type(amount_requested) != int or amount_requested <= 0:
+        msg = "amount_requested must be a positive number of cents"
+        raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+    if idempotency_key is None and idempotency_key_optional:
+        return
+    if type(idempotency_key) != str or not idempotency_key or \
+            len(idempotency_key) > JsonRpcHandlerImpl.CREATE_INVOICE_MAX_IDEMPOTENCY_KEY_LENGTH:
+        msg = "idempotency_key must be a string of 1 to {} characters".format(JsonRpcHandlerImpl.CREATE_INVOICE_MAX_IDEMPOTENCY_KEY_LENGTH)
+        raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
 
 class JsonRpcHandlerImpl(JsonRpcHandler):
     '''
     The names of JSON RPC method in this class have the form "_jsonrpc_{method_name}". "method_name"
     is the name that exposed to outside. For example def _jsonrpc_echo(self), "echo" is the method.
+
+    A method may be an async generator to stream a large result. Every value it yields except the last is sent
+    as a notification {"jsonrpc": "2.0", "method": "stream", "params": {"id": request_id, "result": value}}, and
+    the last value is the result of the response.
     '''
+    LIST_INVOICES_MAX_LIMIT = 1000
+    # Number of invoices read from the DB and sent to the remote at a time.
+    LIST_INVOICES_CHUNK_SIZE = 100
+    CREATE_INVOICE_MAX_IDEMPOTENCY_KEY_LENGTH = 64
+
     def __init__(self, websocket_send: WebSocketSend, jsonrpc_session: JsonRpcSession):
         self.jsonrpc_session = jsonrpc_session
         self.websocket_send = websocket_send
@@ -55,22 +105,47 @@ class JsonRpcHandlerImpl(JsonRpcHandler):
         This is option 1 in https://websockets.readthedocs.io/en/stable/topics/authentication.html#sending-credentials
         '''
         try:
-            payload = JwtTokenUtils().verify_and_extract_payload(jwt_token)
+            jwt_token_utils = JwtTokenUtils()
+            payload = jwt_token_utils.verify_and_extract_payload(jwt_token)
             if payload.exp < int(time.time()):
-                raise JsonRpcException("Token has expired: {}".format(exp), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Token has expired")
+                raise JsonRpcException("Token has expired: {}".format(payload.exp), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Token has expired")
 
-            account = DBAccount.get_account_by_username(payload.sub)
+            # Re-authentication with a known token, e.g. reconnects, skips the DB.
+            account_id = jwt_token_utils.get_cached_account_id(jwt_token)
+            if account_id is None:
+                generation = AccountCache.instance.generation()
+                account = DBAccount.get_account_by_username(payload.sub)
+                if account is None:
+                    raise JsonRpcException("Account {} is not found".format(payload.sub), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Invalid JWT Token")
+                account_id = account.account_id
+                jwt_token_utils.set_cached_account_id(jwt_token, account_id)
+                AccountCache.instance.put(account, generation)
         except JwtTokenDecodeError as decode_error:
-            raise JsonRpcException("JwtTokenDecodeError: " + decode_error.error_message, JSONRPC_ERROR_CODE_INVALID_REQUEST, "Invalid JWT Token")
+            raise JsonRpcException("JwtTokenDecodeError: " + str(decode_error), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Invalid JWT Token")
         except JsonRpcException as jsonrpc_error:
             raise jsonrpc_error
         except Exception as e:
             raise JsonRpcException(str(e), JSONRPC_ERROR_CODE_INTERNAL_ERROR)
-        
-        self.jsonrpc_session.account_id = account.account_id
-        self.jsonrpc_session.exp = payload.exp
+
+        try:
+            ConnectionRegistry.instance.set_account(self.jsonrpc_session, account_id)
+        except ConnectionLimitError as e:
+            raise JsonRpcException(str(e), JSONRPC_ERROR_CODE_INVALID_REQUEST, "Too many connections")
+        self.jsonrpc_session.set_auth(account_id, payload.exp)
         return "ok"
 
+    async def _jsonrpc_get_account(self):
+        '''
+        Profile of the authenticated account.
+        '''
+        account = self.jsonrpc_session.get_account()
+        return {
+            "account_id": account.account_id,
+            "username": account.username,
+            "email": account.email,
+            "mailing_address": account.mailing_address
+        }
+
     '''
     Knowledge on `await` (ref https://www.python.org/dev/peps/pep-0492/#await-expression):
     The following new await expression is used to obtain a result of coroutine execution:
@@ -89,21 +164,218 @@ class JsonRpcHandlerImpl(JsonRpcHandler):
         print("echo after asyncio.sleep")
         return msg
 
+    async def _jsonrpc_list_invoices(self, cursor: str = "", limit: int = 100, status: list = None,
+            created_from: int = None, created_to: int = None):
+        '''
+        List invoices of the authenticated account ordered by invoice_id, streamed in chunks of LIST_INVOICES_CHUNK_SIZE.
+        @cursor: opaque. "" for the first page, otherwise next_cursor of the previous page.
+        @status: list of invoice statuses to include. All statuses if empty.
+        @created_from, @created_to: include invoices with created_from <= created_at < created_to.
+        Each chunk is {"invoices": [...]}. The last one also has "next_cursor", which is "" when there are no more invoices.
+        '''
+        self.jsonrpc_session.check_auth()
+        if type(limit) != int or limit < 1 or limit > JsonRpcHandlerImpl.LIST_INVOICES_MAX_LIMIT:
+            msg = "limit must be between 1 and {}".format(JsonRpcHandlerImpl.LIST_INVOICES_MAX_LIMIT)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        if status is not None and (type(status) != list or any(s not in INVOICE_STATUSES for s in status)):
+            msg = "status must be a list of {}".format(", ".join(INVOICE_STATUSES))
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        for name, value in [("created_from", created_from), ("created_to", created_to)]:
+            if value is not None and type(value) != int:
+                msg = "{} must be an integer".format(name)
+                raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        if created_from is not None and created_to is not None and created_from > created_to:
+            msg = "created_from must not be after created_to"
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        after_invoice_id = _decode_list_invoices_cursor(cursor) if cursor else 0
+
+        remaining = limit
+        while True:
+            chunk_size = min(remaining, self.LIST_INVOICES_CHUNK_SIZE)
+            invoices = DBInvoice.list_invoices(self.jsonrpc_session.account_id, after_invoice_id, chunk_size,
+                status, created_from, created_to)
+            remaining -= len(invoices)
+            if invoices:
+                after_invoice_id = invoices[-1].invoice_id
+            chunk = {"invoices": [vars(invoice) for invoice in invoices]}
+            if len(invoices) < chunk_size:
+                chunk["next_cursor"] = ""
+                yield chunk
+                return
+            if remaining == 0:
+                chunk["next_cursor"] = _encode_list_invoices_cursor(after_invoice_id)
+                yield chunk
+                return
+            yield chunk
+
+    async def _jsonrpc_export_invoices(self, format: str = EXPORT_FORMAT_NDJSON):
+        '''
+        Export all invoices of the authenticated account, streamed as {"format": format, "data": text} chunks of
+        NDJSON lines or CSV rows. The result is {"format": format, "rows": number of rows exported}.
+        A chunk is read from the DB only after the previous one is handed to the websocket, so a slow remote
+        slows down the export instead of growing the memory.
+        '''
+        self.jsonrpc_session.check_auth()
+        if format not in EXPORT_FORMATS:
+            msg = "format must be one of {}".format(", ".join(EXPORT_FORMATS))
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+
+        exported_rows = 0
+        chunks = iter_export_chunks(self.jsonrpc_session.account_id, format)
+        try:
+            for text, number_of_rows in chunks:
+                exported_rows += number_of_rows
+                yield {"format": format, "data": text}
+        finally:
+            chunks.close()
+        yield {"format": format, "rows": exported_rows}
+
+    async def _jsonrpc_create_invoice(self, amount_requested: int, idempotency_key: str):
+        '''
+        Create an invoice of @amount_requested USD in cents for the authenticated account.
+        @idempotency_key: chosen by the client e.g. a UUID. A request with a key that was already used, e.g. a retry
+            after a timeout, returns the invoice of the first request instead of creating another one.
+        The result is {"invoice_id", "status", "encoded_invoice", "amount_requested", "exchange_rate", "expired_at"}.
+        '''
+        self.jsonrpc_session.check_auth()
+        _check_create_invoice_params(amount_requested, idempotency_key)
+        try:
+            return await IdempotentInvoiceCreator.instance.create(self.jsonrpc_session.account_id, amount_requested, idempotency_key)
+        except IdempotencyKeyConflict as e:
+            raise JsonRpcException(str(e), JSONRPC_ERROR_CODE_INVALID_PARAMS, "idempotency_key was used for another invoice")
+
+    async def _jsonrpc_create_invoices(self, invoices: list):
+        '''
+        Create many invoices at once, e.g. one per line item.
+        @invoices: [{"amount_requested": 1000, "idempotency_key": "..."}], at most Config.CreateInvoicesMaxBatchSize.
+            idempotency_key is optional, see create_invoice.
+        The result has the result of create_invoice of each invoice, in order, or {"error": {"code", "message"}}
+        for the invoices that failed.
+        '''
+        self.jsonrpc_session.check_auth()
+        if type(invoices) != list or not invoices or len(invoices) > Config.CreateInvoicesMaxBatchSize:
+            msg = "invoices must be a list of 1 to {} invoices".format(Config.CreateInvoicesMaxBatchSize)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        items = []
+        for invoice in invoices:
+            if type(invoice) != dict:
+                msg = "Each invoice must be an object"
+                raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+            amount_requested = invoice.get("amount_requested", None)
+            idempotency_key = invoice.get("idempotency_key", None)
+            _check_create_invoice_params(amount_requested, idempotency_key, idempotency_key is None)
+            items.append((amount_requested, idempotency_key))
+
+        results = await BulkInvoiceCreator.instance.create(self.jsonrpc_session.account_id, items)
+        for index, result in enumerate(results):
+            if isinstance(result, IdempotencyKeyConflict):
+                results[index] = {"error": {"code": JSONRPC_ERROR_CODE_INVALID_PARAMS, "message": "idempotency_key was used for another invoice"}}
+            elif isinstance(result, Exception):
+                results[index] = {"error": {"code": JSONRPC_ERROR_CODE_INTERNAL_ERROR, "message": "Failed to create the invoice"}}
+        return results
+
+    async def _jsonrpc_set_invoice_pool(self, amount_requested: int, size: int):
+        '''
+        Keep @size invoices of @amount_requested USD in cents ready, e.g. for a fixed price item, so that create_invoice
+        of that amount does not wait for the node. A @size of 0 removes the pool.
+        The result is the pools of the authenticated account, [{"account_id", "amount_requested", "size"}].
+        '''
+        self.jsonrpc_session.check_auth()
+        if type(amount_requested) != int or amount_requested <= 0:
+            msg = "amount_requested must be a positive number of cents"
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        if type(size) != int or size < 0 or size > Config.InvoicePoolMaxSize:
+            msg = "size must be between 0 and {}".format(Config.InvoicePoolMaxSize)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        account_id = self.jsonrpc_session.account_id
+        amounts = [pool.amount_requested for pool in DBInvoicePool.list_pools(account_id)]
+        if size > 0 and amount_requested not in amounts and len(amounts) >= Config.InvoicePoolMaxPoolsPerAccount:
+            msg = "At most {} invoice pools".format(Config.InvoicePoolMaxPoolsPerAccount)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        DBInvoicePool.set_pool(account_id, amount_requested, size)
+        return [vars(pool) for pool in DBInvoicePool.list_pools(account_id)]
+
+    async def _jsonrpc_get_account_stats(self, from_day: int, to_day: int):
+        '''
+        Totals of the finalized invoices of the authenticated account per day for from_day <= day < to_day, where
+        a day is the unix time in seconds of its 00:00 UTC. Days without finalized invoices are left out.
+        '''
+        self.jsonrpc_session.check_auth()
+        if type(from_day) != int or type(to_day) != int:
+            msg = "from_day and to_day must be unix time in seconds"
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        stats = DBAccountDailyStats.get_account_stats(self.jsonrpc_session.account_id, from_day, to_day)
+        return [vars(daily_stats) for daily_stats in stats]
+
     def can_handle(self, request: JsonRpcRequest) -> bool:
         return request.method in self.jsonrpc_methods
 
+    async def _stream(self, request: JsonRpcRequest, results):
+        '''
+        Send all but the last value of the async generator @results as stream notifications.
+        @return: the last value.
+        '''
+        previous = None
+        has_previous = False
+        try:
+            async for result in results:
+                # Lets other requests run between chunks, and a request past its deadline be cancelled.
+                await asyncio.sleep(0)
+                request.keep_alive()
+                if has_previous:
+                    await self.websocket_send.send_message({
+                        "jsonrpc": request.jsonrpc,
+                        "method": "stream",
+                        "params": {
+                            "id": request.id,
+                            "result": previous
+                        }
+                    })
+                previous = result
+                has_previous = True
+            return previous
+        finally:
+            # Release what the generator holds e.g. DB cursors, when sending fails.
+            await results.aclose()
+
     async def handle(self, request: JsonRpcRequest):
         assert request.method in self.jsonrpc_methods
+        method = self.jsonrpc_methods[request.method]
         if type(request.params) == dict:
-            result = await self.jsonrpc_methods[request.method](**request.params)
+            result = method(**request.params)
         else:
-            result = await self.jsonrpc_methods[request.method](*request.params)
+            result = method(*request.params)
+        if inspect.isasyncgen(result):
+            result = await self._stream(request, result)
+        else:
+            result = await result
         response = {
             "jsonrpc": request.jsonrpc,
             "result": result,
             "id": request.id
         }
-        await self.websocket_send.send(json.dumps(response))
+        websocket_send = request.websocket_send if request.websocket_send else self.websocket_send
+        await websocket_send.send_message(response)
+
+class _BatchResponseSend(WebSocketSend):
+    '''
+    Collects the response to one request of a batch, so that all responses go out in one frame.
+    '''
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, message):
+        self.messages.append(message)
+
+def _error_response(code, message, request_id):
+    return {
+        "jsonrpc": "2.0",
+        "error": {
+            "code": code,
+            "message": message
+        },
+        "id": request_id
+    }
 
 class JsonRpc():
     '''
@@ -111,72 +383,212 @@ class JsonRpc():
 
     How to use it:
         jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(websocket))
-        handlers = [asyncio.create_task(jsonrpc.handle()) for _ in range(3)]
-        await asyncio.gather([handlers])
-    where 3 is the number of handlers for the websocket i.e the max "concurrent" request processing for the websoecket.
+        await jsonrpc.handle()
+
+    handle() receives the messages of the websocket and handles each one in its own task, so that a slow request does
+    not hold up the others. At most @max_concurrent_requests requests of the websocket, counting each request of a
+    batch, are handled at a time, and at most @max_concurrent_requests messages are in progress. Feeds run in tasks
+    of the FeedHandler, which are cancelled when handle() returns.
+
+    Each request is cancelled if it is not done within Config.JsonRpcRequestTimeoutSeconds, or the number of seconds
+    of its optional "_timeout" param, and gets a JSONRPC_ERROR_CODE_TIMEOUT error. For a stream, e.g. export_invoices,
+    the timeout applies to each chunk instead of the whole stream. Cancellation stops the request at its next await,
+    e.g. between the chunks of a stream or on a call of AsyncLightningClient.
+
+    A message may also be a JSON-RPC 2.0 batch i.e. an array of at most @max_batch_size requests. They are handled
+    concurrently within the limit above, and their responses are sent as one array. Requests without "id" are
+    notifications and get no response in a batch.
     '''
-    def __init__(self, websocket: WebSocketServerProtocolWrapper):
+    def __init__(self, websocket: WebSocketServerProtocolWrapper, max_concurrent_requests: int = Config.JsonRpcMaxConcurrentRequests,
+            request_timeout: float = Config.JsonRpcRequestTimeoutSeconds, max_request_timeout: float = Config.JsonRpcMaxRequestTimeoutSeconds,
+            max_batch_size: int = Config.JsonRpcMaxBatchSize):
         self.running = True
         self.websocket = websocket
         self.jsonrpc_session = JsonRpcSession()
+        self._max_concurrent_requests = max_concurrent_requests
+        self._request_timeout = request_timeout
+        self._max_request_timeout = max_request_timeout
+        self._max_batch_size = max_batch_size
+        # Requests being handled, see _dispatch. Made in handle(), in the event loop of the websocket.
+        self._requests_semaphore: asyncio.Semaphore = None
+        self._feed_handler = FeedHandler(self.websocket, self.jsonrpc_session)
+        self._handlers: typing.List[JsonRpcHandler] = [
+            JsonRpcHandlerImpl(self.websocket, self.jsonrpc_session),
+            self._feed_handler
+        ]
+        self._request_tasks: typing.Set[asyncio.Task] = set()
+        # Task of handle() receiving the messages, cancelled by stop().
+        self._receive_task: asyncio.Task = None
 
     def stop(self):
         self.running = False
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+
+    def _pop_timeout(self, params) -> float:
+        '''
+        Remove the optional "_timeout" from @params, so that it is not passed to the method.
+        @return: the timeout of the request in seconds.
+        '''
+        if type(params) != dict or "_timeout" not in params:
+            return self._request_timeout
+        timeout = params.pop("_timeout")
+        if type(timeout) not in [int, float] or timeout <= 0 or timeout > self._max_request_timeout:
+            msg = "_timeout must be a number of seconds between 0 and {}".format(self._max_request_timeout)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_PARAMS, msg)
+        return timeout
+
+    async def _handle_with_deadline(self, handler: JsonRpcHandler, request: JsonRpcRequest, timeout: float):
+        '''
+        Cancel the request at its deadline, which streams push back on each chunk, see JsonRpcRequest.keep_alive.
+        '''
+        loop = asyncio.get_running_loop()
+        request.timeout = timeout
+        request.deadline = loop.time() + timeout
+        task = asyncio.ensure_future(handler.handle(request))
+        try:
+            while True:
+                await asyncio.wait([task], timeout=max(request.deadline - loop.time(), 0))
+                if task.done():
+                    return task.result()
+                if loop.time() >= request.deadline:
+                    break
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise JsonRpcException("Request {} {} timed out after {} seconds".format(request.id, request.method, timeout), 
+                JSONRPC_ERROR_CODE_TIMEOUT, "Request timed out")
+        finally:
+            # e.g. the request itself is cancelled as the websocket closes.
+            if not task.done():
+                task.cancel()
+
+    async def _dispatch(self, handlers: typing.List[JsonRpcHandler], jsonrpc_request, websocket_send: WebSocketSend):
+        '''
+        Handle one request object. Its response, or error, is sent to @websocket_send.
+        '''
+        # Per request object rather than per message, so that the requests of a batch share the limit of the
+        # websocket without a batch waiting on itself.
+        async with self._requests_semaphore:
+            await self._dispatch_request(handlers, jsonrpc_request, websocket_send)
+
+    async def _dispatch_request(self, handlers: typing.List[JsonRpcHandler], jsonrpc_request, websocket_send: WebSocketSend):
+        request_id = None
+        try:
+            if type(jsonrpc_request) != dict:
+                raise JsonRpcException("Request must be an object", JSONRPC_ERROR_CODE_INVALID_REQUEST)
+            request_id = jsonrpc_request.get("id", None)
+
+            if "jsonrpc" not in jsonrpc_request or jsonrpc_request["jsonrpc"] != "2.0":
+                raise JsonRpcException("Unsupported version", JSONRPC_ERROR_CODE_INVALID_REQUEST)
+            if "method" not in jsonrpc_request:
+                raise JsonRpcException("method must be specified", JSONRPC_ERROR_CODE_METHOD_NOT_FOUND)
+
+            params = jsonrpc_request.get("params", [])
+            timeout = self._pop_timeout(params)
+            request_obj = JsonRpcRequest(jsonrpc_request["jsonrpc"], jsonrpc_request["method"], 
+                params, request_id, websocket_send)
+
+            handled = False
+            for handler in  handlers:
+                if handler.can_handle(request_obj):
+                    await self._handle_with_deadline(handler, request_obj, timeout)
+                    handled = True
+                    break
+            
+            if not handled:
+                raise JsonRpcException("method not found", JSONRPC_ERROR_CODE_METHOD_NOT_FOUND)
+        except JsonRpcException as e:
+            LOGGER.debug("websocket_handler JsonRpcException: {}".format(str(e)))
+            await websocket_send.send_message(_error_response(e.code, e.message_to_client, request_id))
+        except websockets.exceptions.ConnectionClosed as e:
+            raise e
+        except Exception as e:
+            LOGGER.debug("websocket_handler Exception: {}".format(str(e)))
+            await websocket_send.send_message(_error_response(JSONRPC_ERROR_CODE_INTERNAL_ERROR, "", request_id))
+
+    async def _dispatch_batch(self, handlers: typing.List[JsonRpcHandler], jsonrpc_requests: list):
+        if not jsonrpc_requests:
+            raise JsonRpcException("Empty batch", JSONRPC_ERROR_CODE_INVALID_REQUEST)
+        if len(jsonrpc_requests) > self._max_batch_size:
+            msg = "A batch can have at most {} requests".format(self._max_batch_size)
+            raise JsonRpcException(msg, JSONRPC_ERROR_CODE_INVALID_REQUEST, msg)
+
+        response_sends = [_BatchResponseSend() for _ in jsonrpc_requests]
+        await asyncio.gather(*[self._dispatch(handlers, jsonrpc_request, response_send) 
+            for jsonrpc_request, response_send in zip(jsonrpc_requests, response_sends)])
+
+        responses = []
+        for jsonrpc_request, response_send in zip(jsonrpc_requests, response_sends):
+            is_notification = type(jsonrpc_request) == dict and "id" not in jsonrpc_request
+            if not is_notification:
+                responses.extend(response_send.messages)
+        if responses:
+            await self.websocket.send_message(responses)
+
+    async def _handle_message(self, jsonrpc_request):
+        try:
+            if type(jsonrpc_request) == list:
+                await self._dispatch_batch(self._handlers, jsonrpc_request)
+            else:
+                await self._dispatch(self._handlers, jsonrpc_request, self.websocket)
+        except JsonRpcException as e:
+            LOGGER.debug("websocket_handler JsonRpcException: {}".format(str(e)))
+            await self.websocket.send_message(_error_response(e.code, e.message_to_client, None))
+
+    async def _run_request(self, jsonrpc_request, semaphore: asyncio.Semaphore):
+        try:
+            await self._handle_message(jsonrpc_request)
+        except websockets.exceptions.ConnectionClosed as e:
+            self.running = False
+            LOGGER.debug("websocket_handler closing: {}".format(str(e)))
+        except Exception as e:
+            LOGGER.debug("websocket_handler Exception: {}".format(str(e)))
+        finally:
+            semaphore.release()
+
+    async def _close(self):
+        '''
+        Cancel the requests in progress and the feeds.
+        '''
+        tasks = list(self._request_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._feed_handler.close()
 
     async def handle(self):
-        handlers: typing.List[JsonRpcHandler] = []
-        handlers.append(JsonRpcHandlerImpl(self.websocket, self.jsonrpc_session))
+        self._requests_semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+        # Messages in progress, so that a client sending faster than its requests are handled is not read from.
+        semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+        self._receive_task = asyncio.ensure_future(self._receive(semaphore))
+        try:
+            await self._receive_task
+        except asyncio.CancelledError:
+            # Cancelled by stop(), otherwise handle() itself is cancelled.
+            if self.running:
+                raise
+        finally:
+            await self._close()
 
+    async def _receive(self, semaphore: asyncio.Semaphore):
         while self.running:
-            request_id = None
             try:
-                request_str = None
-                while self.running and not request_str:
-                    if self.websocket.messages:
-                        request_str = await self.websocket.recv()
-                    await asyncio.sleep(0)
+                request_str = await self.websocket.recv()
                 LOGGER.debug("request_str: {}".format(request_str))
 
                 try:
-                    jsonrpc_request = json.loads(request_str)
-                except json.JSONDecodeError as e:
+                    jsonrpc_request = self.websocket.codec.loads(request_str)
+                except CodecDecodeError as e:
                     raise JsonRpcException(str(e), JSONRPC_ERROR_CODE_PARSE_ERROR, 
                         "Failed to parse the json request")
 
-                request_id = jsonrpc_request["id"] if jsonrpc_request["id"] else None
-                params = jsonrpc_request["params"] if jsonrpc_request["params"] else []
-
-                # if "method" not in jsonrpc_request or jsonrpc_request["method"] not in jsonrpc_methods:
-                #     raise JsonRpcException("method not found", JSONRPC_ERROR_CODE_METHOD_NOT_FOUND)
-
-                if "jsonrpc" not in jsonrpc_request or jsonrpc_request["jsonrpc"] != "2.0":
-                    raise JsonRpcException("Unsupported version", JSONRPC_ERROR_CODE_INVALID_REQUEST)
-                if "method" not in jsonrpc_request:
-                    raise JsonRpcException("method must be specified", JSONRPC_ERROR_CODE_METHOD_NOT_FOUND)
-
-                request_obj = JsonRpcRequest(jsonrpc_request["jsonrpc"], jsonrpc_request["method"], 
-                    jsonrpc_request.get("params", []), jsonrpc_request.get("id", None))
-
-                handled = False
-                for handler in  handlers:
-                    if handler.can_handle(request_obj):
-                        await handler.handle(request_obj)
-                        handled = True
-                        break
-                
-                if not handled:
-                    raise JsonRpcException("method not found", JSONRPC_ERROR_CODE_METHOD_NOT_FOUND)
+                await semaphore.acquire()
+                task = asyncio.create_task(self._run_request(jsonrpc_request, semaphore))
+                self._request_tasks.add(task)
+                task.add_done_callback(self._request_tasks.discard)
             except JsonRpcException as e:
                 LOGGER.debug("websocket_handler JsonRpcException: {}".format(str(e)))
-                response = {
-                    "jsonrpc": "2.0",
-                    "error": {
-                        "code": e.code,
-                        "message": e.message_to_client
-                    },
-                    "id": request_id
-                }
-                await self.websocket.send(json.dumps(response))
+                await self.websocket.send_message(_error_response(e.code, e.message_to_client, None))
             except websockets.exceptions.ConnectionClosedOK as e:
                 self.running = False
             except websockets.exceptions.ConnectionClosedError as e:
@@ -191,12 +603,15 @@ class JsonRpc():
                     },
                     "id": None
                 }
-                await self.websocket.send(json.dumps(response))
+                await self.websocket.send_message(response)
 
 async def websocket_handler(websocket: WebSocketServerProtocol):
-    jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(websocket))
-    handlers = [asyncio.create_task(jsonrpc.handle()) for _ in range(3)]
-    await asyncio.gather(*handlers)
+    websocket_wrapper = WebSocketServerProtocolWrapper(websocket)
+    jsonrpc = JsonRpc(websocket_wrapper)
+    try:
+        await jsonrpc.handle()
+    finally:
+        websocket_wrapper.close()
 
 ############ Testing  ############
 async def _test_echo_client():
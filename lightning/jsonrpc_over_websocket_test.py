@@ -1,4 +1,7 @@
 from .jsonrpc_over_websocket import JsonRpc, WebSocketServerProtocolWrapper, JsonRpcHandlerImpl, JsonRpcSession
+from .jsonrpc_handler import JsonRpcException, JsonRpcHandler, JsonRpcRequest, WebSocketSend
+from .jsonrpc_handler import JSONRPC_ERROR_CODE_INVALID_PARAMS, JSONRPC_ERROR_CODE_TIMEOUT
+from .codec import StdlibJsonCodec
 import websockets
 from copy import copy
 import asyncio
@@ -22,6 +25,9 @@ class JsonRpcHandlerTest(unittest.TestCase):
                 self.sent.append(data)
                 raise websockets.exceptions.ConnectionClosedError(None, None)
             async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
                 return self.messages.pop(0)
             async def close():
                 pass
@@ -41,6 +47,208 @@ class JsonRpcHandlerTest(unittest.TestCase):
         self.assertEqual(response["jsonrpc"], "2.0")
         self.assertEqual(response["result"], "hello from client request 2")
 
+    def test_batch(self):
+        class MockWebSocket():
+            def __init__(self):
+                self.messages = []
+                self.sent = []
+            async def send(self, data:str):
+                self.sent.append(data)
+            async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
+                return self.messages.pop(0)
+
+        mock_websocket = MockWebSocket()
+        jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(mock_websocket), max_concurrent_requests=2)
+        mock_websocket.messages.append(json.dumps([
+            {"id": 1, "jsonrpc": "2.0", "params": ["first"], "method": "echo"},
+            {"jsonrpc": "2.0", "params": ["notification"], "method": "echo"},
+            {"id": 3, "jsonrpc": "2.0", "params": {}, "method": "unknown"},
+            {"id": 4, "jsonrpc": "2.0", "params": ["last"], "method": "echo"},
+            5
+        ]))
+        mock_websocket.messages.append("[]")
+        loop = asyncio.new_event_loop()
+        loop.call_later(0.5, jsonrpc.stop)
+        loop.run_until_complete(jsonrpc.handle())
+
+        # Messages are handled concurrently, so their responses may be sent in any order.
+        self.assertEqual(len(mock_websocket.sent), 2)
+        sent = sorted([json.loads(data) for data in mock_websocket.sent], key=lambda response: type(response) == dict)
+        responses = sent[0]
+        self.assertEqual(len(responses), 4)
+        self.assertEqual(responses[0], {"jsonrpc": "2.0", "result": "first", "id": 1})
+        self.assertEqual(responses[1]["id"], 3)
+        self.assertEqual(responses[1]["error"]["code"], -32601)
+        self.assertEqual(responses[2], {"jsonrpc": "2.0", "result": "last", "id": 4})
+        self.assertEqual(responses[3]["id"], None)
+        self.assertEqual(responses[3]["error"]["code"], -32600)
+        # An empty batch is an invalid request.
+        self.assertEqual(sent[1]["error"]["code"], -32600)
+
+    def test_batchConcurrency(self):
+        class MockWebSocket():
+            def __init__(self):
+                self.messages = []
+                self.sent = []
+            async def send(self, data:str):
+                self.sent.append(json.loads(data))
+            async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
+                return self.messages.pop(0)
+
+        class SlowHandler(JsonRpcHandler):
+            def __init__(self):
+                self.running = 0
+                self.max_running = 0
+            def can_handle(self, request):
+                return request.method == "slow"
+            async def handle(self, request):
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                try:
+                    await asyncio.sleep(0.05)
+                finally:
+                    self.running -= 1
+                await request.websocket_send.send_message({"jsonrpc": "2.0", "result": "done", "id": request.id})
+
+        mock_websocket = MockWebSocket()
+        jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(mock_websocket), max_concurrent_requests=2, max_batch_size=3)
+        slow_handler = SlowHandler()
+        jsonrpc._handlers.insert(0, slow_handler)
+        batch = [{"id": i, "jsonrpc": "2.0", "params": {}, "method": "slow"} for i in range(3)]
+        mock_websocket.messages.extend([json.dumps(batch), json.dumps(batch)])
+        mock_websocket.messages.append(json.dumps(batch + batch))
+        loop = asyncio.new_event_loop()
+        loop.call_later(0.5, jsonrpc.stop)
+        loop.run_until_complete(jsonrpc.handle())
+
+        # The requests of both batches share the limit of the websocket.
+        self.assertEqual(slow_handler.max_running, 2)
+        batches = [response for response in mock_websocket.sent if type(response) == list]
+        self.assertEqual([len(responses) for responses in batches], [3, 3])
+        # A batch over max_batch_size is rejected.
+        errors = [response for response in mock_websocket.sent if type(response) == dict]
+        self.assertEqual([error["error"]["code"] for error in errors], [-32600])
+
+    def test_binaryCodec(self):
+        class BinaryJsonCodec(StdlibJsonCodec):
+            binary = True
+            def dumps(self, obj):
+                return StdlibJsonCodec.dumps(self, obj).encode("utf-8")
+
+        class MockWebSocket():
+            def __init__(self):
+                self.messages = []
+                self.sent = []
+            async def send(self, data):
+                self.sent.append(data)
+            async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
+                return self.messages.pop(0)
+
+        mock_websocket = MockWebSocket()
+        websocket = WebSocketServerProtocolWrapper(mock_websocket)
+        websocket.codec = BinaryJsonCodec()
+        jsonrpc = JsonRpc(websocket)
+        mock_websocket.messages.append(b'{"id": 1, "jsonrpc": "2.0", "params": ["hello"], "method": "echo"}')
+        mock_websocket.messages.append(b'[{"id": 2, "jsonrpc": "2.0", "params": ["batch"], "method": "echo"}]')
+        mock_websocket.messages.append(b'{"id": 3, ')
+        loop = asyncio.new_event_loop()
+        loop.call_later(0.5, jsonrpc.stop)
+        loop.run_until_complete(jsonrpc.handle())
+
+        # Responses, batches and errors are all encoded with the codec of the connection.
+        self.assertEqual(len(mock_websocket.sent), 3)
+        for data in mock_websocket.sent:
+            self.assertEqual(type(data), bytes)
+        sent = [json.loads(data) for data in mock_websocket.sent]
+        self.assertIn({"jsonrpc": "2.0", "result": "hello", "id": 1}, sent)
+        self.assertIn([{"jsonrpc": "2.0", "result": "batch", "id": 2}], sent)
+        self.assertIn(-32700, [response["error"]["code"] for response in sent if "error" in response])
+
+    def test_requestTimeout(self):
+        class MockWebSocket():
+            def __init__(self):
+                self.messages = []
+                self.sent = []
+            async def send(self, data):
+                self.sent.append(json.loads(data))
+            async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
+                return self.messages.pop(0)
+
+        cancelled = []
+        class SlowHandler(JsonRpcHandler):
+            def can_handle(self, request):
+                return request.method == "slow"
+            async def handle(self, request):
+                self.params = request.params
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(request.id)
+                    raise
+
+        mock_websocket = MockWebSocket()
+        jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(mock_websocket), request_timeout=0.1, max_request_timeout=1)
+        slow_handler = SlowHandler()
+        jsonrpc._handlers.insert(0, slow_handler)
+        mock_websocket.messages.append(json.dumps({"id": 1, "jsonrpc": "2.0", "params": {}, "method": "slow"}))
+        mock_websocket.messages.append(json.dumps({"id": 2, "jsonrpc": "2.0", "params": {"_timeout": 0.2}, "method": "slow"}))
+        mock_websocket.messages.append(json.dumps({"id": 3, "jsonrpc": "2.0", "params": {"_timeout": 2}, "method": "slow"}))
+        loop = asyncio.new_event_loop()
+        loop.call_later(0.5, jsonrpc.stop)
+        loop.run_until_complete(jsonrpc.handle())
+
+        self.assertEqual([1, 2], sorted(cancelled))
+        # "_timeout" is not passed to the method.
+        self.assertEqual({}, slow_handler.params)
+        errors = {response["id"]: response["error"]["code"] for response in mock_websocket.sent}
+        self.assertEqual({1: JSONRPC_ERROR_CODE_TIMEOUT, 2: JSONRPC_ERROR_CODE_TIMEOUT, 3: JSONRPC_ERROR_CODE_INVALID_PARAMS}, errors)
+
+    def test_streamTimeout(self):
+        class MockWebSocket():
+            def __init__(self):
+                self.messages = []
+                self.sent = []
+            async def send(self, data):
+                self.sent.append(json.loads(data))
+            async def recv(self):
+                # Blocks while there is no message, like a websocket.
+                while not self.messages:
+                    await asyncio.sleep(0.01)
+                return self.messages.pop(0)
+
+        class SlowStreamHandler(JsonRpcHandlerImpl):
+            async def _jsonrpc_slow_stream(self, delay: float):
+                for i in range(4):
+                    await asyncio.sleep(delay)
+                    yield i
+
+        mock_websocket = MockWebSocket()
+        jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(mock_websocket), request_timeout=0.1)
+        jsonrpc._handlers.insert(0, SlowStreamHandler(jsonrpc.websocket, jsonrpc.jsonrpc_session))
+        # Longer than the timeout in total, but each chunk is within it.
+        mock_websocket.messages.append(json.dumps({"id": 1, "jsonrpc": "2.0", "params": [0.05], "method": "slow_stream"}))
+        # A chunk takes longer than the timeout.
+        mock_websocket.messages.append(json.dumps({"id": 2, "jsonrpc": "2.0", "params": [0.2], "method": "slow_stream"}))
+        loop = asyncio.new_event_loop()
+        loop.call_later(0.5, jsonrpc.stop)
+        loop.run_until_complete(jsonrpc.handle())
+
+        responses = {response["id"]: response for response in mock_websocket.sent if "id" in response}
+        self.assertEqual(responses[1]["result"], 3)
+        self.assertEqual(responses[2]["error"]["code"], JSONRPC_ERROR_CODE_TIMEOUT)
+
     def test_authenticate(self):
         # Create the account for the token creation
         account = DBAccount()
@@ -70,3 +278,96 @@ class JsonRpcHandlerTest(unittest.TestCase):
         DBUtils.delete("accounts", "account_id", created_account.account_id)
 
         
+
+    def test_listInvoices(self):
+        account = DBAccount()
+        account.username = "Jack" + str(random.randint(0, 10e12))
+        account.password = "dsafdsafdsaf"
+        account.email = account.username + "@gmail.com"
+        created_account = DBAccount.create_account(account)
+        invoices = []
+        for i in range(5):
+            invoice = DBInvoice()
+            invoice.account_id = created_account.account_id
+            invoice.status = "paid" if i % 2 == 0 else "expired"
+            invoice.created_at = 1000 + i
+            invoice.amount_requested = 100
+            invoice.exchange_rate = 2000
+            invoices.append(invoice)
+        DBUtils.insert_many(invoices, "invoices", id_column_name="invoice_id")
+
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.sent = []
+            async def send(self, data: str):
+                self.sent.append(json.loads(data))
+
+        session = JsonRpcSession()
+        session.account_id = created_account.account_id
+        session.exp = int(time.time()) + 60*60*24
+        websocket_send = MockWebSocketSend()
+        impl = JsonRpcHandlerImpl(websocket_send, session)
+        impl.LIST_INVOICES_CHUNK_SIZE = 2
+
+        # First page of 3 is streamed as a chunk of 2 followed by the response with 1.
+        asyncio.run(impl.handle(JsonRpcRequest("2.0", "list_invoices", {"limit": 3}, 7)))
+        self.assertEqual(len(websocket_send.sent), 2)
+        self.assertEqual(websocket_send.sent[0]["method"], "stream")
+        self.assertEqual(websocket_send.sent[0]["params"]["id"], 7)
+        self.assertEqual([i["invoice_id"] for i in websocket_send.sent[0]["params"]["result"]["invoices"]],
+            [invoice.invoice_id for invoice in invoices[:2]])
+        result = websocket_send.sent[1]["result"]
+        self.assertEqual(websocket_send.sent[1]["id"], 7)
+        self.assertEqual([i["invoice_id"] for i in result["invoices"]], [invoices[2].invoice_id])
+
+        # Second page continues from the cursor.
+        websocket_send.sent = []
+        asyncio.run(impl.handle(JsonRpcRequest("2.0", "list_invoices", {"limit": 3, "cursor": result["next_cursor"]}, 8)))
+        result = websocket_send.sent[-1]["result"]
+        self.assertEqual([i["invoice_id"] for i in websocket_send.sent[0]["params"]["result"]["invoices"]],
+            [invoice.invoice_id for invoice in invoices[3:]])
+        self.assertEqual(result["invoices"], [])
+        self.assertEqual(result["next_cursor"], "")
+
+        # Filters
+        websocket_send.sent = []
+        impl.LIST_INVOICES_CHUNK_SIZE = JsonRpcHandlerImpl.LIST_INVOICES_CHUNK_SIZE
+        params = {"status": ["paid"], "created_from": 1001}
+        asyncio.run(impl.handle(JsonRpcRequest("2.0", "list_invoices", params, 9)))
+        result = websocket_send.sent[-1]["result"]
+        self.assertEqual([i["invoice_id"] for i in result["invoices"]], [invoices[2].invoice_id, invoices[4].invoice_id])
+        self.assertEqual(result["next_cursor"], "")
+
+        # Unknown statuses
+        for status in ["paid", ["paid", "refunded"], [["paid"]], {"paid": 1}]:
+            with self.assertRaises(JsonRpcException) as context:
+                asyncio.run(impl.handle(JsonRpcRequest("2.0", "list_invoices", {"status": status}, 10)))
+            self.assertEqual(context.exception.code, JSONRPC_ERROR_CODE_INVALID_PARAMS, status)
+
+        # Invalid created_from, created_to
+        for params in [{"created_from": "1001"}, {"created_to": 1001.5}, {"created_from": True},
+                {"created_from": 1002, "created_to": 1001}]:
+            with self.assertRaises(JsonRpcException) as context:
+                asyncio.run(impl.handle(JsonRpcRequest("2.0", "list_invoices", params, 11)))
+            self.assertEqual(context.exception.code, JSONRPC_ERROR_CODE_INVALID_PARAMS, params)
+
+        for invoice in invoices:
+            DBUtils.delete("invoices", "invoice_id", invoice.invoice_id)
+        DBUtils.delete("accounts", "account_id", created_account.account_id)
+
+    def test_exportInvoices(self):
+        class MockWebSocketSend(WebSocketSend):
+            def __init__(self):
+                self.sent = []
+            async def send(self, data: str):
+                self.sent.append(json.loads(data))
+
+        session = JsonRpcSession()
+        session.account_id = -1
+        session.exp = int(time.time()) + 60*60*24
+        websocket_send = MockWebSocketSend()
+        impl = JsonRpcHandlerImpl(websocket_send, session)
+        asyncio.run(impl.handle(JsonRpcRequest("2.0", "export_invoices", {"format": "csv"}, 4)))
+        self.assertEqual(websocket_send.sent[0]["params"]["result"]["format"], "csv")
+        self.assertTrue(websocket_send.sent[0]["params"]["result"]["data"].startswith("invoice_id,"))
+        self.assertEqual(websocket_send.sent[1]["result"], {"format": "csv", "rows": 0})
@@ -1,7 +1,8 @@
 
+import asyncio
 import socket
 import sys
-import json
+from .codec import json_codec
 from .config import Config
 import time
 from threading import Lock
@@ -10,7 +11,9 @@ import logging
 import re
 from copy import copy
 from .pubsub import Pubsub
-from .db import DBInvoice, DBUtils
+from .db import DBInvoice, DBInvoicePool, DBInvoicePoolItem, DBUtils, DBAccountDailyStats
+from . import market
+from uuid import uuid4
 from threading import Thread
 
 LOGGER = logging.Logger(__file__)
@@ -50,9 +53,9 @@ class LightningClient:
         request['jsonrpc'] = '2.0'
         self.id += 1
 
-        msg = json.dumps(request) + '\n'
-        self.sock.sendall(msg.encode('ascii'))
-        response = json.loads(self.f.readline())
+        msg = json_codec.dumps(request) + '\n'
+        self.sock.sendall(msg.encode('utf-8'))
+        response = json_codec.loads(self.f.readline())
         # Each response ends with two new lines, hence this.
         # ref: https://github.com/ElementsProject/lightning/blob/v0.10.1/contrib/pyln-client/pyln/client/lightning.py#L298
         _ = self.f.readline()
@@ -65,6 +68,37 @@ def CreateLightningClient() -> LightningClient:
     '''
     return LightningClient(Config.LightningUnixSocket)
 
+class AsyncLightningClient:
+    '''
+    asyncio counterpart of LightningClient, so that node calls do not block the event loop. Each call has its own
+    connection to the node. A cancelled call, e.g. of a JSON-RPC request past its deadline, closes its connection,
+    so an abandoned call neither holds a connection nor leaves a response behind.
+    '''
+    # In bytes. Max size of a response, e.g. of listinvoices.
+    MAX_RESPONSE_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, socket_file: str = None):
+        self._socket_file = socket_file if socket_file is not None else Config.LightningUnixSocket
+        self._id = 0
+
+    async def call(self, method, params=None) -> dict:
+        '''
+        @params: dict or list.
+        @return: the JSON-RPC response of the node, with either "result" or "error".
+        '''
+        self._id += 1
+        request = {'method': method, 'params': params if params is not None else [], 'id': self._id, 'jsonrpc': '2.0'}
+        reader, writer = await asyncio.open_unix_connection(self._socket_file, limit=AsyncLightningClient.MAX_RESPONSE_SIZE)
+        try:
+            writer.write((json_codec.dumps(request) + '\n').encode('utf-8'))
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("Lightning closed the connection during {}".format(method))
+            return json_codec.loads(line)
+        finally:
+            writer.close()
+
 # class LightningOverview():
 #     def __init__(self):
 #         self.node_id = ""
@@ -123,6 +157,30 @@ class LightningInvoice():
 #         # the amount the destination received, if known. Example "1000msat"
 #         self.amount_msat = ""
 
+def _invoice_params(invoice_label, msatoshi, description, expiry) -> dict:
+    return {
+        "msatoshi": msatoshi,
+        "label": invoice_label,
+        "description": description,
+        "expiry":  expiry
+    }
+
+def _invoice_result(invoice_response):
+    assert invoice_response.get(
+        "error") is None, invoice_response.get("error")
+
+    # Check for any warnings. Abort if there is any.
+    result = invoice_response["result"]
+    warnings = []
+    for key, value in result.items():
+        if key.startswith("warning_"):
+            warnings.append((key, value))
+    if warnings:
+        LOGGER.warn("Invoice warnings: {}".format(warnings))
+        raise Exception("invoice has warnings")
+
+    return result["bolt11"], result["expires_at"]
+
 class LightningNode():
 
     def invoice(self, invoice_label, msatoshi, description, expiry):
@@ -138,27 +196,8 @@ class LightningNode():
 
         client: LightningClient = CreateLightningClient()
         try:
-            params = {
-                "msatoshi": msatoshi,
-                "label": invoice_label,
-                "description": description,
-                "expiry":  expiry
-            }
-            invoice_response = client.call("invoice", params)
-            assert invoice_response.get(
-                "error") is None, invoice_response.get("error")
-
-            # Check for any warnings. Abort if there is any.
-            result = invoice_response["result"]
-            warnings = []
-            for key, value in result.items():
-                if key.startswith("warning_"):
-                    warnings.append((key, value))
-            if warnings:
-                LOGGER.warn("Invoice warnings: {}".format(warnings))
-                raise Exception("invoice has warnings")
-
-            return result["bolt11"], result["expires_at"]
+            invoice_response = client.call("invoice", _invoice_params(invoice_label, msatoshi, description, expiry))
+            return _invoice_result(invoice_response)
         finally:    
             client.close()
 
@@ -178,6 +217,21 @@ class LightningNode():
         finally:
             client.close()
 
+class AsyncLightningNode():
+    '''
+    LightningNode over AsyncLightningClient, for many concurrent calls from the event loop e.g. by BulkInvoiceCreator.
+    '''
+    def __init__(self, client: AsyncLightningClient = None):
+        self._client = client if client is not None else AsyncLightningClient()
+
+    async def invoice(self, invoice_label, msatoshi, description, expiry):
+        """
+        See LightningNode.invoice.
+        """
+        assert len(description) < 100
+        invoice_response = await self._client.call("invoice", _invoice_params(invoice_label, msatoshi, description, expiry))
+        return _invoice_result(invoice_response)
+
 # def get_lightning_overview():
 #     client = CreateLightningClient()
 #     try:
@@ -324,32 +378,51 @@ class LightningNode():
 #         client.close()
 
 
+def _msatoshi(amount_requested, exchange_rate) -> int:
+    return round(amount_requested * exchange_rate * 1000)
+
+def invoice_msatoshi(invoice: DBInvoice) -> int:
+    return _msatoshi(invoice.amount_requested, invoice.exchange_rate)
+
+def invoice_label(invoice: DBInvoice) -> str:
+    '''
+    @return: label on the node of @invoice.
+    '''
+    return "{}-{}-{}".format(LightningMonitor.LABEL_PREFIX, invoice.account_id, invoice.invoice_id)
+
 class LightningMonitor(Thread):
     instance = None
     
     LABEL_PREFIX = "OpenLightningWallet"
+    # See LightningNode.invoice
+    INVOICE_EXPIRY = "10m"
 
-    def __init__(self, lightning_node: LightningNode = None, polling_interval=0.5):
+    def __init__(self, lightning_node: LightningNode = None, polling_interval=0.5, exchange_info = market.exchange_info):
         Thread.__init__(self)
         # delegate to methods.
         def on_dbinvoice_created(topic:str, invoice: DBInvoice):
             self._create_invoice(topic, invoice)
+        def on_dbinvoice_claimed(topic:str, claimed):
+            self._watch_claimed_invoice(topic, *claimed)
 
         Pubsub.instance.subscribe('/invoice/created', on_dbinvoice_created)
+        Pubsub.instance.subscribe('/invoice/claimed', on_dbinvoice_claimed)
         
         self._lightning_node = lightning_node if lightning_node else LightningNode()
+        self._exchange_info = exchange_info
         self._pending_labels = {}
         self._lock = Lock()
         self._stop = False
         self._polling_interval = polling_interval
+        self._pool_refiller = Thread(target=self._run_pool_refills, daemon=True)
         
     def _create_invoice(self, topic, invoice: DBInvoice):
         assert invoice.invoice_id not in self._pending_labels
         assert topic == '/invoice/created'
         # Ask Lightning to generate an invoice
-        label = "{}-{}-{}".format(LightningMonitor.LABEL_PREFIX, invoice.account_id, invoice.invoice_id)
-        msatoshi = round(invoice.amount_requested * invoice.exchange_rate * 1000)
-        expiry = "10m"
+        label = invoice_label(invoice)
+        msatoshi = invoice_msatoshi(invoice)
+        expiry = LightningMonitor.INVOICE_EXPIRY
         encoded_invoice, expired_at = self._lightning_node.invoice(label, msatoshi, "", expiry)
 
         # Update database
@@ -374,19 +447,79 @@ class LightningMonitor(Thread):
         updated_invoice.expired_at = update_invoice['expired_at']
         Pubsub.instance.publish("/invoice/pending", updated_invoice)
 
+    def _watch_claimed_invoice(self, topic, invoice: DBInvoice, label: str):
+        '''
+        @invoice: already pending on the node with @label, e.g. claimed from a pool by InvoiceGenerator or created
+            by BulkInvoiceCreator.
+        '''
+        assert topic == '/invoice/claimed'
+        self._lock.acquire()
+        try:
+            self._pending_labels[invoice.invoice_id] = label
+        finally:
+            self._lock.release()
+        Pubsub.instance.publish("/invoice/pending", invoice)
+
+    def _refill_invoice_pools(self):
+        '''
+        Drop the pool invoices that are about to expire, and create invoices on the node for the pools that are short,
+        at most Config.InvoicePoolMaxInvoicesPerRefill.
+        '''
+        now = int(time.time())
+        min_expired_at = now + Config.InvoicePoolMinRemainingSeconds
+        DBInvoicePoolItem.delete_items_expiring_before(min_expired_at)
+
+        exchange_rate = None
+        remaining = Config.InvoicePoolMaxInvoicesPerRefill
+        for pool in DBInvoicePool.list_pools():
+            if remaining <= 0:
+                break
+            missing = pool.size - DBInvoicePoolItem.count_items(pool.account_id, pool.amount_requested, min_expired_at)
+            missing = min(missing, remaining)
+            if missing <= 0:
+                continue
+            remaining -= missing
+            if exchange_rate is None:
+                exchange_rate = self._exchange_info()["sat_per_usd"]
+                assert exchange_rate, "No exchange rate"
+            items = []
+            for _ in range(missing):
+                item = DBInvoicePoolItem()
+                item.account_id = pool.account_id
+                item.amount_requested = pool.amount_requested
+                item.exchange_rate = exchange_rate
+                item.label = "{}-pool-{}-{}".format(LightningMonitor.LABEL_PREFIX, pool.account_id, uuid4().hex)
+                item.encoded_invoice, item.expired_at = self._lightning_node.invoice(item.label,
+                    _msatoshi(pool.amount_requested, exchange_rate), "", Config.InvoicePoolInvoiceExpiry)
+                items.append(item)
+            DBInvoicePoolItem.insert_items(items)
+
+    def _run_pool_refills(self):
+        while not self._stop:
+            time.sleep(Config.InvoicePoolRefillInterval)
+            try:
+                self._refill_invoice_pools()
+            except Exception as e:
+                # e.g. no exchange rate. Retried on the next one.
+                LOGGER.warning("Failed to refill invoice pools: {}".format(str(e)))
+
     def _finalize_invoice(self, invoice_id, status):
         assert invoice_id in self._pending_labels
         assert status in ["expired", "paid"], "Invalid status {}".format(status)
-        # Update database
+        # Update database. The account stats are updated in the same transaction so that they match the invoices.
         update_invoice = {
             'status': status,
         }
-        DBUtils.update('invoices', update_invoice, "invoice_id", invoice_id)
+        with DBUtils.transaction():
+            DBUtils.update('invoices', update_invoice, "invoice_id", invoice_id)
+            DBAccountDailyStats.add_finalized_invoice(invoice_id)
+            updated_invoice = DBInvoice.get_invoice_by_id(invoice_id)
 
         # Notify the status update
-        updated_invoice = DBInvoice()
-        updated_invoice.invoice_id = invoice_id
-        updated_invoice.status = status
+        if updated_invoice is None:
+            updated_invoice = DBInvoice()
+            updated_invoice.invoice_id = invoice_id
+            updated_invoice.status = status
         Pubsub.instance.publish("/invoice/finalized", updated_invoice)
 
         # Remove it from the watchlist
@@ -401,6 +534,7 @@ class LightningMonitor(Thread):
 
     def run(self):
         LOGGER.debug("LightningMonitor start")
+        self._pool_refiller.start()
         while not self._stop:
             self._lock.acquire()
             pending_labels = dict(self._pending_labels)
@@ -1,8 +1,15 @@
-from .lightning import LightningNode, LightningMonitor
+from .lightning import AsyncLightningClient, LightningNode, LightningMonitor
+import asyncio
+import json
+import os
+import tempfile
+from .config import Config
 from .pubsub import Pubsub
-from .db import DBInvoice, DBAccount, DBUtils
+from .db import DBInvoice, DBAccount, DBUtils, DBAccountDailyStats, DBInvoicePool, DBInvoicePoolItem
+from .invoice_utils import InvoiceGenerator
 import unittest
 import random
+import threading
 import time
 import logging
 import sys
@@ -24,6 +31,7 @@ class TestLightning(unittest.TestCase):
         self.test_account: DBAccount = DBAccount.create_account(account)
 
     def tearDown(self):
+        DBUtils.delete("account_daily_stats", "account_id", self.test_account.account_id)
         DBUtils.delete("accounts", "account_id", self.test_account.account_id)
         
     def test_account(self):
@@ -51,6 +59,7 @@ class TestLightning(unittest.TestCase):
                 finalized_callback_called[0] = True
                 self.assertEqual(topic, "/invoice/finalized")
                 self.assertEqual(updated_invoice.status, "paid")
+                self.assertEqual(updated_invoice.account_id, self.test_account.account_id)
             Pubsub.instance.subscribe("/invoice/finalized", finalized_callback)
 
             # Create invoice
@@ -65,9 +74,143 @@ class TestLightning(unittest.TestCase):
             self.assertTrue(pending_callback_called[0])
             time.sleep(0.1)
             self.assertTrue(finalized_callback_called[0])
+            stats = DBAccountDailyStats.get_account_stats(self.test_account.account_id, 0, 2**40)
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(stats[0].paid_count, 1)
+            self.assertEqual(stats[0].paid_amount_requested, 20000)
 
             DBUtils.delete("invoices", "invoice_id", created_invoice.invoice_id)
         finally:
             moniter.stop()
 
 
+
+    def test_invoicePool(self):
+        class DummyLightningNode(LightningNode):
+            def __init__(self):
+                self.labels = []
+            def invoice(self, invoice_label, msatoshi, description, expiry):
+                self.labels.append(invoice_label)
+                return "encoded-" + invoice_label, int(time.time()) + 900
+            def invoice_status(self, invoice_label):
+                return "unpaid"
+
+        Pubsub.instance = Pubsub()
+        account_id = self.test_account.account_id
+        node = DummyLightningNode()
+        monitor = LightningMonitor(lightning_node=node, exchange_info=lambda: {"sat_per_usd": 2000})
+        DBInvoicePool.set_pool(account_id, 500, 2)
+        try:
+            # An item about to expire is dropped and replaced.
+            item = DBInvoicePoolItem()
+            item.account_id = account_id
+            item.amount_requested = 500
+            item.exchange_rate = 1000
+            item.encoded_invoice = "about-to-expire"
+            item.label = "about-to-expire"
+            item.expired_at = int(time.time()) + 1
+            DBInvoicePoolItem.insert_items([item])
+            # At most InvoicePoolMaxInvoicesPerRefill invoices are created per refill.
+            max_invoices_per_refill = Config.InvoicePoolMaxInvoicesPerRefill
+            Config.InvoicePoolMaxInvoicesPerRefill = 1
+            try:
+                monitor._refill_invoice_pools()
+            finally:
+                Config.InvoicePoolMaxInvoicesPerRefill = max_invoices_per_refill
+            self.assertEqual(len(node.labels), 1)
+            monitor._refill_invoice_pools()
+            self.assertEqual(len(node.labels), 2)
+            monitor._refill_invoice_pools()
+            self.assertEqual(len(node.labels), 2)
+            self.assertEqual(DBInvoicePoolItem.count_items(account_id, 500, 0), 2)
+
+            pending_invoices = []
+            Pubsub.instance.subscribe("/invoice/pending", lambda topic, invoice: pending_invoices.append(invoice))
+            invoice = InvoiceGenerator().generate(account_id, 500)
+            self.assertEqual(invoice["status"], "pending")
+            self.assertEqual(invoice["exchange_rate"], 2000)
+            self.assertIn(invoice["encoded_invoice"], ["encoded-" + label for label in node.labels])
+            self.assertEqual(DBInvoicePoolItem.count_items(account_id, 500, 0), 1)
+            self.assertEqual(DBInvoice.get_invoice_by_id(invoice["invoice_id"]).encoded_invoice, invoice["encoded_invoice"])
+            # The monitor watches the claimed invoice.
+            self.assertEqual([pending_invoice.invoice_id for pending_invoice in pending_invoices], [invoice["invoice_id"]])
+            self.assertIn(monitor._pending_labels[invoice["invoice_id"]], node.labels)
+
+            monitor._refill_invoice_pools()
+            self.assertEqual(len(node.labels), 3)
+            DBUtils.delete("invoices", "invoice_id", invoice["invoice_id"])
+        finally:
+            DBInvoicePool.set_pool(account_id, 500, 0)
+            DBUtils.delete("invoice_pool_items", "account_id", account_id)
+
+    def test_poolRefillDoesNotBlockPolling(self):
+        class DummyLightningNode(LightningNode):
+            def invoice(self, invoice_label, msatoshi, description, expiry):
+                return "encoded_invoice", int(time.time()) + 900
+            def invoice_status(self, invoice_label):
+                return "paid"
+        # A hung exchange rate request.
+        exchange_info_called = threading.Event()
+        release_exchange_info = threading.Event()
+        def exchange_info():
+            exchange_info_called.set()
+            release_exchange_info.wait()
+            return {"sat_per_usd": None}
+
+        Pubsub.instance = Pubsub()
+        account_id = self.test_account.account_id
+        DBInvoicePool.set_pool(account_id, 500, 1)
+        refill_interval = Config.InvoicePoolRefillInterval
+        Config.InvoicePoolRefillInterval = 0
+        monitor = LightningMonitor(lightning_node=DummyLightningNode(), polling_interval=0, exchange_info=exchange_info)
+        try:
+            monitor.start()
+            self.assertTrue(exchange_info_called.wait(1))
+            finalized_invoices = []
+            Pubsub.instance.subscribe("/invoice/finalized", lambda topic, invoice: finalized_invoices.append(invoice))
+            invoice = DBInvoice()
+            invoice.account_id = account_id
+            invoice.created_at = int(time.time())
+            invoice.amount_requested = 500
+            invoice.exchange_rate = 2000
+            created_invoice = DBInvoice.create_invoice(invoice)
+            deadline = time.time() + 1
+            while not finalized_invoices and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([created_invoice.invoice_id], [invoice.invoice_id for invoice in finalized_invoices])
+            DBUtils.delete("invoices", "invoice_id", created_invoice.invoice_id)
+        finally:
+            monitor.stop()
+            Config.InvoicePoolRefillInterval = refill_interval
+            release_exchange_info.set()
+            DBInvoicePool.set_pool(account_id, 500, 0)
+
+class AsyncLightningClientTest(unittest.TestCase):
+
+    def test_call(self):
+        socket_file = os.path.join(tempfile.mkdtemp(), "lightning-rpc")
+        closed = []
+        async def on_connection(reader, writer):
+            request = json.loads(await reader.readline())
+            if request["method"] == "getinfo":
+                writer.write((json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": {"params": request["params"]}}) + "\n\n").encode())
+                await writer.drain()
+            # Otherwise never responds, until the client goes away.
+            closed.append(await reader.read() == b"")
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_unix_server(on_connection, socket_file)
+            try:
+                client = AsyncLightningClient(socket_file)
+                response = await client.call("getinfo", {"a": 1})
+                self.assertEqual(response["result"], {"params": {"a": 1}})
+                # A call past its deadline is cancelled, which closes its connection.
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(client.call("waitanyinvoice"), 0.1)
+                await asyncio.sleep(0.1)
+                self.assertEqual(closed, [True, True])
+            finally:
+                server.close()
+                await server.wait_closed()
+        asyncio.run(run())
@@ -1,15 +1,24 @@
+import logging
 import requests
+from .config import Config
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+# Satoshis per bitcoin.
+COIN = 100000000
 
 def exchange_info():
     sat_per_usd = None
     usd_per_btc = None
-    response = requests.get("https://blockchain.info/tobtc?currency=USD&value=1")
+    response = requests.get("https://blockchain.info/tobtc?currency=USD&value=1",
+        timeout=Config.MarketRequestTimeoutSeconds)
     if response.status_code == 200:
         try: 
             btc_per_usd = float(response.text)
             sat_per_usd = int(round(btc_per_usd * COIN))
             usd_per_btc = round(1.0 / btc_per_usd, 2)
         except Exception as e:
-            logger.warn("exchange_info failed: {}".format(str(e)))
+            LOGGER.warning("exchange_info failed: {}".format(str(e)))
 
     return {"sat_per_usd": sat_per_usd, "usd_per_btc": usd_per_btc}
\ No newline at end of file
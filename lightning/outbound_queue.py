@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+import websockets
+from collections import deque
+from websockets import frames
+from .config import Config
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+# Policy violation. The client did not read what it asked for.
+CLOSE_CODE_SLOW_CONSUMER = 1008
+
+class SlowConsumerError(websockets.exceptions.ConnectionClosedError):
+    def __init__(self, error_message):
+        websockets.exceptions.ConnectionClosedError.__init__(self, None, frames.Close(CLOSE_CODE_SLOW_CONSUMER, "Slow consumer"))
+        self.error_message = error_message
+
+def _size(data) -> int:
+    # In bytes, as sent in the frame. str frames are UTF-8, whose length is that of the str when it is ASCII.
+    if isinstance(data, str) and not data.isascii():
+        return len(data.encode("utf-8"))
+    return len(data)
+
+class OutboundQueue():
+    '''
+    Messages to send on one websocket. send() only queues the message and one writer task writes the queue
+    to the websocket in order, so a client that reads slowly costs the queued bytes instead of blocking every sender.
+
+    Once @high_watermark bytes are queued the queue is congested: send() waits until the writer brings it down to
+    @low_watermark bytes, and feeds coalesce their items, see WebSocketSend.is_congested. A queue congested for
+    longer than @max_congested_seconds closes the websocket, whether or not anything is sending meanwhile.
+    '''
+    def __init__(self, websocket, high_watermark: int = Config.OutboundQueueHighWatermark, 
+            low_watermark: int = Config.OutboundQueueLowWatermark, 
+            max_congested_seconds: float = Config.OutboundQueueMaxCongestedSeconds):
+        '''
+        @websocket: WebSocketServerProtocol
+        '''
+        assert low_watermark <= high_watermark
+        self._websocket = websocket
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._max_congested_seconds = max_congested_seconds
+
+        self._messages = deque()
+        self._queued_bytes = 0
+        # When the queue went over the high watermark, None if it is not congested.
+        self._congested_since = None
+        # Closes the websocket once congested for max_congested_seconds, see _evict.
+        self._eviction_timer: asyncio.TimerHandle = None
+        self._uncongested = asyncio.Event()
+        self._uncongested.set()
+        self._writer_task = None
+        # Raised by send() once the websocket is closed.
+        self._error = None
+
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    def is_congested(self) -> bool:
+        return self._congested_since is not None
+
+    async def wait_uncongested(self):
+        '''
+        Wait until the queue is not congested.
+        @raise ConnectionClosed: once the websocket is closed.
+        '''
+        await self._uncongested.wait()
+        if self._error:
+            raise self._error
+
+    async def send(self, data):
+        if self._error:
+            raise self._error
+        await self.wait_uncongested()
+
+        self._messages.append(data)
+        self._queued_bytes += _size(data)
+        if self._congested_since is None and self._queued_bytes >= self._high_watermark:
+            self._congested_since = time.monotonic()
+            self._uncongested.clear()
+            self._eviction_timer = asyncio.get_running_loop().call_later(self._max_congested_seconds, 
+                lambda: asyncio.ensure_future(self._evict()))
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        '''
+        Write the queue until it is empty. An idle websocket has no writer task.
+        '''
+        try:
+            while self._messages:
+                data = self._messages[0]
+                await self._websocket.send(data)
+                self._messages.popleft()
+                self._queued_bytes -= _size(data)
+                if self._congested_since is not None and self._queued_bytes <= self._low_watermark:
+                    self._set_uncongested()
+        except websockets.exceptions.ConnectionClosed as e:
+            self._fail(e)
+        except Exception as e:
+            LOGGER.debug("OutboundQueue writer Exception: {}".format(str(e)))
+            self._fail(websockets.exceptions.ConnectionClosedError(None, None))
+        finally:
+            if self._writer_task is asyncio.current_task():
+                self._writer_task = None
+
+    def _set_uncongested(self):
+        self._congested_since = None
+        self._uncongested.set()
+        if self._eviction_timer is not None:
+            self._eviction_timer.cancel()
+            self._eviction_timer = None
+
+    def _fail(self, error):
+        self._error = error
+        self._messages.clear()
+        self._queued_bytes = 0
+        # Wake up the senders waiting for the queue, they raise self._error.
+        self._set_uncongested()
+
+    async def _evict(self):
+        self._eviction_timer = None
+        if self._error or self._congested_since is None:
+            return
+        LOGGER.info("Closing websocket congested for more than {} seconds with {} bytes queued".format(
+            self._max_congested_seconds, self._queued_bytes))
+        self._fail(SlowConsumerError("Congested for more than {} seconds".format(self._max_congested_seconds)))
+        self.close()
+        await self._websocket.close(CLOSE_CODE_SLOW_CONSUMER, "Slow consumer")
+
+    def close(self):
+        '''
+        Stop the writer. Queued messages are dropped, and send() raises from now on.
+        '''
+        if self._error is None:
+            self._fail(websockets.exceptions.ConnectionClosedOK(None, None))
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        if self._eviction_timer is not None:
+            self._eviction_timer.cancel()
+            self._eviction_timer = None
@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+import websockets
+from .outbound_queue import OutboundQueue, SlowConsumerError, CLOSE_CODE_SLOW_CONSUMER
+
+class MockWebSocket():
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        # send() blocks while cleared, like a remote that does not read.
+        self.reading = asyncio.Event()
+    async def send(self, data):
+        await self.reading.wait()
+        self.sent.append(data)
+    async def close(self, code, reason):
+        self.closed_with = (code, reason)
+
+class OutboundQueueTest(unittest.TestCase):
+
+    def test_watermarks(self):
+        async def run():
+            websocket = MockWebSocket()
+            queue = OutboundQueue(websocket, high_watermark=10, low_watermark=4, max_congested_seconds=10)
+            # Sending does not wait for the remote.
+            await queue.send("abc")
+            await queue.send("defg")
+            self.assertFalse(queue.is_congested())
+            await queue.send("hij")
+            self.assertTrue(queue.is_congested())
+            self.assertEqual(10, queue.queued_bytes())
+
+            # Senders wait while congested.
+            pending_send = asyncio.create_task(queue.send("klm"))
+            await asyncio.sleep(0.01)
+            self.assertFalse(pending_send.done())
+
+            websocket.reading.set()
+            await pending_send
+            await asyncio.sleep(0.01)
+            self.assertFalse(queue.is_congested())
+            self.assertEqual(["abc", "defg", "hij", "klm"], websocket.sent)
+            self.assertEqual(0, queue.queued_bytes())
+        asyncio.run(run())
+
+    def test_slowConsumer(self):
+        async def run():
+            websocket = MockWebSocket()
+            queue = OutboundQueue(websocket, high_watermark=4, low_watermark=0, max_congested_seconds=0.05)
+            await queue.send("abcd")
+            self.assertTrue(queue.is_congested())
+            with self.assertRaises(SlowConsumerError):
+                await queue.send("efgh")
+            self.assertEqual(CLOSE_CODE_SLOW_CONSUMER, websocket.closed_with[0])
+            # The websocket is closed for good.
+            with self.assertRaises(SlowConsumerError):
+                await queue.send("ijkl")
+            self.assertEqual([], websocket.sent)
+        asyncio.run(run())
+
+    def test_slowConsumerWithoutSenders(self):
+        async def run():
+            websocket = MockWebSocket()
+            queue = OutboundQueue(websocket, high_watermark=4, low_watermark=0, max_congested_seconds=0.05)
+            await queue.send("abcd")
+            # Nothing else is sent, e.g. only feeds, which wait while congested.
+            await asyncio.sleep(0.1)
+            self.assertEqual(CLOSE_CODE_SLOW_CONSUMER, websocket.closed_with[0])
+            with self.assertRaises(SlowConsumerError):
+                await queue.wait_uncongested()
+        asyncio.run(run())
+
+    def test_queuedBytes(self):
+        async def run():
+            websocket = MockWebSocket()
+            queue = OutboundQueue(websocket, high_watermark=100, low_watermark=0, max_congested_seconds=10)
+            await queue.send("ab")
+            await queue.send("\u00e9t\u00e9")
+            await queue.send(b"\x00\x01")
+            self.assertEqual(2 + 5 + 2, queue.queued_bytes())
+            queue.close()
+        asyncio.run(run())
+
+    def test_sendAfterClose(self):
+        async def run():
+            websocket = MockWebSocket()
+            websocket.reading.set()
+            queue = OutboundQueue(websocket, high_watermark=100, low_watermark=0, max_congested_seconds=10)
+            queue.close()
+            with self.assertRaises(websockets.exceptions.ConnectionClosed):
+                await queue.send("abc")
+            await asyncio.sleep(0.01)
+            self.assertEqual([], websocket.sent)
+            self.assertIsNone(queue._writer_task)
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
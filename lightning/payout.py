@@ -0,0 +1,159 @@
+import argparse
+import logging
+import sys
+import typing
+from collections import OrderedDict
+from threading import Event, Thread
+from .config import Config
+from .db import DatabaseParams, DBPayout, DBUtils
+from .pubsub import Pubsub
+
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+class PayoutBatch():
+    def __init__(self, account_id: int, method: str):
+        '''
+        Payouts of one account and method, paid out together. Payload of the "/payout/*" topics.
+        '''
+        self.account_id = account_id
+        self.method = method
+        # In USD. Sum of the amounts of the payouts.
+        self.amount = 0
+        self.payout_ids: typing.List[int] = []
+
+def _aggregate(payouts: typing.List[DBPayout]) -> typing.List[PayoutBatch]:
+    batches: typing.Dict[tuple, PayoutBatch] = OrderedDict()
+    for payout in payouts:
+        key = (payout.account_id, payout.method)
+        if key not in batches:
+            batches[key] = PayoutBatch(payout.account_id, payout.method)
+        batches[key].amount += payout.amount
+        batches[key].payout_ids.append(payout.payoutId)
+    return list(batches.values())
+
+class PayoutScheduler(Thread):
+    '''
+    Picks up the "initiated" payouts every @polling_interval seconds, @batch_size at a time, and moves them
+        "initiated" -> "pending" -> "sent", or "failed" if @payout_sender raises.
+    Without @payout_sender, e.g. for payouts by "mail" which are sent by hand, the payouts stay "pending" until an
+    operator pays them out and moves them on, see main().
+    The payouts of a batch are aggregated per (account, method) into one PayoutBatch, so that an account gets one
+    payment for all its payouts of the batch. Each step updates the whole batch in one transaction and publishes
+    each PayoutBatch on "/payout/pending", then "/payout/sent" or "/payout/failed".
+
+    Payouts left "pending" by a crash are not picked up again, so that nothing is paid twice. They are for an
+    operator to check. "completed" is also set by an operator once the payment arrived.
+    Started by server.py, or on its own with `python -m lightning.payout run`.
+    '''
+    instance = None
+
+    def __init__(self, payout_sender: typing.Callable[[PayoutBatch], None] = None,
+            batch_size: int = Config.PayoutBatchSize, polling_interval: float = Config.PayoutPollingInterval):
+        '''
+        @payout_sender: pays out a PayoutBatch. Raises if it is not paid. If None, payouts are left "pending".
+        '''
+        Thread.__init__(self)
+        self._payout_sender = payout_sender
+        self._batch_size = batch_size
+        self._polling_interval = polling_interval
+        self._stop_event = Event()
+
+    def process_payouts(self) -> int:
+        '''
+        Process the payouts that are "initiated" now, in batches.
+        @return: number of batches processed.
+        '''
+        n_batches = 0
+        after_payout_id = 0
+        while True:
+            payouts = DBPayout.list_payouts_by_status("initiated", after_payout_id, self._batch_size)
+            if not payouts:
+                break
+            self._process_batch(payouts)
+            n_batches += 1
+            after_payout_id = payouts[-1].payoutId
+        return n_batches
+
+    def _process_batch(self, payouts: typing.List[DBPayout]):
+        pending_ids = set(DBPayout.update_statuses([payout.payoutId for payout in payouts], "initiated", "pending"))
+        batches = _aggregate([payout for payout in payouts if payout.payoutId in pending_ids])
+        for batch in batches:
+            Pubsub.instance.publish("/payout/pending", batch)
+        if self._payout_sender is None:
+            for batch in batches:
+                LOGGER.info("Payout of {} USD by {} to account {} is pending, payouts {}".format(
+                    batch.amount, batch.method, batch.account_id, batch.payout_ids))
+            return
+
+        sent = []
+        failed = []
+        for batch in batches:
+            try:
+                self._payout_sender(batch)
+                sent.append(batch)
+            except Exception as e:
+                LOGGER.warning("Failed to pay out {} to account {}: {}".format(batch.payout_ids, batch.account_id, str(e)))
+                failed.append(batch)
+
+        with DBUtils.transaction():
+            DBPayout.update_statuses([payout_id for batch in sent for payout_id in batch.payout_ids], "pending", "sent")
+            DBPayout.update_statuses([payout_id for batch in failed for payout_id in batch.payout_ids], "pending", "failed")
+        for batch in sent:
+            Pubsub.instance.publish("/payout/sent", batch)
+        for batch in failed:
+            Pubsub.instance.publish("/payout/failed", batch)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        LOGGER.debug("PayoutScheduler start")
+        while not self._stop_event.wait(self._polling_interval):
+            try:
+                n_batches = self.process_payouts()
+                if n_batches:
+                    LOGGER.info("Processed {} payout batches".format(n_batches))
+            except Exception as e:
+                LOGGER.error("Failed to process payouts: {}".format(str(e)))
+        LOGGER.debug("PayoutScheduler has stopped.")
+
+PayoutScheduler.instance = PayoutScheduler()
+
+# Status an operator moves payouts to -> the status they must be in.
+_OPERATOR_TRANSITIONS = {"sent": "pending", "completed": "sent", "failed": "pending"}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Process payouts.")
+    parser.add_argument("--db-path", default=DatabaseParams.get_db_path())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("run", help="Process the initiated payouts until interrupted.")
+    subparsers.add_parser("list-pending", help="Print the pending payouts to pay out, per account and method.")
+    set_status_parser = subparsers.add_parser("set-status", help="Move payouts on once paid out, or once the payment arrived.")
+    set_status_parser.add_argument("status", choices=list(_OPERATOR_TRANSITIONS.keys()))
+    set_status_parser.add_argument("payout_ids", type=int, nargs="+")
+    args = parser.parse_args(argv)
+
+    DatabaseParams.set_db_path(args.db_path)
+    if args.command == "run":
+        PayoutScheduler.instance.run()
+    elif args.command == "list-pending":
+        after_payout_id = 0
+        while True:
+            payouts = DBPayout.list_payouts_by_status("pending", after_payout_id, Config.PayoutBatchSize)
+            if not payouts:
+                break
+            for batch in _aggregate(payouts):
+                print("account_id={} method={} amount={} payout_ids={}".format(
+                    batch.account_id, batch.method, batch.amount, " ".join(str(payout_id) for payout_id in batch.payout_ids)))
+            after_payout_id = payouts[-1].payoutId
+    else:
+        updated_ids = DBPayout.update_statuses(args.payout_ids, _OPERATOR_TRANSITIONS[args.status], args.status)
+        skipped_ids = sorted(set(args.payout_ids) - set(updated_ids))
+        if skipped_ids:
+            print("Not {}: {}".format(_OPERATOR_TRANSITIONS[args.status], " ".join(str(payout_id) for payout_id in skipped_ids)))
+
+if __name__ == '__main__':
+    # python -m lightning.payout list-pending
+    # python -m lightning.payout set-status sent 12 13
+    main(sys.argv[1:])
@@ -0,0 +1,91 @@
+import random
+import unittest
+from .db import DBAccount, DBPayout, DBUtils
+from .payout import PayoutScheduler, main
+from .pubsub import Pubsub
+
+class PayoutSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.accounts = []
+        for _ in range(2):
+            account = DBAccount()
+            account.username = "Jack" + str(random.random())
+            account.password = "dummypass"
+            account.email = "dummyemail"
+            account.mailing_address = "Addr"
+            self.accounts.append(DBAccount.create_account(account))
+        self.payout_ids = []
+
+    def tearDown(self):
+        for payout_id in self.payout_ids:
+            DBUtils.delete("payouts", "payoutId", payout_id)
+        for account in self.accounts:
+            DBUtils.delete("accounts", "account_id", account.account_id)
+
+    def _create_payout(self, account_id, amount):
+        payout = DBPayout()
+        payout.account_id = account_id
+        payout.method = "mail"
+        payout.amount = amount
+        DBPayout.create_payout(payout)
+        self.payout_ids.append(payout.payoutId)
+        return payout
+
+    def test_processPayouts(self):
+        succeeding, failing = self.accounts
+        for amount in [10, 20, 30]:
+            self._create_payout(succeeding.account_id, amount)
+        for amount in [5, 7]:
+            self._create_payout(failing.account_id, amount)
+
+        def sender(batch):
+            if batch.account_id == failing.account_id:
+                raise Exception("Address unknown")
+            sent_batches.append(batch)
+        sent_batches = []
+        events = []
+        subscriber_ids = [Pubsub.instance.subscribe(topic, lambda topic, batch: events.append((topic, batch)))
+            for topic in ["/payout/pending", "/payout/sent", "/payout/failed"]]
+        try:
+            n_batches = PayoutScheduler(sender, batch_size=2, polling_interval=0).process_payouts()
+        finally:
+            for subscriber_id in subscriber_ids:
+                Pubsub.instance.unsubscribe(subscriber_id)
+
+        self.assertEqual(3, n_batches)
+        self.assertEqual(60, sum(batch.amount for batch in sent_batches))
+        statuses = {payout.payoutId: payout.status for payout in DBPayout.list_payouts_by_status("sent", 0, 1000)}
+        statuses.update({payout.payoutId: payout.status for payout in DBPayout.list_payouts_by_status("failed", 0, 1000)})
+        self.assertEqual(["sent"] * 3 + ["failed"] * 2, [statuses[payout_id] for payout_id in self.payout_ids])
+
+        # One event per account of each batch, e.g. the second batch has a payout of each account.
+        self.assertEqual(["/payout/pending", "/payout/sent", "/payout/pending", "/payout/pending", "/payout/sent",
+            "/payout/failed", "/payout/pending", "/payout/failed"], [topic for topic, _ in events])
+        self.assertEqual([30, 30], [batch.amount for topic, batch in events if topic == "/payout/sent"])
+        self.assertEqual([5, 7], [batch.amount for topic, batch in events if topic == "/payout/failed"])
+
+        # Nothing left to process.
+        self.assertEqual(0, PayoutScheduler(sender, batch_size=2).process_payouts())
+
+    def test_withoutSender(self):
+        payouts = [self._create_payout(self.accounts[0].account_id, amount) for amount in [10, 20]]
+        self.assertEqual(1, PayoutScheduler(batch_size=10).process_payouts())
+        pending_ids = [payout.payoutId for payout in DBPayout.list_payouts_by_status("pending", 0, 1000)]
+        self.assertEqual(self.payout_ids, [payout_id for payout_id in pending_ids if payout_id in self.payout_ids])
+
+        # The operator moves them on once paid out.
+        main(["set-status", "sent", str(payouts[0].payoutId)])
+        main(["set-status", "completed", str(payouts[0].payoutId), str(payouts[1].payoutId)])
+        completed_ids = [payout.payoutId for payout in DBPayout.list_payouts_by_status("completed", 0, 1000)]
+        self.assertIn(payouts[0].payoutId, completed_ids)
+        self.assertNotIn(payouts[1].payoutId, completed_ids)
+
+    def test_updateStatuses(self):
+        payout = self._create_payout(self.accounts[0].account_id, 10)
+        self.assertEqual([payout.payoutId], DBPayout.update_statuses([payout.payoutId], "initiated", "pending"))
+        # Already moved.
+        self.assertEqual([], DBPayout.update_statuses([payout.payoutId], "initiated", "pending"))
+
+if __name__ == '__main__':
+    unittest.main()
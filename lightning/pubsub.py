@@ -42,7 +42,7 @@ class Pubsub():
     def publish(self, topic: str, payload):
         self._lock.acquire()
         try:
-            callbacks = self._callbacks.values()
+            callbacks = list(self._callbacks.values())
         finally:
             self._lock.release()
 
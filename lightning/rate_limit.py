@@ -0,0 +1,92 @@
+import time
+import typing
+from collections import OrderedDict
+from threading import Lock
+
+class _TokenBucket():
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+class TokenBucketLimiter():
+    '''
+    A token bucket per key, e.g. per username. Each key may do @burst requests at once and @rate requests per
+    second on average. Buckets of at most @max_keys keys are kept in an LRU, a new key evicts the least recently
+    used one. Evicting a bucket that has not refilled yet resets it, so such evictions also take a token from a
+    bucket shared by all keys, of @overflow_rate and @overflow_burst. Cycling through many keys is then limited by
+    it, while new keys are still let in.
+    Thread safe.
+    '''
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000, clock = time.monotonic,
+            overflow_rate: float = None, overflow_burst: int = None):
+        '''
+        @overflow_rate, @overflow_burst: @rate and @burst if None.
+        '''
+        self._rate = rate
+        self._burst = burst
+        self._max_keys = max_keys
+        self._clock = clock
+        self._overflow_rate = rate if overflow_rate is None else overflow_rate
+        self._overflow_burst = burst if overflow_burst is None else overflow_burst
+        self._overflow_bucket = _TokenBucket(self._overflow_burst, clock())
+        self._buckets: typing.Dict[typing.Any, _TokenBucket] = OrderedDict()
+        self._lock = Lock()
+        # Counters for monitoring.
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def try_acquire(self, key) -> bool:
+        '''
+        @return: True and take a token if @key has one, otherwise False.
+        '''
+        now = self._clock()
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.get(key, None)
+            if bucket is None:
+                if len(self._buckets) >= self._max_keys:
+                    if not self._is_full(next(iter(self._buckets.values())), now) and not self._take_overflow_token(now):
+                        self.rejected += 1
+                        return False
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+                bucket = _TokenBucket(self._burst, now)
+                self._buckets[key] = bucket
+            else:
+                self._buckets.move_to_end(key)
+                bucket.tokens = min(self._burst, bucket.tokens + (now - bucket.updated_at) * self._rate)
+                bucket.updated_at = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                self.allowed += 1
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def _take_overflow_token(self, now: float) -> bool:
+        bucket = self._overflow_bucket
+        bucket.tokens = min(self._overflow_burst, bucket.tokens + (now - bucket.updated_at) * self._overflow_rate)
+        bucket.updated_at = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True
+        return False
+
+    def _is_full(self, bucket: _TokenBucket, now: float) -> bool:
+        return bucket.tokens + (now - bucket.updated_at) * self._rate >= self._burst
+
+    def get_counters(self) -> dict:
+        self._lock.acquire()
+        try:
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+                "keys": len(self._buckets)
+            }
+        finally:
+            self._lock.release()
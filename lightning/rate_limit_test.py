@@ -0,0 +1,55 @@
+import unittest
+from .rate_limit import TokenBucketLimiter
+
+class TokenBucketLimiterTest(unittest.TestCase):
+
+    def test_tryAcquire(self):
+        now = [100.0]
+        limiter = TokenBucketLimiter(rate=0.5, burst=2, clock=lambda: now[0])
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertFalse(limiter.try_acquire("alice"))
+        # Other keys have their own bucket.
+        self.assertTrue(limiter.try_acquire("bob"))
+
+        # One token is back after 2 seconds.
+        now[0] += 2
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertFalse(limiter.try_acquire("alice"))
+
+        # Tokens do not accumulate beyond burst.
+        now[0] += 100
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertFalse(limiter.try_acquire("alice"))
+
+        self.assertEqual(limiter.get_counters(), {"allowed": 6, "rejected": 3, "evicted": 0, "keys": 2})
+
+    def test_evictLeastRecentlyUsed(self):
+        now = [0.0]
+        limiter = TokenBucketLimiter(rate=1, burst=1, max_keys=2, clock=lambda: now[0])
+        self.assertTrue(limiter.try_acquire("a"))
+        now[0] += 1
+        self.assertTrue(limiter.try_acquire("b"))
+        # "a" was the least recently used one and had refilled, so it is evicted and starts over.
+        self.assertTrue(limiter.try_acquire("c"))
+        counters = limiter.get_counters()
+        self.assertEqual(counters["evicted"], 1)
+        self.assertEqual(counters["keys"], 2)
+        self.assertTrue(limiter.try_acquire("a"))
+        self.assertEqual(limiter.get_counters()["evicted"], 2)
+
+    def test_evictDrainedBuckets(self):
+        now = [0.0]
+        limiter = TokenBucketLimiter(rate=0.1, burst=1, max_keys=3, clock=lambda: now[0], overflow_rate=1, overflow_burst=2)
+        for key in ["a", "b", "c"]:
+            self.assertTrue(limiter.try_acquire(key))
+            self.assertFalse(limiter.try_acquire(key))
+        # A full table of drained buckets still lets new keys in, as long as the shared bucket has tokens.
+        self.assertTrue(limiter.try_acquire("d"))
+        self.assertTrue(limiter.try_acquire("e"))
+        self.assertFalse(limiter.try_acquire("f"))
+        self.assertEqual(["c", "d", "e"], list(limiter._buckets.keys()))
+        now[0] += 1
+        self.assertTrue(limiter.try_acquire("f"))
+        self.assertEqual(limiter.get_counters(), {"allowed": 6, "rejected": 4, "evicted": 3, "keys": 3})
@@ -1,17 +1,67 @@
 import asyncio
+import logging
 import websockets
+from http import HTTPStatus
 from lightning.jsonrpc_over_websocket import JsonRpc, WebSocketServerProtocolWrapper
+from lightning.codec import available_subprotocols
+from lightning.compression import server_extensions, compression_metrics
+from lightning.config import Config
+from lightning.connection_registry import CLOSE_CODE_TRY_AGAIN_LATER, ConnectionLimitError, ConnectionRegistry, close_if_unauthenticated
+from lightning.db import DatabaseParams
+from lightning.db_schema.migration import apply_updates
+from lightning.lightning import LightningMonitor
+from lightning.payout import PayoutScheduler
 
-_NUMBER_OF_HANDLERS = 10
+LOGGER = logging.getLogger(__file__)
+LOGGER.setLevel(Config.LoggingLevel)
+
+async def _process_request(path, request_headers):
+    # Rejected before the handshake, so that a full server spends nothing more on the connection.
+    if ConnectionRegistry.instance.is_full():
+        return HTTPStatus.SERVICE_UNAVAILABLE, [], b"Too many connections\n"
+    return None
 
 async def _entry(websocket):
-    jsonrpc = JsonRpc(WebSocketServerProtocolWrapper(websocket))
-    handlers = [asyncio.create_task(jsonrpc.handle()) for _ in range(_NUMBER_OF_HANDLERS)]
-    await asyncio.gather(*handlers)
+    websocket_wrapper = WebSocketServerProtocolWrapper(websocket)
+    jsonrpc = JsonRpc(websocket_wrapper)
+    try:
+        ConnectionRegistry.instance.register(jsonrpc.jsonrpc_session)
+    except ConnectionLimitError as e:
+        LOGGER.info("Rejected {}: {}".format(websocket.remote_address, str(e)))
+        websocket_wrapper.close()
+        await websocket.close(CLOSE_CODE_TRY_AGAIN_LATER, "Too many connections")
+        return
+    authenticate_timeout = asyncio.create_task(close_if_unauthenticated(websocket, jsonrpc.jsonrpc_session))
+    try:
+        await jsonrpc.handle()
+    finally:
+        authenticate_timeout.cancel()
+        websocket_wrapper.close()
+        ConnectionRegistry.instance.unregister(jsonrpc.jsonrpc_session)
+    metrics = compression_metrics(websocket)
+    if metrics:
+        LOGGER.debug("Compression of {}: {}".format(websocket.remote_address, metrics.to_dict()))
+
+async def _log_connection_counts():
+    while True:
+        await asyncio.sleep(Config.ConnectionCountsLogInterval)
+        LOGGER.info("Connections: {}".format(ConnectionRegistry.instance.get_counts()))
 
 async def _main():
-    async with websockets.serve(_entry, "localhost", 8000):
-        await asyncio.Future()  # run forever
+    apply_updates(DatabaseParams.get_db_path())
+    # Creates the invoices of create_invoice on the node and watches their status.
+    LightningMonitor.instance = LightningMonitor()
+    LightningMonitor.instance.daemon = True
+    LightningMonitor.instance.start()
+    # Moves the initiated payouts to pending for an operator, see `python -m lightning.payout`.
+    PayoutScheduler.instance.daemon = True
+    PayoutScheduler.instance.start()
+    # Clients that send no Sec-WebSocket-Protocol get JSON text frames.
+    async with websockets.serve(_entry, "localhost", 8000, subprotocols=available_subprotocols(),
+            extensions=server_extensions(), compression=None, process_request=_process_request,
+            ping_interval=Config.WebSocketPingInterval, ping_timeout=Config.WebSocketPingTimeout,
+            max_size=Config.WebSocketMaxMessageSize, max_queue=Config.WebSocketMaxQueue):
+        await _log_connection_counts()  # run forever
 
 if __name__ == '__main__':
     asyncio.run(_main())
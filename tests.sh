@@ -1,8 +1,21 @@
 . venv/bin/activate
+python -m lightning.db_schema.migration
+python -m unittest lightning/db_schema/migration_test.py
 python -m unittest lightning/db_test.py
 python -m unittest lightning/pubsub_test.py
 python -m unittest lightning/lightning_test.py
 python -m unittest lightning/auth_test.py
+python -m unittest lightning/codec_test.py
+python -m unittest lightning/compression_test.py
+python -m unittest lightning/rate_limit_test.py
+python -m unittest lightning/account_cache_test.py
+python -m unittest lightning/outbound_queue_test.py
+python -m unittest lightning/connection_registry_test.py
+python -m unittest lightning/feed_replay_test.py
+python -m unittest lightning/feed_router_test.py
+python -m unittest lightning/feed_filter_test.py
 python -m unittest lightning/feed_handler_test.py
 python -m unittest lightning/invoice_utils_test.py
+python -m unittest lightning/invoice_export_test.py
+python -m unittest lightning/payout_test.py
 python -m unittest lightning/jsonrpc_over_websocket_test.py
\ No newline at end of file